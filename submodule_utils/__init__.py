@@ -35,6 +35,8 @@ import numpy as np
 
 # Modules
 from submodule_utils.subtype_enum import BinaryEnum
+from submodule_utils.patch_store import PatchStore, PatchStoreWriter, write_patch_store
+from submodule_utils.shards import get_shard_path, consolidate_shards
 
 DEAFULT_SEED = 256
 # TODO fix this regex!
@@ -342,14 +344,16 @@ def create_patch_pattern(patch_pattern):
 
     Parameters
     ----------
-    patch_pattern : str
-        String of '/' separated words
+    patch_pattern : str or dict
+        String of '/' separated words, or a dict of the words and their ordering which is returned unchanged.
 
     Returns
     -------
     dict
         Empty dict if patch pattern is '', otherwise each word becomes a dict key with int ID giving position of the key in patch pattern.
     '''
+    if isinstance(patch_pattern, dict):
+        return patch_pattern
     if patch_pattern == '' or patch_pattern == "'":
         return {}
     else:
@@ -1096,13 +1100,32 @@ def get_origin(slide_id, dataset_origin):
             return origin
 
 def save_hdf5(output_path, paths, patch_size, mode='w'):
-    hf = h5py.File(output_path, mode)
-    dset1 = hf.create_dataset('paths', data=paths)
-    hf.attrs['patch_size'] = patch_size
-    hf.close()
+    """Save patch paths to a hd5 file. Paths with file names of the form {x}_{y}.{extension} are stored as chunked integer coordinate arrays (version 2 layout), otherwise the full path strings are stored (version 1 layout). See submodule_utils.patch_store.
+
+    Parameters
+    ----------
+    output_path : str
+        Path to the hd5 file.
+
+    paths : list of str
+        Patch paths.
+
+    patch_size : int
+
+    mode : str
+        Mode to open the hd5 file with. With mode 'a' the paths are appended to the patches of an existing version 2 file. Use PatchStoreWriter to write paths in batches.
+    """
+    with h5py.File(output_path, mode) as hf:
+        try:
+            write_patch_store(hf, paths, patch_size)
+        except ValueError:
+            if 'x' in hf:
+                raise
+            hf.create_dataset('paths', data=paths)
+            hf.attrs['patch_size'] = patch_size
 
 def open_hd5_file(hd5_path):
-    """Extract data from a hd5 file.
+    """Extract data from a hd5 file written in either layout of save_hdf5. Use PatchStore to read the patches lazily.
 
     Parameters
     ----------
@@ -1116,9 +1139,9 @@ def open_hd5_file(hd5_path):
         - paths (array)
         - patch_size (int)
     """
-    with h5py.File(hd5_path, "r") as f:
-        paths = [path.decode("utf-8") for path in list(f['paths'])]
-        patch_size = f.attrs['patch_size']
+    with PatchStore(hd5_path) as store:
+        paths = store.get_paths()
+        patch_size = store.patch_size
     return paths, patch_size
 
 def get_patchsize_by_patch_path(path):
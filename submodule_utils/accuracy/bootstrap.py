@@ -0,0 +1,223 @@
+"""Bootstrap confidence intervals of slide level metrics.
+
+The slides are resampled with replacement as one (resamples, slides) index matrix, and the confusion matrices of all resamples are counted with a single bincount. Accuracy, kappa and F1 score are computed from the batch of confusion matrices, and AUC from the ranks of the probabilities of each resample, without calling sklearn per resample.
+
+Resamples are drawn in blocks of BOOTSTRAP_BLOCK_SIZE, each with its own seed spawned from the seed, so blocks can be computed on a process pool and the samples only depend on the seed.
+"""
+import multiprocessing
+
+import numpy as np
+
+from submodule_utils import DEAFULT_SEED
+
+BOOTSTRAP_RESAMPLES = 2000
+BOOTSTRAP_BLOCK_SIZE = 250
+BOOTSTRAP_METRICS = ['weighted_acc', 'kappa', 'f1_score', 'auc', 'average_acc']
+
+
+def get_resample_indices(n, n_resamples, rng):
+    """Draw the indices of n_resamples resamples with replacement of n items.
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of shape (n_resamples, n).
+    """
+    return rng.integers(0, n, size=(n_resamples, n))
+
+
+def get_confusion_matrices(real_labels, pred_labels, n_classes):
+    """Count the confusion matrices of a batch of label arrays with one bincount.
+
+    Parameters
+    ----------
+    real_labels, pred_labels : np.ndarray
+        int arrays of shape (resamples, n).
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of shape (resamples, n_classes, n_classes) where entry [r, i, j] is the number of items of resample r with real label i predicted as j.
+    """
+    n_resamples = len(real_labels)
+    offsets = np.arange(n_resamples)[:, None] * n_classes * n_classes
+    counts = np.bincount((offsets + real_labels * n_classes + pred_labels).ravel(),
+                         minlength=n_resamples * n_classes * n_classes)
+    return counts.reshape(n_resamples, n_classes, n_classes)
+
+
+def get_confusion_metrics(conf_matrices):
+    """Get the metrics of a batch of confusion matrices of get_confusion_matrices.
+
+    The metrics are the same as SlideLevelAccuracy.get_level_metrics: the F1 score is averaged over the classes that are either real or predicted as with sklearn, and the average accuracy counts classes without slides as 0.
+
+    Returns
+    -------
+    dict
+        {metric: np.ndarray of shape (resamples,)} of weighted_acc, kappa, f1_score and average_acc.
+    """
+    conf_matrices = conf_matrices.astype(np.float64)
+    n = conf_matrices.sum(axis=(1, 2))
+    true_positives = np.diagonal(conf_matrices, axis1=1, axis2=2)
+    real_counts = conf_matrices.sum(axis=2)
+    pred_counts = conf_matrices.sum(axis=1)
+    observed = true_positives.sum(axis=1) / n
+    expected = (real_counts * pred_counts).sum(axis=1) / n ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kappa = (observed - expected) / (1 - expected)
+        f1 = 2 * true_positives / (real_counts + pred_counts)
+        recall = np.where(real_counts > 0, true_positives / real_counts, 0.)
+        f1_score = np.nanmean(f1, axis=1)
+    return {
+        'weighted_acc': observed * 100,
+        'kappa': kappa,
+        'f1_score': f1_score,
+        'average_acc': recall.mean(axis=1) * 100,
+    }
+
+
+def get_average_ranks(values):
+    """Rank the values of each row from 1, giving tied values the average of their ranks.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Array of shape (rows, n).
+
+    Returns
+    -------
+    np.ndarray
+        float64 array of shape (rows, n) of the rank of each value in its row.
+    """
+    n = values.shape[1]
+    order = np.argsort(values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    changes = sorted_values[:, 1:] != sorted_values[:, :-1]
+    ends = np.ones(values.shape, dtype=bool)
+    starts = np.ones(values.shape, dtype=bool)
+    starts[:, 1:] = changes
+    ends[:, :-1] = changes
+    positions = np.arange(n)
+    # first and last position of the tie group of each sorted value
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, n)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=1)
+    return ranks
+
+
+def get_batch_auc(real_labels, probabilities):
+    """Get the AUC of a batch of resamples from the average ranks of the probabilities.
+
+    Parameters
+    ----------
+    real_labels : np.ndarray
+        int array of shape (resamples, n).
+
+    probabilities : np.ndarray
+        Array of shape (resamples, n, classes).
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (resamples,) of the AUC of the probabilities of class 1 if there are 2 classes, otherwise the unweighted mean of the one-vs-rest AUC of each class. NaN for resamples where the AUC is undefined, i.e. a class has no slides.
+    """
+    n_classes = probabilities.shape[2]
+    classes = [1] if n_classes == 2 else range(n_classes)
+    aucs = []
+    for c in classes:
+        positives = real_labels == c
+        n_positives = positives.sum(axis=1)
+        n_negatives = positives.shape[1] - n_positives
+        ranks = get_average_ranks(probabilities[:, :, c])
+        rank_sums = np.where(positives, ranks, 0.).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            auc = (rank_sums - n_positives * (n_positives + 1) / 2) / (n_positives * n_negatives)
+        aucs.append(np.where((n_positives > 0) & (n_negatives > 0), auc, np.nan))
+    return np.mean(aucs, axis=0)
+
+
+def bootstrap_block(real_labels, probabilities, n_resamples, seed):
+    """Get the metrics of one block of resamples.
+
+    Parameters
+    ----------
+    seed : np.random.SeedSequence or int
+
+    Returns
+    -------
+    dict
+        {metric: np.ndarray of shape (n_resamples,)} of BOOTSTRAP_METRICS.
+    """
+    rng = np.random.default_rng(seed)
+    indices = get_resample_indices(len(real_labels), n_resamples, rng)
+    resampled_labels = real_labels[indices]
+    resampled_probabilities = probabilities[indices]
+    # first class with the most votes, as list.index(max(votes))
+    pred_labels = resampled_probabilities.argmax(axis=2)
+    metrics = get_confusion_metrics(get_confusion_matrices(
+            resampled_labels, pred_labels, probabilities.shape[1]))
+    metrics['auc'] = get_batch_auc(resampled_labels, resampled_probabilities)
+    return metrics
+
+
+def _bootstrap_block(args):
+    return bootstrap_block(*args)
+
+
+def bootstrap_metrics(real_labels, probabilities, n_resamples=BOOTSTRAP_RESAMPLES,
+                      seed=DEAFULT_SEED, n_process=None, block_size=BOOTSTRAP_BLOCK_SIZE):
+    """Get the bootstrap samples of the slide level metrics.
+
+    Parameters
+    ----------
+    real_labels : np.ndarray
+        int array of the real label of each slide.
+
+    probabilities : np.ndarray
+        Array of shape (slides, classes) of the probabilities of each slide, i.e. the fractions of its votes. The predicted label is the first class with the largest probability.
+
+    n_resamples : int
+        Number of resamples.
+
+    seed : int
+        Seed of the resamples. The samples are the same for any n_process.
+
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    block_size : int
+        Number of resamples per block, which bounds memory to about block_size * slides * classes probabilities.
+
+    Returns
+    -------
+    dict
+        {metric: np.ndarray of shape (n_resamples,)} of BOOTSTRAP_METRICS.
+    """
+    real_labels = np.asarray(real_labels, dtype=np.int64)
+    probabilities = np.asarray(probabilities)
+    block_sizes = [min(block_size, n_resamples - start) for start in range(0, n_resamples, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    jobs = [(real_labels, probabilities, size, block_seed)
+            for size, block_seed in zip(block_sizes, seeds)]
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if n_process == 1:
+        blocks = list(map(_bootstrap_block, jobs))
+    else:
+        with multiprocessing.Pool(processes=n_process) as pool:
+            blocks = pool.map(_bootstrap_block, jobs, chunksize=1)
+    return {metric: np.concatenate([block[metric] for block in blocks])
+            for metric in BOOTSTRAP_METRICS}
+
+
+def get_confidence_intervals(samples, confidence=0.95):
+    """Get the percentile confidence intervals of bootstrap samples.
+
+    Returns
+    -------
+    dict
+        {metric: (lower, upper)}. Resamples where a metric is undefined are ignored.
+    """
+    alpha = (1 - confidence) / 2 * 100
+    return {metric: tuple(np.nanpercentile(values, [alpha, 100 - alpha]))
+            for metric, values in samples.items()}
@@ -0,0 +1,102 @@
+"""Evaluation of the prediction CSVs of several runs, i.e. one per cross-validation split or seed, in a single call.
+
+Each run is evaluated by SlideLevelAccuracy in its own process, and the metrics of the runs are consolidated into one table, with their mean and standard deviation in a separate summary table.
+"""
+import enum
+import multiprocessing
+
+import pandas as pd
+
+from submodule_utils.accuracy.slide_level_accuracy import SlideLevelAccuracy
+from submodule_utils.accuracy.bootstrap import BOOTSTRAP_METRICS
+
+
+def evaluate_run(csv_file, patch_pattern, subtypes, threshold=None, starting_line=1):
+    """Get the slide level metrics of a run.
+
+    Parameters
+    ----------
+    csv_file : str or list of str
+        Prediction CSV of the run, or the CSVs of the shards of the run.
+
+    patch_pattern : dict
+        Dictionary describing the directory structure of the patch paths.
+
+    subtypes : dict
+        {name: value} of the subtypes, as the dynamic subtype enum cannot be passed to processes.
+
+    Returns
+    -------
+    dict
+        {metric: value} of the number of slides, BOOTSTRAP_METRICS, the AUC of the mean probabilities of the slides and the accuracy of each subtype.
+    """
+    SubtypeEnum = enum.Enum('SubtypeEnum', subtypes)
+    accuracy = SlideLevelAccuracy(csv_file, patch_pattern, SubtypeEnum, threshold=threshold)
+    accumulator = accuracy.get_accumulator(starting_line)
+    _, acc_per_subtype, weighted_acc, kappa, f1, auc = accuracy.get_level_metrics(
+            accumulator.votes, accumulator.real_labels)
+    metrics = {'slides': len(accumulator.slide_ids), 'weighted_acc': weighted_acc,
+               'kappa': kappa, 'f1_score': f1, 'auc': auc,
+               'average_acc': acc_per_subtype.mean(),
+               'mean_prob_auc': accuracy.get_auc(accumulator.real_labels,
+                                                 accumulator.get_mean_probabilities())}
+    for subtype, acc in zip(accuracy.subtypes_list, acc_per_subtype):
+        metrics[subtype] = acc
+    return metrics
+
+
+def _evaluate_run(args):
+    return evaluate_run(*args)
+
+
+def evaluate_runs(csv_files, patch_pattern, subtypes_list, threshold=None, starting_line=1,
+                  n_process=None, names=None):
+    """Evaluate the prediction CSVs of several runs concurrently on a process pool.
+
+    Parameters
+    ----------
+    csv_files : list of str or list of list of str
+        Prediction CSV of each run, or the CSVs of the shards of each run.
+
+    subtypes_list : enum.Enum
+        The enum representing the subtypes.
+
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    names : list of str
+        Name of each run. Defaults to the CSV paths.
+
+    Returns
+    -------
+    tuple
+        A tuple of
+         - runs (pd.DataFrame) row per run with a column per metric of evaluate_run
+         - summary (pd.DataFrame) mean and std rows of the metrics over the runs
+    """
+    subtypes = {c.name: c.value for c in subtypes_list}
+    jobs = [(csv_file, patch_pattern, subtypes, threshold, starting_line)
+            for csv_file in csv_files]
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if n_process == 1:
+        runs = list(map(_evaluate_run, jobs))
+    else:
+        with multiprocessing.Pool(processes=n_process) as pool:
+            runs = pool.map(_evaluate_run, jobs, chunksize=1)
+    names = names or [csv_file if isinstance(csv_file, str) else ','.join(csv_file)
+                      for csv_file in csv_files]
+    runs = pd.DataFrame(runs, index=names)
+    summary = pd.DataFrame([runs.mean(), runs.std()], index=['mean', 'std'])
+    print_runs(runs, summary, SlideLevelAccuracy(None, patch_pattern, subtypes_list,
+                                                 threshold=threshold))
+    return runs, summary
+
+
+def print_runs(runs, summary, accuracy):
+    """Print the metrics of each run with print_all followed by their mean ± std.
+    """
+    output = '||Metric||Mean ± Std||\n'
+    for metric in BOOTSTRAP_METRICS:
+        accuracy.print_all(runs[metric].tolist(), metric)
+        output += f"|{metric}|{summary.loc['mean', metric]:.4f} ± {summary.loc['std', metric]:.4f}|\n"
+    print(output)
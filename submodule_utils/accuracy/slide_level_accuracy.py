@@ -1,64 +1,484 @@
-
 import sys, csv, glob, argparse, enum, json, os
+import multiprocessing
 import numpy as np
+import pandas as pd
+from submodule_utils import get_patient_by_slide_id, DEAFULT_SEED
+from submodule_utils.predictions import (
+        iter_prediction_chunks, encode_slide_ids, PREDICTION_CHUNK_SIZE)
+from submodule_utils.accuracy.bootstrap import (
+        bootstrap_metrics, get_confidence_intervals, BOOTSTRAP_RESAMPLES, BOOTSTRAP_METRICS)
 from sklearn.metrics import accuracy_score, confusion_matrix, cohen_kappa_score, f1_score, roc_auc_score
 try:
     from pathlib import Path
 except ImportError:
     from pathlib2 import Path
 
+def count_votes(slide_codes, labels, n_slides, n_classes):
+    """Count the patches of each slide with each label.
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of shape (n_slides, n_classes).
+    """
+    counts = np.bincount(slide_codes * n_classes + labels, minlength=n_slides * n_classes)
+    return counts.reshape(n_slides, n_classes)
+
+
+class SlideVoteAccumulator:
+    """Per-slide vote counts and probability sums of the considered patches of prediction CSVs, accumulated chunk by chunk.
+
+    Only arrays of shape (slides, classes) are kept, so memory does not depend on the number of patches. Accumulators of different chunks, files or processes are combined with merge.
+
+    Parameters
+    ----------
+    n_classes : int
+
+    threshold : float
+        Patches are considered if their largest probability is greater than the threshold.
+    """
+    def __init__(self, n_classes, threshold):
+        self.n_classes = n_classes
+        self.threshold = threshold
+        self.slide_index = {}
+        self.votes = np.zeros((0, n_classes), dtype=np.int64)
+        self.prob_sums = np.zeros((0, n_classes), dtype=np.float64)
+        self.real_labels = np.zeros(0, dtype=np.int64)
+
+    @property
+    def slide_ids(self):
+        return list(self.slide_index)
+
+    def grow(self):
+        """Add rows for the slides added to slide_index.
+        """
+        pad = lambda array, **kwargs: np.pad(
+                array, [(0, len(self.slide_index) - len(array))] + [(0, 0)] * (array.ndim - 1),
+                **kwargs)
+        self.votes = pad(self.votes)
+        self.prob_sums = pad(self.prob_sums)
+        self.real_labels = pad(self.real_labels, constant_values=-1)
+
+    def set_real_labels(self, codes, real_labels):
+        """Set the real label of the slides that do not have one yet from the first of their codes.
+        """
+        unique_codes, first = np.unique(codes, return_index=True)
+        unseen = self.real_labels[unique_codes] == -1
+        self.real_labels[unique_codes[unseen]] = real_labels[first[unseen]]
+
+    def update(self, chunk):
+        """Add the considered patches of a PredictionChunk.
+        """
+        considered = chunk.probabilities.max(axis=1) > self.threshold
+        probabilities = chunk.probabilities[:, :self.n_classes]
+        codes = encode_slide_ids(chunk.slide_ids[considered], self.slide_index)
+        self.grow()
+        self.votes += count_votes(codes, chunk.predicted_labels[considered],
+                                  len(self.slide_index), self.n_classes)
+        np.add.at(self.prob_sums, codes, probabilities[considered])
+        self.set_real_labels(codes, chunk.real_labels[considered])
+        return self
+
+    def update_csv(self, csv_file, patch_pattern, starting_line=1,
+                   chunk_size=PREDICTION_CHUNK_SIZE):
+        """Add the considered patches of a prediction CSV read chunk by chunk.
+
+        Parameters
+        ----------
+        csv_file : str or iterable of list
+            Path to the prediction CSV, or an iterable of already split lines such as a csv.reader.
+        """
+        for chunk in iter_prediction_chunks(csv_file, patch_pattern, chunk_size=chunk_size,
+                                            starting_line=starting_line):
+            self.update(chunk)
+        return self
+
+    def merge(self, other):
+        """Add the votes and probability sums of another accumulator, i.e. of another CSV or process.
+
+        Raises
+        ------
+        ValueError
+            If the accumulators do not have the same threshold.
+        """
+        if not np.array_equal(self.threshold, other.threshold):
+            raise ValueError("Cannot merge accumulators of different thresholds")
+        codes = encode_slide_ids(np.array(other.slide_ids, dtype=object), self.slide_index)
+        self.grow()
+        self.votes[codes] += other.votes
+        self.prob_sums[codes] += other.prob_sums
+        self.set_real_labels(codes, other.real_labels)
+        return self
+
+    def group_by(self, key_by_id):
+        """Sum the votes and probability sums of the slides with the same key, i.e. of the slides of each patient.
+
+        Parameters
+        ----------
+        key_by_id : dict
+            {slide_id: key} of every slide of the accumulator.
+
+        Returns
+        -------
+        SlideVoteAccumulator
+            Accumulator with a row per key in order of appearance. The real label of a key is the one of its first slide.
+        """
+        grouped = type(self)(self.n_classes, self.threshold)
+        keys = np.array([key_by_id[slide_id] for slide_id in self.slide_ids], dtype=object)
+        codes = encode_slide_ids(keys, grouped.slide_index)
+        grouped.grow()
+        np.add.at(grouped.votes, codes, self.votes)
+        np.add.at(grouped.prob_sums, codes, self.prob_sums)
+        grouped.set_real_labels(codes, self.real_labels)
+        return grouped
+
+    def get_mean_probabilities(self):
+        """Get the mean probabilities of the considered patches of each slide.
+        """
+        return self.prob_sums / self.votes.sum(axis=1, keepdims=True)
+
+
+class ThresholdSweepAccumulator(SlideVoteAccumulator):
+    """Per-slide vote counts and probability sums for several thresholds at once.
+
+    Each patch is counted once in the bin of the number of thresholds its largest probability is greater than, so votes and prob_sums have shape (slides, thresholds + 1, classes). The votes at a threshold are the sums of the bins above it, given by get_accumulator. Real labels are of the first patch of each slide.
+
+    Parameters
+    ----------
+    n_classes : int
+
+    thresholds : iterable of float
+        Thresholds in any order, kept sorted.
+    """
+    def __init__(self, n_classes, thresholds):
+        super().__init__(n_classes, np.sort(np.asarray(thresholds, dtype=np.float64)))
+        n_bins = len(self.threshold) + 1
+        self.votes = np.zeros((0, n_bins, n_classes), dtype=np.int64)
+        self.prob_sums = np.zeros((0, n_bins, n_classes), dtype=np.float64)
+
+    def update(self, chunk):
+        """Add the patches of a PredictionChunk.
+        """
+        max_probabilities = chunk.probabilities.max(axis=1)
+        # number of thresholds the largest probability is greater than, compared in the probability dtype as max > threshold
+        bins = np.searchsorted(self.threshold.astype(max_probabilities.dtype), max_probabilities,
+                               side='left')
+        codes = encode_slide_ids(chunk.slide_ids, self.slide_index)
+        self.grow()
+        n_bins = len(self.threshold) + 1
+        counts = np.bincount((codes * n_bins + bins) * self.n_classes + chunk.predicted_labels,
+                             minlength=self.votes.size)
+        self.votes += counts.reshape(self.votes.shape)
+        np.add.at(self.prob_sums, (codes, bins), chunk.probabilities[:, :self.n_classes])
+        self.set_real_labels(codes, chunk.real_labels)
+        return self
+
+    def get_accumulator(self, idx):
+        """Get the votes at the threshold at position idx of the sorted thresholds.
+
+        Returns
+        -------
+        SlideVoteAccumulator
+            Accumulator of the slides with at least one considered patch.
+        """
+        votes = self.votes[:, idx + 1:].sum(axis=1)
+        considered = votes.sum(axis=1) > 0
+        accumulator = SlideVoteAccumulator(self.n_classes, float(self.threshold[idx]))
+        accumulator.slide_index = {slide_id: code for code, slide_id in
+                                   enumerate(np.array(self.slide_ids, dtype=object)[considered])}
+        accumulator.votes = votes[considered]
+        accumulator.prob_sums = self.prob_sums[:, idx + 1:].sum(axis=1)[considered]
+        accumulator.real_labels = self.real_labels[considered]
+        return accumulator
+
+
+def accumulate_csv_file(csv_file, patch_pattern, n_classes, threshold, starting_line=1,
+                        accumulator_class=SlideVoteAccumulator):
+    return accumulator_class(n_classes, threshold).update_csv(
+            csv_file, patch_pattern, starting_line=starting_line)
+
+
+def _accumulate_csv_file(args):
+    return accumulate_csv_file(*args)
+
+
+def accumulate_csv_files(csv_files, patch_pattern, n_classes, threshold, starting_line=1,
+                         n_process=None, accumulator_class=SlideVoteAccumulator):
+    """Accumulate the votes of prediction CSVs split across files, i.e. by parallel inference shards. Files are read concurrently on a process pool and the partial accumulators are merged in order.
+
+    Parameters
+    ----------
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    accumulator_class : type
+        SlideVoteAccumulator, or ThresholdSweepAccumulator with a list of thresholds as threshold.
+
+    Returns
+    -------
+    SlideVoteAccumulator
+    """
+    jobs = [(csv_file, patch_pattern, n_classes, threshold, starting_line, accumulator_class)
+            for csv_file in csv_files]
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if n_process == 1:
+        accumulators = map(_accumulate_csv_file, jobs)
+    else:
+        with multiprocessing.Pool(processes=n_process) as pool:
+            accumulators = pool.map(_accumulate_csv_file, jobs, chunksize=1)
+    accumulator = accumulator_class(n_classes, threshold)
+    for partial in accumulators:
+        accumulator.merge(partial)
+    return accumulator
+
+
 class SlideLevelAccuracy:
-    def __init__(self, csv_file, patch_pattern, subtypes_list, threshold=None, verbose=False):
+    def __init__(self, csv_file, patch_pattern, subtypes_list, threshold=None, verbose=False,
+                 dataset_origin=None, manifest=None, n_process=1):
+        """
+        Parameters
+        ----------
+        csv_file : str or iterable of list or list of str
+            Path to the prediction CSV or to a prediction store converted from it, an iterable of already split lines such as a csv.reader, or a list of paths to prediction CSVs read one after another.
+
+        dataset_origin : list of str
+            Dataset origins of the patient regexes used to get the patient of each slide for patient level results.
+
+        manifest : dict
+            Manifest read by read_manifest with the slide_id, patient_id and origin columns, used instead of dataset_origin to get the patient of each slide.
+
+        n_process : int
+            Number of processes to accumulate the votes of a list of CSVs on. None for the number of CPUs.
+        """
         self.csv_file = csv_file
+        self.dataset_origin = dataset_origin
+        self.manifest = manifest
         self.patch_pattern = '/'.join(k for k in patch_pattern.keys())
         self.subtypes_list = [k.name+"="+str(k.value) for k in subtypes_list]
         self.threshold = self.get_threshold_value(self.subtypes_list, threshold)
         self.verbose = verbose
+        self.n_process = n_process
+
+    def calculate_slide_level_accuracy(self, starting_line=1, accumulator=None):
+        """Print the slide level results, and the patient level results if dataset_origin or manifest is set.
 
-    def calculate_slide_level_accuracy(self, starting_line=1):
+        Parameters
+        ----------
+        accumulator : SlideVoteAccumulator
+            Votes accumulated beforehand, i.e. merged from several processes. Defaults to the votes of csv_file.
+        """
         print(f"Slide Level Results:\n{40 * '*'}")
         print(f'All probabilities must be greater than {self.threshold} in order to be considered.\n')
 
-        slide_pred_votes_dict = dict()
-        slide_real_labels_dict = dict()
-        for idx, line in enumerate(self.csv_file):
-            if idx < starting_line:
-                continue
-            file_name, predicted_label, real_label, probability,_ = line
-            slide_id = self.get_slide_id_from_full_file_name(file_name, self.patch_pattern)
-            probability_list = self.get_list_from_probability_string(probability)
-            if max(probability_list) > self.threshold:
-                if slide_id in slide_pred_votes_dict:
-                    slide_pred_votes_dict[slide_id][int(predicted_label)] += 1
-                else:
-                    slide_real_labels_dict[slide_id] = int(real_label)
-                    slide_pred_votes_dict[slide_id] = [0] * len(self.subtypes_list)
-                    slide_pred_votes_dict[slide_id][int(predicted_label)] += 1
+        if accumulator is None:
+            accumulator = self.get_accumulator(starting_line)
+        self.print_level_results(accumulator)
+        if self.dataset_origin is not None or self.manifest is not None:
+            print(f"Patient Level Results:\n{40 * '*'}")
+            self.print_level_results(self.get_patient_accumulator(accumulator))
+
+    def print_level_results(self, accumulator):
+        """Print the results of the slides, or patients, of an accumulator.
+        """
         if self.verbose:
-            self.print_slide_level_prediction(slide_pred_votes_dict, slide_real_labels_dict, self.subtypes_list)
-
-        slide_votes_array = self.get_np_array_from_dict_values(slide_pred_votes_dict)
-        slide_probs_array = self.get_probs_from_votes(slide_votes_array)
-        slide_pred_labels_dict = self.get_dict_of_predicted_labels(slide_pred_votes_dict)
-        slide_real_labels = self.get_np_array_from_dict_values(slide_real_labels_dict)
-        slide_pred_labels = self.get_np_array_from_dict_values(slide_pred_labels_dict)
-        conf_matrix = confusion_matrix(slide_real_labels, slide_pred_labels).T
+            self.print_slide_level_prediction(dict(zip(accumulator.slide_ids, accumulator.votes.tolist())),
+                                              dict(zip(accumulator.slide_ids, accumulator.real_labels.tolist())),
+                                              self.subtypes_list)
+        conf_matrix, acc_per_subtype, weighted_acc, kappa, f1, auc = self.get_level_metrics(
+                accumulator.votes, accumulator.real_labels)
+        mean_prob_auc = self.get_auc(accumulator.real_labels, accumulator.get_mean_probabilities())
+        self.print_confusion_matrix(conf_matrix, self.subtypes_list)
+        self.print_results_summary(self.subtypes_list, acc_per_subtype, weighted_acc, kappa, f1, auc,
+                                   mean_prob_auc=mean_prob_auc)
+
+    def get_level_metrics(self, votes, real_labels):
+        """Get the metrics of slides, or patients, from their votes.
+
+        Returns
+        -------
+        tuple
+            A tuple of the transposed confusion matrix, accuracy per subtype, weighted accuracy, kappa, F1 score and AUC.
+        """
+        slide_probs_array = self.get_probs_from_votes(votes)
+        # first class with the most votes, as list.index(max(votes))
+        slide_pred_labels = votes.argmax(axis=1)
+        conf_matrix = confusion_matrix(real_labels, slide_pred_labels,
+                                       labels=range(len(self.subtypes_list))).T
         acc_per_subtype = self.get_acc_per_subtype(conf_matrix)
-        average_acc = acc_per_subtype.mean()
-        weighted_acc = self.get_slide_level_accuracy(slide_real_labels, slide_pred_labels)
-        overall_slide_kappa = cohen_kappa_score(slide_real_labels, slide_pred_labels)
-        overall_slide_f1 = f1_score(slide_real_labels, slide_pred_labels, average='macro')
+        weighted_acc = self.get_slide_level_accuracy(real_labels, slide_pred_labels)
+        overall_slide_kappa = cohen_kappa_score(real_labels, slide_pred_labels)
+        overall_slide_f1 = f1_score(real_labels, slide_pred_labels, average='macro')
+        slide_auc = self.get_auc(real_labels, slide_probs_array)
+        return conf_matrix, acc_per_subtype, weighted_acc, overall_slide_kappa, overall_slide_f1, slide_auc
+
+    def get_auc(self, real_labels, probabilities):
+        """Get the macro one-vs-rest AUC of slides, or patients, from their probabilities, i.e. the vote fractions of get_probs_from_votes or the mean probabilities of SlideVoteAccumulator.get_mean_probabilities.
+
+        Returns
+        -------
+        float
+            The AUC, 0 if it is undefined.
+        """
         slide_auc=0
         try:
             if len(self.subtypes_list) == 2:
-                slide_auc = roc_auc_score(slide_real_labels, slide_probs_array[:, 1], average='macro')
+                slide_auc = roc_auc_score(real_labels, probabilities[:, 1], average='macro')
             else:
-                slide_auc = roc_auc_score(slide_real_labels, slide_probs_array, multi_class='ovr', average='macro')
+                slide_auc = roc_auc_score(real_labels, probabilities, multi_class='ovr', average='macro')
         except:
             pass
-        self.print_confusion_matrix(conf_matrix, self.subtypes_list)
-        self.print_results_summary(self.subtypes_list, acc_per_subtype, weighted_acc, overall_slide_kappa, overall_slide_f1,
-                              slide_auc)
+        return slide_auc
+
+    def get_slide_to_patient(self, slide_ids):
+        """Get the patient of each slide from the manifest if set, otherwise from the patient regex of the dataset origins.
+
+        Returns
+        -------
+        dict
+            {slide_id: patient_id}. Patient IDs from the manifest are prefixed by their origin, i.e. ovcare__VOA-1011, so patients of different cohorts do not mix.
+        """
+        if self.manifest is not None:
+            manifest_patients = {slide_id: f"{origin.lower()}__{patient_id}"
+                                 for slide_id, patient_id, origin in zip(self.manifest['slide_id'],
+                                                                         self.manifest['patient_id'],
+                                                                         self.manifest['origin'])}
+            return {slide_id: manifest_patients[slide_id] for slide_id in slide_ids}
+        return {slide_id: get_patient_by_slide_id(slide_id, dataset_origin=self.dataset_origin)
+                for slide_id in slide_ids}
+
+    def get_patient_accumulator(self, accumulator):
+        """Group the votes and probability sums of the slides of an accumulator by patient.
+
+        Returns
+        -------
+        SlideVoteAccumulator
+            Accumulator of the patients.
+        """
+        return accumulator.group_by(self.get_slide_to_patient(accumulator.slide_ids))
+
+    def get_slide_votes(self, starting_line=1):
+        """Count the votes of each slide over the patches with a probability greater than the threshold.
+
+        Returns
+        -------
+        tuple
+            A tuple of
+             - slide_ids (list of str) slides in order of appearance
+             - votes (np.ndarray) int64 array of shape (slides, classes) of the number of patches of each slide predicted as each class
+             - real_labels (np.ndarray) int64 array of the label of the first considered patch of each slide
+        """
+        accumulator = self.get_accumulator(starting_line)
+        return accumulator.slide_ids, accumulator.votes, accumulator.real_labels
+
+    def get_accumulator(self, starting_line=1, thresholds=None):
+        """Accumulate the votes of the prediction CSV, or of each CSV in turn if csv_file is a list of paths.
+
+        Parameters
+        ----------
+        thresholds : iterable of float
+            Thresholds to accumulate the votes of at once instead of the threshold.
+
+        Returns
+        -------
+        SlideVoteAccumulator or ThresholdSweepAccumulator
+        """
+        n_classes = len(self.subtypes_list)
+        if thresholds is None:
+            accumulator_class, threshold = SlideVoteAccumulator, self.threshold
+        else:
+            accumulator_class, threshold = ThresholdSweepAccumulator, thresholds
+        if isinstance(self.csv_file, (list, tuple)) and all(isinstance(f, str) for f in self.csv_file):
+            return accumulate_csv_files(self.csv_file, self.patch_pattern, n_classes, threshold,
+                                        starting_line=starting_line, n_process=self.n_process,
+                                        accumulator_class=accumulator_class)
+        return accumulator_class(n_classes, threshold).update_csv(
+                self.csv_file, self.patch_pattern, starting_line=starting_line)
+
+    def sweep_thresholds(self, thresholds, starting_line=1, accumulator=None):
+        """Print and get the slide level results at several thresholds from a single pass over the predictions.
+
+        Parameters
+        ----------
+        thresholds : iterable of float
+            Thresholds to evaluate, i.e. np.arange(0.5, 1., 0.05).
+
+        accumulator : ThresholdSweepAccumulator
+            Votes accumulated beforehand. Defaults to the votes of csv_file at thresholds.
+
+        Returns
+        -------
+        pd.DataFrame
+            Row per threshold in increasing order with the threshold, number of slides with considered patches, weighted accuracy, kappa, F1 score, AUC and average accuracy.
+        """
+        if accumulator is None:
+            accumulator = self.get_accumulator(starting_line, thresholds=thresholds)
+        rows = []
+        for idx, threshold in enumerate(accumulator.threshold):
+            slides = accumulator.get_accumulator(idx)
+            if len(slides.slide_ids) == 0:
+                rows.append([threshold, 0] + [np.nan] * 5)
+                continue
+            _, acc_per_subtype, weighted_acc, kappa, f1, auc = self.get_level_metrics(
+                    slides.votes, slides.real_labels)
+            rows.append([threshold, len(slides.slide_ids), weighted_acc, kappa, f1, auc,
+                         acc_per_subtype.mean()])
+        results = pd.DataFrame(rows, columns=['threshold', 'slides', 'weighted_acc', 'kappa',
+                                              'f1_score', 'auc', 'average_acc'])
+        self.print_threshold_sweep(results)
+        return results
+
+    def bootstrap_confidence_intervals(self, n_resamples=BOOTSTRAP_RESAMPLES, confidence=0.95,
+                                       seed=DEAFULT_SEED, n_process=None, starting_line=1,
+                                       accumulator=None):
+        """Print and get the slide level metrics with bootstrap confidence intervals.
+
+        Parameters
+        ----------
+        n_resamples : int
+            Number of resamples of the slides.
+
+        confidence : float
+            Confidence level of the percentile intervals.
+
+        seed : int
+            Seed of the resamples.
+
+        n_process : int
+            Number of processes to compute the resamples on. Defaults to the number of CPUs.
+
+        accumulator : SlideVoteAccumulator
+            Votes accumulated beforehand, i.e. the patient accumulator for patient level intervals. Defaults to the votes of csv_file.
+
+        Returns
+        -------
+        pd.DataFrame
+            Row per metric with its value and the lower and upper bounds of its interval.
+        """
+        if accumulator is None:
+            accumulator = self.get_accumulator(starting_line)
+        _, acc_per_subtype, weighted_acc, kappa, f1, auc = self.get_level_metrics(
+                accumulator.votes, accumulator.real_labels)
+        values = {'weighted_acc': weighted_acc, 'kappa': kappa, 'f1_score': f1, 'auc': auc,
+                  'average_acc': acc_per_subtype.mean()}
+        samples = bootstrap_metrics(accumulator.real_labels,
+                                    self.get_probs_from_votes(accumulator.votes),
+                                    n_resamples=n_resamples, seed=seed, n_process=n_process)
+        intervals = get_confidence_intervals(samples, confidence)
+        results = pd.DataFrame([[metric, values[metric], *intervals[metric]]
+                                for metric in BOOTSTRAP_METRICS],
+                               columns=['metric', 'value', 'lower', 'upper'])
+        output = f'||Metric||Value||{confidence * 100:g}% CI Lower||{confidence * 100:g}% CI Upper||\n'
+        for row in results.itertuples():
+            output += f'|{row.metric}|{row.value:.4f}|{row.lower:.4f}|{row.upper:.4f}|\n'
+        print(output)
+        return results
+
+    def print_threshold_sweep(self, results):
+        output = '||Threshold||Slides||Weighted Slide Acc||Slide Kappa||Slide F1 Score||Slide AUC||Avg Slide Acc||\n'
+        for row in results.itertuples():
+            output += (f'|{row.threshold:.4f}|{row.slides}|{row.weighted_acc:.2f}%|{row.kappa:.4f}|'
+                       f'{row.f1_score:.4f}|{row.auc:.4f}|{row.average_acc:.2f}%|\n')
+        print(output)
 
     def ensure_directory_exists(self ,directory_path):
         if not os.path.exists(directory_path):
@@ -67,29 +487,9 @@ class SlideLevelAccuracy:
     def one_hot(self ,arr, num_classes):
         return np.squeeze(np.eye(num_classes)[arr.reshape(-1)])
 
-    def get_slide_id_from_full_file_name(self ,file_name, patch_pattern):
-        patch_pattern_parts = patch_pattern.split('/')
-        patch_pattern_slide_id_relative_index = patch_pattern_parts.index('slide') - len(patch_pattern_parts) - 1
-        file_name_parts = file_name.split('/')
-        return file_name_parts[patch_pattern_slide_id_relative_index]
-
-    def get_list_from_probability_string(self ,orig_string):
-        '''probability has form "[0.333 0.666]", for example. It is type str.'''
-        new_list = []
-        for num in orig_string[1:-2].split(' '):
-            try:
-                new_list.append(float(num))
-            except:
-                pass
-        return new_list
-
     def get_probs_from_votes(self ,pred_votes_array):
-        prob_array = []
-        for votes_list in pred_votes_array:
-            sum_votes = sum(votes_list)
-            prob_list = (votes_list / sum_votes)
-            prob_array += [prob_list]
-        return np.asarray(prob_array)
+        pred_votes_array = np.asarray(pred_votes_array)
+        return pred_votes_array / pred_votes_array.sum(axis=1, keepdims=True)
 
     def print_slide_level_prediction(self ,pred_votes_dict, real_labels_dict, subtypes_list):
         output = '||Slide ID||'
@@ -117,12 +517,6 @@ class SlideLevelAccuracy:
         sum_votes = sum(vote_list)
         return float(max_vote / sum_votes) * 100
 
-    def get_dict_of_predicted_labels(self ,pred_votes_dict):
-        pred_labels_dict = dict()
-        for slide_id in pred_votes_dict:
-            pred_labels_dict[slide_id] = pred_votes_dict[slide_id].index(max(pred_votes_dict[slide_id]))
-        return pred_labels_dict
-
     def get_np_array_from_dict_values(self ,dictionary):
         return np.asarray(list(dictionary.values()))
 
@@ -143,18 +537,26 @@ class SlideLevelAccuracy:
         return accuracy_score(real_labels_array, pred_labels_array) * 100
 
     def get_acc_per_subtype(self ,conf_matrix):
-        acc_per_subtype = conf_matrix.diagonal() / conf_matrix.sum(axis=0) * 100
-        acc_per_subtype[np.isinf(acc_per_subtype)] = 0.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            acc_per_subtype = conf_matrix.diagonal() / conf_matrix.sum(axis=0) * 100
+        acc_per_subtype[~np.isfinite(acc_per_subtype)] = 0.0
         return acc_per_subtype
 
-    def print_results_summary(self ,subtypes_list, acc_per_subtype, weighted_acc, kappa, f1_score, auc):
+    def print_results_summary(self ,subtypes_list, acc_per_subtype, weighted_acc, kappa, f1_score, auc,
+                              mean_prob_auc=None):
         output = '||Dataset||'
         for subtype in subtypes_list:
             output += f'{subtype}||'
-        output += f'Weighted Slide Acc||Slide Kappa||Slide F1 Score||Slide AUC||Avg Slide Acc||\n|X|'
+        output += f'Weighted Slide Acc||Slide Kappa||Slide F1 Score||Slide AUC||'
+        if mean_prob_auc is not None:
+            output += 'Mean Prob AUC||'
+        output += 'Avg Slide Acc||\n|X|'
         for idx, subtype in enumerate(subtypes_list):
             output += f'{acc_per_subtype[idx]:.2f}%|'
-        output += f'{weighted_acc:.2f}%|{kappa:.4f}|{f1_score:.4f}|{auc:.4f}|{acc_per_subtype.mean():.2f}%|\n'
+        output += f'{weighted_acc:.2f}%|{kappa:.4f}|{f1_score:.4f}|{auc:.4f}|'
+        if mean_prob_auc is not None:
+            output += f'{mean_prob_auc:.4f}|'
+        output += f'{acc_per_subtype.mean():.2f}%|\n'
         print(output)
 
     def print_all(self ,metric_list, metric_name):
@@ -171,7 +573,7 @@ class SlideLevelAccuracy:
         print(output)
 
     def get_threshold_value(self, subtypes_list, threshold):
-        if threshold is None or threshold is 0:
+        if threshold is None or threshold == 0:
             return float(1 / len(subtypes_list))
         else:
             return threshold
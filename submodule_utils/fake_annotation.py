@@ -1,10 +1,11 @@
 import os
-import cv2
-import numpy as np
 from PIL import Image
 import submodule_utils as utils
 from shapely.geometry import Polygon
 from submodule_utils.metadata.annotation import GroovyAnnotation
+from submodule_utils.thumbnail import (
+        ANNOTATION_COLORS, DEFAULT_ANNOTATION_COLOR, draw_polygons, read_thumbnail,
+        get_thumbnail_size)
 
 
 class FakeAnnotation(object):
@@ -21,7 +22,8 @@ class FakeAnnotation(object):
     therefore using x and y in PIL format while using cv2 library is fine and correct!
     """
 
-    def __init__(self, slide_name, os_slide, annotation_file_path, magnification, patch_size, skip_area):
+    def __init__(self, slide_name, os_slide, annotation_file_path, magnification, patch_size, skip_area,
+                 slide_path=None, thumbnail_cache=None, max_dimension=None):
         """
         Parameters
         ----------
@@ -31,6 +33,14 @@ class FakeAnnotation(object):
 
         annotation : dict
 
+        slide_path : str
+            Path of the slide, used to look up the thumbnail in thumbnail_cache.
+
+        thumbnail_cache : ThumbnailCache or None
+            Cache to read the decoded thumbnail from instead of the slide.
+
+        max_dimension : int or None
+            Maximum width and height of the thumbnail. By default the size of the lowest resolution level is used.
         """
         self.patch_size = patch_size
         self.os_slide = os_slide
@@ -42,6 +52,9 @@ class FakeAnnotation(object):
         self.annotation_file = os.path.join(self.store_path, f'{self.slide_name}.txt')
         self.multi_poly = None
         self.skip_area = skip_area
+        self.slide_path = slide_path
+        self.thumbnail_cache = thumbnail_cache
+        self.max_dimension = max_dimension
 
     def add_poly(self, x, y):
         coords = [(x, y), (x+self.patch_size, y),
@@ -54,39 +67,24 @@ class FakeAnnotation(object):
             self.multi_poly = self.multi_poly.union(poly)
 
     def thumbnail_(self):
-        # Get maximum downsample and minimum dimension
-        self.down_sample = self.os_slide.level_downsamples[-1]
-        self.dimensions  = self.os_slide.level_dimensions[-1]
+        self.dimensions, self.down_sample = get_thumbnail_size(self.os_slide,
+                                                               self.max_dimension)
 
         self.annotation = GroovyAnnotation(self.annotation_file, 0, 0, False, None)
 
         def get_thumbnail():
-            thumbnail = self.os_slide.get_thumbnail(self.dimensions)
-            self.thumbnail = cv2.cvtColor(np.array(thumbnail), cv2.COLOR_RGB2BGR)
+            self.thumbnail = read_thumbnail(self.os_slide, self.dimensions,
+                                            slide_path=self.slide_path,
+                                            thumbnail_cache=self.thumbnail_cache)
 
         def save_thumbnail():
-            self.thumbnail = Image.fromarray(cv2.cvtColor(self.thumbnail, cv2.COLOR_BGR2RGB))
+            self.thumbnail = Image.fromarray(self.thumbnail)
             self.thumbnail.save(f'{os.path.join(self.store_thubmnail_path, self.slide_name)}.png')
 
         def draw_annotation():
-            overlay = self.thumbnail.copy()
-            poly = self.annotation.polygons
-            alpha = 0.2 # that's the transparency factor
-            for label, polygons in poly.items():
-                if label=='Tumor': color=(0, 0, 255) # Red # color=(0, 255, 255) # Yellow
-                elif label=='Stroma' or label=='Necrosis': color=(0, 255, 0) # Green # color=(255, 255, 0) # Cyan / Aqua
-                else: color=(192,192,192) # Silver
-                for polygon in polygons:
-                    int_coords = lambda x: (np.array(x)/self.down_sample).round().astype(np.int32)
-                    # draw a line
-                    exterior = int_coords(polygon.exterior.coords)
-                    xs, ys = exterior[:,0], exterior[:,1]
-                    draw_points = (np.asarray([xs, ys]).T).astype(np.int32)
-                    cv2.polylines(self.thumbnail, [draw_points], False, color, 2)
-                    # draw a polygon
-                    # exterior = [int_coords(polygon.exterior.coords)]
-                    # cv2.fillPoly(overlay, exterior, color=color)
-            # cv2.addWeighted(overlay, alpha, self.thumbnail, 1 - alpha, 0, self.thumbnail)
+            for label, polygons in self.annotation.polygons.items():
+                color = ANNOTATION_COLORS.get(label, DEFAULT_ANNOTATION_COLOR)
+                draw_polygons(self.thumbnail, polygons, self.down_sample, color)
 
         get_thumbnail()
         draw_annotation()
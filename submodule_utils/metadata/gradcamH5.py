@@ -9,17 +9,32 @@ from openslide import OpenSlide
 from tqdm import tqdm
 from pytorch_grad_cam.grad_cam import GradCAM
 from pytorch_grad_cam.utils.image import show_cam_on_image
+from submodule_utils.metadata.gradcam_store import (
+        create_gradcam_datasets, write_gradcam_h5, get_gradcam_tile_size, GradCAMWriter,
+        AsyncWriter, GRADCAM_MAP_SIZE, DEFAULT_GRADCAM_COMPRESSION,
+        DEFAULT_GRADCAM_BUFFER_BYTES, DEFAULT_WRITER_THREADS)
+
+
+def write_gradcam_overlay(patch_path, cam, patch_size, output_path):
+    """Save the activation map of a patch overlayed on the patch image.
+    """
+    rgb_img = cv2.imread(patch_path, 1)[:, :, ::-1]
+    rgb_img = cv2.resize(rgb_img, (patch_size, patch_size))
+    rgb_img = np.float32(rgb_img) / 255
+    cam_image = show_cam_on_image(rgb_img, cam)
+    if not cv2.imwrite(output_path, cam_image):
+        raise IOError(f"could not write {output_path}")
 
 class GradCAM_AIM():
 
     """Creating the gradcam activation map as a hd5 file.
 
-    The generated hd5 file has the below structure:
+    The generated hd5 file has the below structure (see submodule_utils.metadata.gradcam_store):
 
     ```
-    Dataset hierarchy: {patch_size}/{magnification}/grad_cam, image_coordinates, slide_diminsions
-    Dataset data: {patch_size}/{magnification}/grad_cam is a tile_x in tile_y array that contains a 32X32 activation map for each patch
-    Dataset data: {patch_size}/{magnification}/image_coordinates is a string that contains the tiles of the patches that we have generated acitvation map for. 
+    Dataset hierarchy: {patch_size}/{magnification}/maps, tiles, slide_diminsions
+    Dataset data: {patch_size}/{magnification}/maps is a (n, 32, 32) array that contains a 32X32 activation map for each patch
+    Dataset data: {patch_size}/{magnification}/tiles is a (n, 2) int array of the (row, column) tile of each activation map
     Dataset data: {patch_size}/{magnification}/slide_diminsions contains (width, height) of the slide
     ```
 
@@ -32,18 +47,8 @@ class GradCAM_AIM():
 
 
     def create_hdf_datasets(self, hdf, os_slide, patch_size, magnification):
-        tile_width, tile_height, width, height = self.get_tile_dimensions(os_slide, patch_size * int(40 // magnification))
-        group_name = "{}/{}".format(patch_size, magnification)
-        group = hdf.require_group(group_name)
-        datasets = {}
-        datasets["grad_cam"] = group.create_dataset("grad_cam",
-                                                    (tile_height, tile_width, 32, 32),
-                                                     compression="gzip", compression_opts=9, dtype='f')
-        datasets["image_coordinates"] = group.create_dataset("image_coordinates", (1, ), dtype=h5py.special_dtype(vlen=str))
-        datasets["slide_diminsions"] = group.create_dataset("slide_diminsions", (2, ), dtype='f')
-        datasets["slide_diminsions"][0] = width
-        datasets["slide_diminsions"][1] = height
-        return datasets
+        return create_gradcam_datasets(hdf, patch_size, magnification, os_slide.dimensions,
+                                       self.compression, self.compression_opts)
 
     def get_gradcam(self, patch_paths, cur_datas, gt_label):
 
@@ -55,39 +60,68 @@ class GradCAM_AIM():
             slide_id = get_slide_by_patch_id(patch_id, self.patch_pattern)
             
 
-            # save overlayed gradcam and patch images
+            # save overlayed gradcam and patch images on the writer threads
             if not self.generate_gradcam_h5:
 
-                os.makedirs(f"{self.gradcam_location}/{slide_id}", exist_ok=True)
+                if slide_id not in self.gradcam_dirs:
+                    os.makedirs(f"{self.gradcam_location}/{slide_id}", exist_ok=True)
+                    self.gradcam_dirs.add(slide_id)
 
-                rgb_img = cv2.imread(patch_path, 1)[:, :, ::-1]
-                rgb_img = cv2.resize(rgb_img, (patch_size, patch_size))
-                rgb_img = np.float32(rgb_img) / 255
                 file_name = patch_id.split("/")[-1] + ".png"
-                
-                cam_image = show_cam_on_image(rgb_img, cam) 
-                cv2.imwrite(f"{self.gradcam_location}/{slide_id}/{file_name}", cam_image)
+                self.image_writer.submit(patch_path, cam, patch_size,
+                                         f"{self.gradcam_location}/{slide_id}/{file_name}")
 
             # save the overlay gradcam activation map as a hd5 file
             else :
-                cam = cv2.resize(cam, (32, 32)) # downsample activation map
+                cam = cv2.resize(cam, (GRADCAM_MAP_SIZE, GRADCAM_MAP_SIZE)) # downsample activation map
                 magnification = get_magnification_by_patch_id(patch_id, self.patch_pattern)
-                tile_y, tile_x = get_patch_tile_by_patch_id(patch_id, patch_size * int(40 // magnification))
-
-                # for each patch store the activation map in the dataset
-                if slide_id in self.dict_gradcams: 
-                    self.dict_gradcams[slide_id]['meta']['image_coordinates'] += f"{tile_x}_{tile_y}-"
-                    
-                else:
-                    self.dict_gradcams[slide_id] = {'meta': {'patch_size': patch_size,'magnification': magnification,
-                                                    'image_coordinates': f"{tile_x}_{tile_y}-"}, 'data': []}
-                self.dict_gradcams[slide_id]['data'].append([tile_x, tile_y, cam])
-        
+                tile_col, tile_row = get_patch_tile_by_patch_id(patch_id,
+                        get_gradcam_tile_size(patch_size, magnification))
+
+                # for each patch store the activation map and its tile
+                if self.streaming:
+                    self.gradcam_writer.append(slide_id, patch_size, magnification,
+                                               (tile_row, tile_col), cam)
+                    continue
+                if slide_id not in self.dict_gradcams:
+                    self.dict_gradcams[slide_id] = {'meta': {'patch_size': patch_size,'magnification': magnification},
+                                                    'tiles': [], 'maps': []}
+                self.dict_gradcams[slide_id]['tiles'].append((tile_row, tile_col))
+                self.dict_gradcams[slide_id]['maps'].append(cam)
+
+
+    def get_slide_dimensions(self, slide_id):
+        try:
+            slide_path = glob.glob(f"{os.path.join(self.slides_path, slide_id)}.*")[0]
+            os_slide = OpenSlide(slide_path)
+        except:
+            print(f"could not find/open {slide_id} at {self.slides_path}")
+            return None
+        dimensions = os_slide.dimensions
+        os_slide.close()
+        return dimensions
+
+    def finish_slide(self, slide_id):
+        """In streaming mode, write the remaining activation maps of a slide that has no more patches.
+        """
+        if self.streaming:
+            self.gradcam_writer.finish_slide(slide_id)
+
+    def drain(self):
+        """Wait for the overlayed gradcam images that are still being written and stop the writer threads. Call once all patches have been passed to get_gradcam.
+        """
+        if not self.generate_gradcam_h5:
+            n_done, n_failed = self.image_writer.close()
+            print(f"wrote {n_done} gradcam images, {n_failed} failed.")
 
     def save_gradcam_h5(self):
 
         out_path = f"{self.gradcam_location}/grad_cam_h5_files"
 
+        if self.streaming:
+            self.gradcam_writer.close()
+            return
+
         print ("Creating h5 activation maps ...")
         for slide_id in tqdm(self.dict_gradcams.keys()):
 
@@ -98,22 +132,42 @@ class GradCAM_AIM():
                 print(f"could not find/open {slide_id} at {self.slides_path}")
                 continue
 
-            hdf = h5py.File(f"{out_path}/{slide_id}.h5", 'w')
-
-            datasets = self.create_hdf_datasets(hdf, os_slide, self.dict_gradcams[slide_id]['meta']['patch_size'],
-                                         self.dict_gradcams[slide_id]['meta']['magnification'])
-
-            
-            for tile_x, tile_y, grad_cam in self.dict_gradcams[slide_id]['data']:
-                datasets["grad_cam"][tile_x, tile_y] = grad_cam
-            datasets["image_coordinates"][0] = self.dict_gradcams[slide_id]['meta']['image_coordinates']
-            
+            gradcam = self.dict_gradcams[slide_id]
+            write_gradcam_h5(f"{out_path}/{slide_id}.h5", gradcam['meta']['patch_size'],
+                             gradcam['meta']['magnification'], os_slide.dimensions,
+                             np.array(gradcam['tiles']), np.stack(gradcam['maps']),
+                             self.compression, self.compression_opts)
+            os_slide.close()
             print (f"created {slide_id} h5 activation map.")
 
 
-    def __init__(self, slides_path, category_enum, patch_pattern, gradcam_location, deep_model, gradcam_h5):
+    def __init__(self, slides_path, category_enum, patch_pattern, gradcam_location, deep_model, gradcam_h5,
+                 compression=DEFAULT_GRADCAM_COMPRESSION, compression_opts=None,
+                 streaming=False, max_buffer_bytes=DEFAULT_GRADCAM_BUFFER_BYTES,
+                 slide_patch_counts=None, n_writer_threads=DEFAULT_WRITER_THREADS, worker_id=None):
         """
+        Parameters
+        ----------
+        compression : str
+            Compression of the h5 activation maps, one of 'lzf', 'gzip' or None.
+
+        compression_opts : int
+            Compression level of gzip.
+
+        streaming : bool
+            Whether to write the h5 activation maps of each slide as it is completed instead of keeping all of them in memory until save_gradcam_h5. Maps are also written when the buffered maps exceed max_buffer_bytes.
+
+        max_buffer_bytes : int
+            Maximum size of the buffered activation maps in streaming mode.
+
+        slide_patch_counts : dict
+            {slide_id: number of patches} used in streaming mode to write a slide as soon as all of its patches are seen. Otherwise slides are written by finish_slide or save_gradcam_h5.
+
+        n_writer_threads : int
+            Number of threads writing the overlayed gradcam images when not generating h5 files. get_gradcam blocks once a few images per thread are waiting, and drain waits for the rest.
 
+        worker_id : int
+            ID of this worker when several workers run on the same slides in streaming mode. Each worker writes its own {slide_id}.shard{worker_id}.h5 files, consolidate them with submodule_utils.shards.consolidate_shard_dir.
         """
         self.slides_path = slides_path
         self.category_enum = category_enum
@@ -122,10 +176,21 @@ class GradCAM_AIM():
         self.layer = [deep_model.feature_extract[-1]]
         self.gradcam = GradCAM(model=deep_model, target_layers=self.layer, use_cuda=torch.cuda.is_available())
         self.generate_gradcam_h5 = gradcam_h5
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.streaming = streaming
 
         if (self.generate_gradcam_h5):
             self.dict_gradcams = {}
             os.makedirs(f"{self.gradcam_location}/grad_cam_h5_files", exist_ok=True)
+            if self.streaming:
+                self.gradcam_writer = GradCAMWriter(f"{self.gradcam_location}/grad_cam_h5_files",
+                                                    self.get_slide_dimensions, compression,
+                                                    compression_opts, max_buffer_bytes,
+                                                    slide_patch_counts, worker_id)
+        else:
+            self.gradcam_dirs = set()
+            self.image_writer = AsyncWriter(write_gradcam_overlay, n_writer_threads)
             
 
 
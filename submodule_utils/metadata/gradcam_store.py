@@ -0,0 +1,688 @@
+"""Storage of Grad-CAM activation maps in {slide_id}.h5 files.
+
+Version 1 files written by earlier versions of GradCAM_AIM have
+
+```
+Dataset {patch_size}/{magnification}/grad_cam: (tile_height, tile_width, 32, 32) grid of activation maps
+Dataset {patch_size}/{magnification}/image_coordinates: string '{row}_{col}-{row}_{col}-...' of the tiles with a map
+Dataset {patch_size}/{magnification}/slide_diminsions: (width, height) of the slide
+```
+
+Version 2 files store only the maps of the tiles with a patch
+
+```
+Attribute {patch_size}/{magnification}.format_version: 2
+Attribute {patch_size}/{magnification}.n_maps: number of maps committed to the file
+Dataset {patch_size}/{magnification}/maps: (n, 32, 32) activation maps
+Dataset {patch_size}/{magnification}/tiles: (n, 2) int32 (row, column) tile of each map
+Dataset {patch_size}/{magnification}/slide_diminsions: (width, height) of the slide
+```
+
+where the tile (row, column) is the patch at (x, y) = (column * tile_size, row * tile_size) with tile_size the patch size at 40x. The datasets are chunked in whole maps, compressed and resizable so maps can be appended.
+"""
+import os
+import glob
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+
+import h5py
+import numpy as np
+from submodule_utils.shards import get_shard_path
+
+GRADCAM_FORMAT_VERSION = 2
+GRADCAM_MAP_SIZE = 32
+# number of maps per chunk, 64 float32 maps are 256KiB
+GRADCAM_CHUNK_MAPS = 64
+GRADCAM_CHUNK_TILES = 4096
+GRADCAM_COMPRESSIONS = ['lzf', 'gzip', None]
+DEFAULT_GRADCAM_COMPRESSION = 'lzf'
+DEFAULT_GRADCAM_BUFFER_BYTES = 512 * 2**20
+DEFAULT_WRITER_THREADS = 4
+# number of work items per writer thread that can be queued before submit blocks
+WRITER_QUEUE_FACTOR = 4
+
+
+def get_gradcam_group_name(patch_size, magnification):
+    return "{}/{}".format(patch_size, magnification)
+
+
+def get_gradcam_tile_size(patch_size, magnification):
+    """Get the size in slide pixels at 40x of a tile of the Grad-CAM grid.
+    """
+    return patch_size * int(40 // magnification)
+
+
+def create_gradcam_datasets(hdf, patch_size, magnification, slide_dimensions,
+                            compression=DEFAULT_GRADCAM_COMPRESSION, compression_opts=None,
+                            chunk_maps=GRADCAM_CHUNK_MAPS):
+    """Create the empty resizable version 2 datasets of a {patch_size}/{magnification} group, replacing existing ones.
+
+    Parameters
+    ----------
+    hdf : h5py.File
+
+    patch_size : int
+
+    magnification : int
+
+    slide_dimensions : tuple of int
+        (width, height) of the slide.
+
+    compression : str
+        One of 'lzf', 'gzip' or None.
+
+    compression_opts : int
+        Compression level of gzip.
+
+    chunk_maps : int
+        Number of maps per chunk.
+
+    Returns
+    -------
+    h5py.Group
+    """
+    if compression not in GRADCAM_COMPRESSIONS:
+        raise ValueError(f"compression must be one of {GRADCAM_COMPRESSIONS}, got {compression}")
+    group_name = get_gradcam_group_name(patch_size, magnification)
+    if group_name in hdf:
+        del hdf[group_name]
+    group = hdf.create_group(group_name)
+    group.create_dataset("maps", (0, GRADCAM_MAP_SIZE, GRADCAM_MAP_SIZE),
+                         maxshape=(None, GRADCAM_MAP_SIZE, GRADCAM_MAP_SIZE),
+                         chunks=(chunk_maps, GRADCAM_MAP_SIZE, GRADCAM_MAP_SIZE),
+                         compression=compression, compression_opts=compression_opts,
+                         dtype='f')
+    group.create_dataset("tiles", (0, 2), maxshape=(None, 2), chunks=(GRADCAM_CHUNK_TILES, 2),
+                         compression=compression, compression_opts=compression_opts,
+                         dtype=np.int32)
+    group.create_dataset("slide_diminsions", data=np.array(slide_dimensions, dtype='f'))
+    group.attrs['format_version'] = GRADCAM_FORMAT_VERSION
+    group.attrs['patch_size'] = patch_size
+    group.attrs['magnification'] = magnification
+    group.attrs['n_maps'] = 0
+    return group
+
+
+def append_gradcam_maps(group, tiles, maps):
+    """Append maps to the version 2 datasets of a group and commit them by updating n_maps.
+
+    Parameters
+    ----------
+    group : h5py.Group
+
+    tiles : np.ndarray
+        int array of shape (n, 2) of the (row, column) tile of each map.
+
+    maps : np.ndarray
+        float array of shape (n, 32, 32).
+    """
+    n_maps = int(group.attrs['n_maps'])
+    n = len(tiles)
+    if n == 0:
+        return
+    for name, values in [("maps", maps), ("tiles", tiles)]:
+        group[name].resize(n_maps + n, axis=0)
+        group[name][n_maps:] = values
+    group.attrs['n_maps'] = n_maps + n
+    group.file.flush()
+
+
+def write_gradcam_h5(gradcam_path, patch_size, magnification, slide_dimensions, tiles, maps,
+                     compression=DEFAULT_GRADCAM_COMPRESSION, compression_opts=None):
+    """Write the activation maps of a slide to a version 2 file in one pass.
+
+    The maps are sorted by tile so maps of neighbouring tiles are in the same chunks.
+
+    Parameters
+    ----------
+    gradcam_path : str
+        Path of the file to write.
+
+    tiles : np.ndarray
+        int array of shape (n, 2) of the (row, column) tile of each map.
+
+    maps : np.ndarray
+        float array of shape (n, 32, 32).
+
+    compression : str
+        One of 'lzf', 'gzip' or None.
+
+    compression_opts : int
+        Compression level of gzip.
+    """
+    tiles = np.asarray(tiles, dtype=np.int32).reshape(-1, 2)
+    order = np.lexsort((tiles[:, 1], tiles[:, 0]))
+    with h5py.File(gradcam_path, 'w') as hdf:
+        group = create_gradcam_datasets(hdf, patch_size, magnification, slide_dimensions,
+                                        compression, compression_opts)
+        append_gradcam_maps(group, tiles[order], np.asarray(maps, dtype=np.float32)[order])
+
+
+class GradCAMWriter(object):
+    """Streaming writer of the activation maps of many slides to one version 2 file per slide.
+
+    Maps are buffered per slide and appended to the resizable datasets of the slide's file when the slide is complete, or when the buffers of all slides exceed max_bytes in which case the largest buffers are flushed first. Each flush commits its maps, so maps flushed before an interruption stay readable.
+
+    If the file of a slide already exists, e.g. when rerunning after an interruption, the writer resumes from its committed maps: rows past n_maps are dropped and maps of tiles already in the file are not written again.
+
+    A slide is complete when finish_slide is called, or when expected_counts maps were appended to it.
+
+    Parameters
+    ----------
+    gradcam_dir : str
+        Directory of the {slide_id}.h5 files.
+
+    get_slide_dimensions : callable
+        Function of slide_id returning the (width, height) of the slide, or None if the slide can not be opened in which case its maps are dropped.
+
+    compression : str
+        One of 'lzf', 'gzip' or None.
+
+    compression_opts : int
+        Compression level of gzip.
+
+    max_bytes : int
+        Maximum size of the buffered maps of all slides.
+
+    expected_counts : dict
+        {slide_id: number of maps} used to flush slides as soon as they are complete.
+
+    worker_id : int
+        If given, maps are written to the {slide_id}.shard{worker_id}.h5 shards of the worker, to be consolidated with submodule_utils.shards.consolidate_shard_dir once all workers are done.
+    """
+    def __init__(self, gradcam_dir, get_slide_dimensions, compression=DEFAULT_GRADCAM_COMPRESSION,
+                 compression_opts=None, max_bytes=DEFAULT_GRADCAM_BUFFER_BYTES,
+                 expected_counts=None, worker_id=None):
+        self.gradcam_dir = gradcam_dir
+        self.get_slide_dimensions = get_slide_dimensions
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.max_bytes = max_bytes
+        self.expected_counts = expected_counts or {}
+        self.worker_id = worker_id
+        self.buffers = {}
+        self.buffered_bytes = 0
+        self.counts = collections.Counter()
+        self.started = set()
+        self.skipped = set()
+        self.committed_tiles = {}
+
+    def get_gradcam_path(self, slide_id):
+        gradcam_path = os.path.join(self.gradcam_dir, f"{slide_id}.h5")
+        if self.worker_id is None:
+            return gradcam_path
+        return get_shard_path(gradcam_path, self.worker_id)
+
+    def append(self, slide_id, patch_size, magnification, tile, cam):
+        """Append the activation map of a patch.
+
+        Parameters
+        ----------
+        tile : tuple of int
+            (row, column) tile of the patch.
+
+        cam : np.ndarray
+            (32, 32) activation map.
+        """
+        if slide_id in self.skipped:
+            return
+        if slide_id not in self.buffers:
+            self.buffers[slide_id] = {'meta': {'patch_size': patch_size,
+                                               'magnification': magnification},
+                                      'tiles': [], 'maps': []}
+        self.buffers[slide_id]['tiles'].append(tile)
+        cam = np.asarray(cam, dtype=np.float32)
+        self.buffers[slide_id]['maps'].append(cam)
+        self.buffered_bytes += cam.nbytes
+        self.counts[slide_id] += 1
+        if self.counts[slide_id] == self.expected_counts.get(slide_id):
+            self.finish_slide(slide_id)
+        while self.buffered_bytes > self.max_bytes and self.buffers:
+            self.flush(max(self.buffers, key=lambda k: len(self.buffers[k]['maps'])))
+
+    def flush(self, slide_id):
+        """Append the buffered maps of a slide to its file.
+        """
+        buffer = self.buffers.pop(slide_id, None)
+        if buffer is None:
+            return
+        maps = np.stack(buffer['maps'])
+        self.buffered_bytes -= maps.nbytes
+        meta = buffer['meta']
+        tiles = np.array(buffer['tiles'], dtype=np.int32).reshape(-1, 2)
+        group_name = get_gradcam_group_name(meta['patch_size'], meta['magnification'])
+        if slide_id not in self.started:
+            slide_dimensions = self.get_slide_dimensions(slide_id)
+            if slide_dimensions is None:
+                self.skipped.add(slide_id)
+                return
+        with h5py.File(self.get_gradcam_path(slide_id), 'a') as hdf:
+            if slide_id not in self.started:
+                if group_name not in hdf:
+                    create_gradcam_datasets(hdf, meta['patch_size'], meta['magnification'],
+                                            slide_dimensions, self.compression,
+                                            self.compression_opts)
+                self.resume(slide_id, hdf[group_name])
+                self.started.add(slide_id)
+            committed = self.committed_tiles[slide_id]
+            if committed:
+                keep = np.array([tuple(tile) not in committed for tile in tiles.tolist()],
+                                dtype=bool)
+                tiles, maps = tiles[keep], maps[keep]
+            append_gradcam_maps(hdf[group_name], tiles, maps)
+
+    def resume(self, slide_id, group):
+        """Drop the uncommitted rows of an existing group and get the tiles of its committed maps.
+        """
+        n_maps = int(group.attrs['n_maps'])
+        for name in ["maps", "tiles"]:
+            if group[name].shape[0] != n_maps:
+                group[name].resize(n_maps, axis=0)
+        self.committed_tiles[slide_id] = set(map(tuple, group['tiles'][:n_maps].tolist()))
+
+    def finish_slide(self, slide_id):
+        """Flush the maps of a complete slide.
+        """
+        self.flush(slide_id)
+        if slide_id in self.started:
+            print(f"created {slide_id} h5 activation map.")
+
+    def close(self):
+        """Flush the maps of every slide.
+        """
+        for slide_id in list(self.buffers):
+            self.finish_slide(slide_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncWriter(object):
+    """Run write jobs such as reading, overlaying and encoding images on a bounded thread pool off the calling thread.
+
+    At most max_pending jobs are queued or running, submit blocks until a slot is free so a producer faster than the disk can not grow memory without bound. Failed jobs are reported and counted, drain waits for all submitted jobs.
+
+    Parameters
+    ----------
+    write_fn : callable
+        Function run on each submitted work item.
+
+    n_threads : int
+        Number of writer threads.
+
+    max_pending : int
+        Maximum number of queued or running work items. Defaults to WRITER_QUEUE_FACTOR * n_threads.
+    """
+    def __init__(self, write_fn, n_threads=DEFAULT_WRITER_THREADS, max_pending=None):
+        self.write_fn = write_fn
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads)
+        self.slots = threading.BoundedSemaphore(max_pending or WRITER_QUEUE_FACTOR * n_threads)
+        self.condition = threading.Condition()
+        self.n_pending = 0
+        self.n_done = 0
+        self.n_failed = 0
+
+    def _done(self, future):
+        with self.condition:
+            self.n_pending -= 1
+            if future.exception() is None:
+                self.n_done += 1
+            else:
+                self.n_failed += 1
+                print(f"could not write: {future.exception()}")
+            self.condition.notify_all()
+        self.slots.release()
+
+    def submit(self, *args):
+        """Queue a work item, blocking while max_pending items are queued or running.
+        """
+        self.slots.acquire()
+        with self.condition:
+            self.n_pending += 1
+        self.executor.submit(self.write_fn, *args).add_done_callback(self._done)
+
+    def drain(self):
+        """Wait for all submitted work items.
+
+        Returns
+        -------
+        tuple
+            (number of items written, number of items that failed) since the writer was created.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.n_pending == 0)
+            return self.n_done, self.n_failed
+
+    def close(self):
+        """Wait for all submitted work items and stop the writer threads.
+
+        Returns
+        -------
+        tuple
+            (number of items written, number of items that failed) as drain.
+        """
+        counts = self.drain()
+        self.executor.shutdown()
+        return counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_tile_keys(tiles):
+    """Encode (row, column) tiles as single int64 keys.
+    """
+    tiles = np.asarray(tiles, dtype=np.int64).reshape(-1, 2)
+    return (tiles[:, 0] << 32) | tiles[:, 1]
+
+
+class GradCAMStore(object):
+    """Random access reader of a Grad-CAM file of either version.
+
+    The file is opened on first access. The tiles of the file are read once, maps are read only for the requested tiles.
+
+    Parameters
+    ----------
+    gradcam_path : str
+        Path to the {slide_id}.h5 file.
+
+    group_name : str
+        {patch_size}/{magnification} group to read. Can be omitted if the file has a single group.
+    """
+    def __init__(self, gradcam_path, group_name=None):
+        self.gradcam_path = gradcam_path
+        self.group_name = group_name
+        self.file = None
+        self.group = None
+        self.tiles = None
+        self.sorted_keys = None
+        self.sorted_indices = None
+
+    def open(self):
+        if self.file is None:
+            self.file = h5py.File(self.gradcam_path, 'r')
+            if self.group_name is None:
+                group_names = [f"{patch_size}/{magnification}"
+                               for patch_size, size_group in self.file.items()
+                               for magnification in size_group]
+                if len(group_names) != 1:
+                    self.close()
+                    raise ValueError(f"{self.gradcam_path} has groups {group_names}, "
+                                     "group_name must be given")
+                self.group_name = group_names[0]
+            self.group = self.file[self.group_name]
+        return self.group
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.group = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def version(self):
+        return int(self.open().attrs.get('format_version', 1))
+
+    @property
+    def patch_size(self):
+        return int(self.open().name.split('/')[1])
+
+    @property
+    def magnification(self):
+        return int(self.open().name.split('/')[2])
+
+    @property
+    def slide_dimensions(self):
+        return tuple(int(d) for d in self.open()['slide_diminsions'][()])
+
+    def __len__(self):
+        return len(self.get_tiles())
+
+    def get_tiles(self):
+        """Get the (row, column) tile of each map.
+
+        Returns
+        -------
+        np.ndarray
+            int64 array of shape (n, 2).
+        """
+        if self.tiles is None:
+            group = self.open()
+            if self.version == 1:
+                coordinates = group['image_coordinates'][0]
+                if isinstance(coordinates, bytes):
+                    coordinates = coordinates.decode()
+                tiles = [tile.split('_') for tile in coordinates.split('-') if tile]
+                self.tiles = np.array(tiles, dtype=np.int64).reshape(-1, 2)
+            else:
+                self.tiles = group['tiles'][:int(group.attrs['n_maps'])].astype(np.int64)
+            keys = get_tile_keys(self.tiles)
+            self.sorted_indices = np.argsort(keys, kind='stable')
+            self.sorted_keys = keys[self.sorted_indices]
+        return self.tiles
+
+    def find_tiles(self, tiles):
+        """Get the index of the map of each tile, -1 if the tile has no map.
+        """
+        self.get_tiles()
+        keys = get_tile_keys(tiles)
+        if len(self.sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys),
+                               len(self.sorted_keys) - 1)
+        found = self.sorted_keys[positions] == keys
+        return np.where(found, self.sorted_indices[positions], -1)
+
+    def read_maps(self, indices):
+        """Read the maps at sorted unique indices.
+        """
+        group = self.open()
+        if len(indices) == 0:
+            return np.zeros((0, GRADCAM_MAP_SIZE, GRADCAM_MAP_SIZE), dtype=np.float32)
+        if self.version == 1:
+            tiles = self.tiles[indices]
+            return np.stack([group['grad_cam'][row, col] for row, col in tiles])
+        start, stop = indices[0], indices[-1] + 1
+        if stop - start <= 2 * len(indices):
+            # close indices are read as one slab
+            return group['maps'][start:stop][indices - start]
+        return group['maps'][indices]
+
+    def get_maps(self, tiles):
+        """Get the maps of tiles.
+
+        Parameters
+        ----------
+        tiles : np.ndarray
+            int array of shape (m, 2) of (row, column) tiles.
+
+        Returns
+        -------
+        tuple
+            A tuple of
+             - maps (np.ndarray) float32 array of shape (m, 32, 32), NaN for tiles without a map
+             - found (np.ndarray) bool array of shape (m,) of the tiles with a map
+        """
+        indices = self.find_tiles(tiles)
+        found = indices >= 0
+        maps = np.full((len(indices), GRADCAM_MAP_SIZE, GRADCAM_MAP_SIZE), np.nan,
+                       dtype=np.float32)
+        unique_indices, inverse = np.unique(indices[found], return_inverse=True)
+        maps[found] = self.read_maps(unique_indices)[inverse]
+        return maps, found
+
+    def get_grid_shape(self):
+        """Get the (rows, columns) of the tile grid of the slide, enlarged to hold every tile of the file.
+        """
+        group = self.open()
+        if self.version == 1:
+            return tuple(int(d) for d in group['grad_cam'].shape[:2])
+        tile_size = get_gradcam_tile_size(self.patch_size, self.magnification)
+        width, height = self.slide_dimensions
+        shape = np.array([-(-height // tile_size), -(-width // tile_size)], dtype=np.int64)
+        tiles = self.get_tiles()
+        if len(tiles) > 0:
+            shape = np.maximum(shape, tiles.max(axis=0) + 1)
+        return tuple(int(d) for d in shape)
+
+    def get_region(self, window):
+        """Get the maps of a region of tiles as a dense grid.
+
+        Parameters
+        ----------
+        window : tuple of slice
+            (row slice, column slice) of the tiles such as np.s_[10:20, 0:5]. Open and negative bounds are relative to the tile grid of get_grid_shape.
+
+        Returns
+        -------
+        np.ndarray
+            float32 array of shape (rows, columns, 32, 32), NaN for tiles without a map.
+
+        Raises
+        ------
+        ValueError
+            If a slice has a step other than 1.
+        """
+        bounds = []
+        for window_slice, dim in zip(window, self.get_grid_shape()):
+            start, stop, step = window_slice.indices(dim)
+            if step != 1:
+                raise ValueError(f"Tiles can not be read with step {step}")
+            bounds.append((start, max(stop, start)))
+        (row_start, row_stop), (col_start, col_stop) = bounds
+        tiles = self.get_tiles()
+        inside = (tiles[:, 0] >= row_start) & (tiles[:, 0] < row_stop) \
+                & (tiles[:, 1] >= col_start) & (tiles[:, 1] < col_stop)
+        indices = np.flatnonzero(inside)
+        grid = np.full((row_stop - row_start, col_stop - col_start,
+                        GRADCAM_MAP_SIZE, GRADCAM_MAP_SIZE), np.nan, dtype=np.float32)
+        grid[tiles[indices, 0] - row_start, tiles[indices, 1] - col_start] = \
+                self.read_maps(indices)
+        return grid
+
+    def __getitem__(self, window):
+        """Get the maps of a region of tiles with get_region, i.e. store[10:20, :] or store[..., 5:].
+        """
+        window = window if isinstance(window, tuple) else (window,)
+        if any(item is Ellipsis for item in window):
+            idx = next(idx for idx, item in enumerate(window) if item is Ellipsis)
+            window = window[:idx] + (slice(None),) * (3 - len(window)) + window[idx + 1:]
+        window = window + (slice(None),) * (2 - len(window))
+        return self.get_region(window)
+
+    def iter_chunks(self, chunk_size=GRADCAM_CHUNK_MAPS * 16):
+        """Iterate over the tiles and maps in chunks.
+
+        Yields
+        ------
+        tuple
+            (tiles, maps) of at most chunk_size maps.
+        """
+        n = len(self)
+        for start in range(0, n, chunk_size):
+            indices = np.arange(start, min(start + chunk_size, n))
+            yield self.tiles[indices], self.read_maps(indices)
+
+
+def merge_gradcam_shards(shard_paths, output_path, compression=DEFAULT_GRADCAM_COMPRESSION,
+                         compression_opts=None):
+    """Merge the Grad-CAM files of a slide written by several workers into one version 2 file.
+
+    Shards are copied chunk by chunk, so only the tiles of the merged file and one chunk of maps are in memory. If a tile is in several shards the map of the first shard is kept.
+
+    Parameters
+    ----------
+    shard_paths : list of str
+        Paths to the Grad-CAM files of the same slide, of either version.
+
+    output_path : str
+        Path of the merged file.
+
+    Returns
+    -------
+    int
+        Number of maps in the merged file.
+
+    Raises
+    ------
+    ValueError
+        If the shards do not have the same patch size, magnification and slide dimensions.
+    """
+    with GradCAMStore(shard_paths[0]) as store:
+        meta = (store.patch_size, store.magnification, store.slide_dimensions)
+    seen_keys = np.zeros(0, dtype=np.int64)
+    with h5py.File(output_path, 'w') as hdf:
+        group = create_gradcam_datasets(hdf, *meta, compression=compression,
+                                        compression_opts=compression_opts)
+        for shard_path in shard_paths:
+            with GradCAMStore(shard_path) as store:
+                shard_meta = (store.patch_size, store.magnification, store.slide_dimensions)
+                if shard_meta != meta:
+                    raise ValueError(f"{shard_path} has patch size, magnification and "
+                                     f"dimensions {shard_meta}, expected {meta}")
+                for tiles, maps in store.iter_chunks():
+                    keys = get_tile_keys(tiles)
+                    keys, first = np.unique(keys, return_index=True)
+                    new = ~np.isin(keys, seen_keys)
+                    indices = np.sort(first[new])
+                    append_gradcam_maps(group, tiles[indices], maps[indices])
+                    seen_keys = np.union1d(seen_keys, keys[new])
+    return len(seen_keys)
+
+
+def _merge_gradcam_shards(args):
+    slide_id, shard_paths, output_path, compression, compression_opts = args
+    try:
+        return slide_id, merge_gradcam_shards(shard_paths, output_path, compression,
+                                              compression_opts)
+    except Exception as e:
+        print(f"could not merge {slide_id}: {e}")
+        return slide_id, None
+
+
+def merge_gradcam_shard_dirs(shard_dirs, output_dir, compression=DEFAULT_GRADCAM_COMPRESSION,
+                             compression_opts=None, n_process=None):
+    """Merge the {slide_id}.h5 Grad-CAM files written to a directory by each worker, i.e. each SLURM array task. Slides are merged concurrently on a process pool.
+
+    Parameters
+    ----------
+    shard_dirs : list of str
+        Output directories of the workers.
+
+    output_dir : str
+        Directory of the merged {slide_id}.h5 files.
+
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    dict
+        {slide_id: number of maps} of each slide, None if the slide could not be merged.
+    """
+    shards = collections.defaultdict(list)
+    for shard_dir in shard_dirs:
+        for shard_path in sorted(glob.glob(os.path.join(shard_dir, '*.h5'))):
+            shards[os.path.splitext(os.path.basename(shard_path))[0]].append(shard_path)
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(slide_id, shard_paths, os.path.join(output_dir, f"{slide_id}.h5"),
+             compression, compression_opts) for slide_id, shard_paths in shards.items()]
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if n_process == 1:
+        return dict(map(_merge_gradcam_shards, jobs))
+    with multiprocessing.Pool(processes=n_process) as pool:
+        return dict(pool.map(_merge_gradcam_shards, jobs, chunksize=1))
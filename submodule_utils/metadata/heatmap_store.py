@@ -0,0 +1,711 @@
+"""Storage of slide heatmaps in heatmap.0.{slide_id}.h5 files.
+
+A heatmap file has one dataset of shape (tile_height, tile_width) per class
+
+```
+Dataset {patch_size}/{magnification}/{class_name}
+```
+
+where the cell (row, column) is the probability of the class for the patch at (x, y) = (column * patch_size, row * patch_size).
+
+Datasets written with HeatmapStorageOptions have the attributes
+
+```
+Attribute heatmap_format: HEATMAP_FORMAT_VERSION
+Attribute scale: stored values are multiplied by scale to get probabilities
+Attribute nodata: stored value of cells without a patch, if they are not 0
+```
+
+so they can be float32, float16 or probabilities quantized to uint8, and can be chunked in tiles and compressed. Datasets without these attributes are float32 where cells without a patch are 0.
+
+A heatmap file can also have a pyramid of each class grid downsampled by 2 per level
+
+```
+Dataset {patch_size}/{magnification}_pyramid/{level}/mean/{class_name}
+Dataset {patch_size}/{magnification}_pyramid/{level}/max/{class_name}
+```
+
+next to the {patch_size}/{magnification} group so that group still only has the class datasets.
+
+where the cell (row, column) of level l is the mean or max of the cells with a patch in the 2**l by 2**l block of tiles at (row * 2**l, column * 2**l). The last level has a single cell.
+"""
+import os
+import glob
+import collections
+import multiprocessing
+
+import h5py
+import numpy as np
+
+HEATMAP_FORMAT_VERSION = 2
+HEATMAP_CHUNK_SIZE = 256
+HEATMAP_DTYPES = ['float32', 'float16', 'uint8']
+# uint8 probabilities are quantized to 0..254 so 255 is left for cells without a patch
+HEATMAP_UINT8_NODATA = 255
+HEATMAP_UINT8_SCALE = 1. / 254
+DEFAULT_HEATMAP_CACHE_BYTES = 64 * 2**20
+HEATMAP_PYRAMID_SUFFIX = '_pyramid'
+HEATMAP_REDUCTIONS = ['mean', 'max']
+
+
+class HeatmapStorageOptions(object):
+    """Options for how the class datasets of a heatmap are stored.
+
+    The defaults write datasets like earlier versions: contiguous float32 where cells without a patch are 0.
+
+    Parameters
+    ----------
+    dtype : str
+        One of 'float32', 'float16' or 'uint8'. uint8 probabilities are quantized in steps of 1/254.
+
+    chunk_size : int
+        Datasets are chunked in tiles of chunk_size by chunk_size cells. Contiguous if None.
+
+    compression : str
+        HDF5 compression filter such as 'gzip' or 'lzf'. Requires chunk_size.
+
+    compression_opts : int
+        Compression level of gzip.
+
+    nodata : bool
+        Whether to store cells without a patch as an explicit no data value (NaN for floats, 255 for uint8) instead of 0.
+    """
+    def __init__(self, dtype='float32', chunk_size=None, compression=None,
+                 compression_opts=None, nodata=False):
+        if dtype not in HEATMAP_DTYPES:
+            raise ValueError(f"dtype must be one of {HEATMAP_DTYPES}, got {dtype}")
+        if compression is not None and chunk_size is None:
+            raise ValueError("compression requires chunk_size")
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.nodata = nodata
+
+    @classmethod
+    def compact(cls, dtype='uint8'):
+        """Get the options of the compact format: quantized probabilities in 256 by 256 chunks compressed with gzip and an explicit no data value.
+        """
+        return cls(dtype=dtype, chunk_size=HEATMAP_CHUNK_SIZE, compression='gzip',
+                   compression_opts=4, nodata=True)
+
+    @property
+    def scale(self):
+        return HEATMAP_UINT8_SCALE if self.dtype == 'uint8' else 1.
+
+    @property
+    def nodata_value(self):
+        if not self.nodata:
+            return 0
+        return HEATMAP_UINT8_NODATA if self.dtype == 'uint8' else np.nan
+
+    def get_chunks(self, shape):
+        """Get the chunk shape of a dataset of shape, clipped to the shape.
+        """
+        if self.chunk_size is None or 0 in shape:
+            return None
+        return tuple(min(self.chunk_size, dim) for dim in shape)
+
+    def create_dataset(self, group, name, shape):
+        """Create an empty class dataset of shape (tile_height, tile_width).
+        """
+        chunks = self.get_chunks(shape)
+        dataset = group.create_dataset(name, shape, dtype=self.dtype, chunks=chunks,
+                                       compression=self.compression if chunks else None,
+                                       compression_opts=self.compression_opts if chunks else None,
+                                       shuffle=chunks is not None and self.compression is not None
+                                               and self.dtype != 'uint8',
+                                       fillvalue=self.nodata_value)
+        dataset.attrs['heatmap_format'] = HEATMAP_FORMAT_VERSION
+        dataset.attrs['scale'] = self.scale
+        if self.nodata:
+            dataset.attrs['nodata'] = self.nodata_value
+        return dataset
+
+    def encode(self, grid):
+        """Encode a float grid of probabilities where cells without a patch are NaN.
+        """
+        grid = np.asarray(grid, dtype=np.float32)
+        missing = np.isnan(grid)
+        if self.dtype == 'uint8':
+            encoded = np.rint(np.clip(np.nan_to_num(grid), 0., 1.) / self.scale).astype(np.uint8)
+        else:
+            encoded = np.nan_to_num(grid).astype(self.dtype)
+        encoded[missing] = self.nodata_value
+        return encoded
+
+
+def decode_heatmap(values, attrs):
+    """Decode the stored values of a class dataset to float32 probabilities where cells without a patch are NaN.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values read from the dataset.
+
+    attrs : h5py.AttributeManager or dict
+        Attributes of the dataset.
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of probabilities. Cells of datasets without an explicit no data value are never NaN.
+    """
+    values = np.asarray(values)
+    decoded = values.astype(np.float32)
+    if 'scale' in attrs and attrs['scale'] != 1.:
+        decoded *= np.float32(attrs['scale'])
+    if has_nodata(attrs) and not np.isnan(attrs['nodata']):
+        decoded[values == attrs['nodata']] = np.nan
+    return decoded
+
+
+def has_nodata(attrs):
+    """Whether a class dataset has an explicit no data value.
+    """
+    return 'nodata' in attrs
+
+
+def get_heatmap_path(heatmap_location, slide_id):
+    return os.path.join(heatmap_location, f'heatmap.0.{slide_id}.h5')
+
+
+def write_heatmap_grid(dataset, grid, options):
+    """Write a float grid of probabilities where cells without a patch are NaN to a class dataset. Chunks without any patch are not written, so they take no space.
+    """
+    encoded = options.encode(grid)
+    if dataset.chunks is None:
+        dataset[...] = encoded
+        return
+    present = ~np.isnan(grid)
+    chunk_height, chunk_width = dataset.chunks
+    for row in range(0, grid.shape[0], chunk_height):
+        for col in range(0, grid.shape[1], chunk_width):
+            window = np.s_[row:row + chunk_height, col:col + chunk_width]
+            if present[window].any():
+                dataset[window] = encoded[window]
+
+
+def iter_class_datasets(hdf):
+    """Iterate over the groups of class datasets of a heatmap file.
+
+    Yields
+    ------
+    tuple
+        (group_name, group) of each {patch_size}/{magnification} group.
+    """
+    for patch_size, size_group in hdf.items():
+        if not isinstance(size_group, h5py.Group):
+            continue
+        for magnification, group in size_group.items():
+            if isinstance(group, h5py.Group) and not magnification.endswith(HEATMAP_PYRAMID_SUFFIX):
+                yield f"{patch_size}/{magnification}", group
+
+
+def get_pyramid_group_name(group_name):
+    """Get the name of the pyramid group of a {patch_size}/{magnification} group.
+    """
+    return f"{group_name}{HEATMAP_PYRAMID_SUFFIX}"
+
+
+def read_class_grids(group):
+    """Read the class datasets of a {patch_size}/{magnification} group into a (classes, tile_height, tile_width) grid where cells without a patch are NaN.
+
+    For datasets without an explicit no data value, cells where every class is 0 are taken as cells without a patch.
+
+    Returns
+    -------
+    tuple
+        (class_names, grid)
+    """
+    class_names = [name for name, dataset in group.items() if isinstance(dataset, h5py.Dataset)]
+    if len(class_names) == 0:
+        return class_names, np.zeros((0, 0, 0), dtype=np.float32)
+    grid = np.stack([decode_heatmap(group[name][...], group[name].attrs) for name in class_names])
+    legacy = [not has_nodata(group[name].attrs) for name in class_names]
+    if all(legacy):
+        grid[:, np.all(grid == 0, axis=0)] = np.nan
+    return class_names, grid
+
+
+def downsample_heatmap(sums, counts, maxes):
+    """Downsample a level of a heatmap pyramid by 2.
+
+    Parameters
+    ----------
+    sums : np.ndarray
+        float64 array of shape (classes, height, width) of the sums of the probabilities of each cell.
+
+    counts : np.ndarray
+        int array of shape (height, width) of the number of tiles with a patch in each cell.
+
+    maxes : np.ndarray
+        float32 array of shape (classes, height, width) of the max of each cell, -inf if the cell has no patch.
+
+    Returns
+    -------
+    tuple
+        (sums, counts, maxes) of the next level of shape (classes, ceil(height / 2), ceil(width / 2)).
+    """
+    classes, height, width = sums.shape
+    pad = ((0, 0), (0, height % 2), (0, width % 2))
+    shape = (classes, (height + 1) // 2, 2, (width + 1) // 2, 2)
+    sums = np.pad(sums, pad).reshape(shape).sum(axis=(2, 4))
+    maxes = np.pad(maxes, pad, constant_values=-np.inf).reshape(shape).max(axis=(2, 4))
+    counts = np.pad(counts, pad[1:]).reshape(shape[1:]).sum(axis=(1, 3))
+    return sums, counts, maxes
+
+
+def get_heatmap_pyramid(grid):
+    """Get the pyramid of a heatmap grid, from downsampled by 2 to a single cell. Cells without a patch are left out of the mean and max.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        float array of shape (classes, tile_height, tile_width) where cells without a patch are NaN.
+
+    Returns
+    -------
+    list of dict
+        {'mean': np.ndarray, 'max': np.ndarray} of each level, float32 arrays of shape (classes, height, width) where cells without a patch are NaN.
+    """
+    present = ~np.isnan(grid).any(axis=0)
+    sums = np.where(present, grid, 0.).astype(np.float64)
+    maxes = np.where(present, grid, -np.inf).astype(np.float32)
+    counts = present.astype(np.int64)
+    levels = []
+    while max(counts.shape) > 1:
+        sums, counts, maxes = downsample_heatmap(sums, counts, maxes)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (sums / counts).astype(np.float32)
+        levels.append({'mean': means,
+                       'max': np.where(counts > 0, maxes, np.nan).astype(np.float32)})
+    return levels
+
+
+def write_heatmap_pyramid(group, class_names, grid, options):
+    """Write the pyramid of a heatmap grid to the {patch_size}/{magnification}_pyramid group next to a {patch_size}/{magnification} group, replacing any existing pyramid.
+
+    Parameters
+    ----------
+    group : h5py.Group
+        {patch_size}/{magnification} group.
+
+    class_names : list of str
+        Names of the classes of the grid.
+
+    grid : np.ndarray
+        float array of shape (classes, tile_height, tile_width) where cells without a patch are NaN.
+
+    options : HeatmapStorageOptions
+        Storage options of the pyramid datasets, they always have an explicit no data value.
+    """
+    options = HeatmapStorageOptions(options.dtype, options.chunk_size, options.compression,
+                                    options.compression_opts, nodata=True)
+    pyramid_name = get_pyramid_group_name(group.name)
+    if pyramid_name in group.file:
+        del group.file[pyramid_name]
+    pyramid_group = group.file.create_group(pyramid_name)
+    for level, reductions in enumerate(get_heatmap_pyramid(grid), start=1):
+        for reduction, level_grid in reductions.items():
+            reduction_group = pyramid_group.require_group(f"{level}/{reduction}")
+            for idx, name in enumerate(class_names):
+                dataset = options.create_dataset(reduction_group, name, level_grid[idx].shape)
+                dataset.attrs['downsample'] = 2**level
+                write_heatmap_grid(dataset, level_grid[idx], options)
+
+
+def build_heatmap_pyramid_file(heatmap_path, options=None):
+    """Write the pyramids of an existing heatmap file.
+
+    Parameters
+    ----------
+    options : HeatmapStorageOptions
+        Storage options of the pyramid datasets. Defaults to HeatmapStorageOptions.compact().
+    """
+    options = options or HeatmapStorageOptions.compact()
+    with h5py.File(heatmap_path, 'a') as hdf:
+        for _, group in list(iter_class_datasets(hdf)):
+            class_names, grid = read_class_grids(group)
+            if len(class_names) > 0:
+                write_heatmap_pyramid(group, class_names, grid, options)
+
+
+def _build_heatmap_pyramid_file(args):
+    heatmap_path, options = args
+    try:
+        build_heatmap_pyramid_file(heatmap_path, options)
+        return True
+    except Exception as e:
+        print(f"could not build the pyramid of {heatmap_path}: {e}")
+        return False
+
+
+def build_heatmap_pyramids(heatmap_location, options=None, n_process=None):
+    """Write the pyramids of every heatmap.*.h5 file in a directory. Files are processed concurrently on a process pool.
+
+    Returns
+    -------
+    list of bool
+        Whether the pyramid of each file, sorted by path, was written.
+    """
+    jobs = [(path, options) for path in sorted(glob.glob(os.path.join(heatmap_location, 'heatmap.*.h5')))]
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if n_process == 1:
+        return list(map(_build_heatmap_pyramid_file, jobs))
+    with multiprocessing.Pool(processes=n_process) as pool:
+        return pool.map(_build_heatmap_pyramid_file, jobs, chunksize=1)
+
+
+def convert_heatmap_file(heatmap_path, options=None, output_path=None, pyramid=True):
+    """Rewrite a heatmap file with other storage options.
+
+    The file is written to a temporary file next to output_path and then renamed, so output_path can be heatmap_path.
+
+    Parameters
+    ----------
+    heatmap_path : str
+        Path to the heatmap file.
+
+    options : HeatmapStorageOptions
+        Storage options of the converted file. Defaults to HeatmapStorageOptions.compact().
+
+    output_path : str
+        Path of the converted file. Defaults to heatmap_path.
+
+    pyramid : bool
+        Whether to also write the pyramids of the heatmap.
+
+    Returns
+    -------
+    tuple
+        (bytes before, bytes after)
+    """
+    options = options or HeatmapStorageOptions.compact()
+    output_path = output_path or heatmap_path
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        with h5py.File(heatmap_path, 'r') as src, h5py.File(tmp_path, 'w') as dst:
+            for key, value in src.attrs.items():
+                dst.attrs[key] = value
+            for group_name, group in iter_class_datasets(src):
+                class_names, grid = read_class_grids(group)
+                dst_group = dst.require_group(group_name)
+                for idx, name in enumerate(class_names):
+                    dataset = options.create_dataset(dst_group, name, grid[idx].shape)
+                    write_heatmap_grid(dataset, grid[idx], options)
+                if pyramid and len(class_names) > 0:
+                    write_heatmap_pyramid(dst_group, class_names, grid, options)
+        size_before = os.path.getsize(heatmap_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size_before, os.path.getsize(output_path)
+
+
+def _convert_heatmap_file(args):
+    heatmap_path, options, pyramid = args
+    try:
+        return (heatmap_path,) + convert_heatmap_file(heatmap_path, options, pyramid=pyramid)
+    except Exception as e:
+        print(f"could not convert {heatmap_path}: {e}")
+        return heatmap_path, None, None
+
+
+def convert_heatmaps(heatmap_location, options=None, n_process=None, pyramid=True):
+    """Convert every heatmap.*.h5 file in a directory in place. Files are converted concurrently on a process pool.
+
+    Parameters
+    ----------
+    heatmap_location : str
+        Directory of the heatmap files.
+
+    options : HeatmapStorageOptions
+        Storage options of the converted files. Defaults to HeatmapStorageOptions.compact().
+
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    pyramid : bool
+        Whether to also write the pyramids of the heatmaps.
+
+    Returns
+    -------
+    list of tuple
+        (heatmap_path, bytes before, bytes after) of each file, the sizes are None if the file could not be converted.
+    """
+    options = options or HeatmapStorageOptions.compact()
+    jobs = [(path, options, pyramid)
+            for path in sorted(glob.glob(os.path.join(heatmap_location, 'heatmap.*.h5')))]
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if n_process == 1:
+        results = list(map(_convert_heatmap_file, jobs))
+    else:
+        with multiprocessing.Pool(processes=n_process) as pool:
+            results = pool.map(_convert_heatmap_file, jobs, chunksize=1)
+    converted = [r for r in results if r[1] is not None]
+    if converted:
+        before = sum(r[1] for r in converted)
+        after = sum(r[2] for r in converted)
+        print(f"converted {len(converted)} of {len(results)} heatmaps "
+              f"from {before / 2**20:.1f}MiB to {after / 2**20:.1f}MiB")
+    return results
+
+
+class HeatmapStore(object):
+    """Lazy reader of a heatmap file.
+
+    The file is opened on first access, and only the chunks of the requested window and classes are read. Decoded chunks are kept in a LRU cache of at most cache_bytes. Contiguous datasets are read in blocks of HEATMAP_CHUNK_SIZE by HEATMAP_CHUNK_SIZE cells.
+
+    Zoomed-out reads use the pyramid of the file with level > 0, windows are then in cells of the level.
+
+    Reads return float32 probabilities where cells without a patch are NaN. For files without an explicit no data value, cells where every class of the file is 0 are taken as no data, also when only some of the classes are read, in which case the other classes are read to find them.
+
+    Parameters
+    ----------
+    heatmap_path : str
+        Path to the heatmap file.
+
+    cache_bytes : int
+        Maximum size of the decoded chunks kept in memory.
+    """
+    def __init__(self, heatmap_path, cache_bytes=DEFAULT_HEATMAP_CACHE_BYTES):
+        self.heatmap_path = heatmap_path
+        self.cache_bytes = cache_bytes
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.file = None
+
+    @classmethod
+    def from_slide(cls, heatmap_location, slide_id, **kwargs):
+        return cls(get_heatmap_path(heatmap_location, slide_id), **kwargs)
+
+    def open(self):
+        if self.file is None:
+            self.file = h5py.File(self.heatmap_path, 'r')
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.cache.clear()
+        self.cached_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def group_names(self):
+        """Names of the {patch_size}/{magnification} groups of the file.
+        """
+        return [group_name for group_name, _ in iter_class_datasets(self.open())]
+
+    def get_group_name(self, group_name=None):
+        if group_name is not None:
+            return group_name
+        group_names = self.group_names
+        if len(group_names) != 1:
+            raise ValueError(f"{self.heatmap_path} has groups {group_names}, "
+                             "group_name must be given")
+        return group_names[0]
+
+    def get_class_names(self, group_name=None):
+        group = self.open()[self.get_group_name(group_name)]
+        return [name for name, dataset in group.items() if isinstance(dataset, h5py.Dataset)]
+
+    def get_dataset_name(self, group_name, class_name, level=0, reduction='mean'):
+        if level == 0:
+            return f"{group_name}/{class_name}"
+        if reduction not in HEATMAP_REDUCTIONS:
+            raise ValueError(f"reduction must be one of {HEATMAP_REDUCTIONS}, got {reduction}")
+        return f"{get_pyramid_group_name(group_name)}/{level}/{reduction}/{class_name}"
+
+    def get_n_levels(self, group_name=None):
+        """Get the number of levels including level 0, the full grid. 1 if the file has no pyramid.
+        """
+        pyramid_name = get_pyramid_group_name(self.get_group_name(group_name))
+        if pyramid_name not in self.open():
+            return 1
+        return 1 + len(self.open()[pyramid_name])
+
+    def get_shape(self, group_name=None, level=0):
+        """Get the (height, width) of the class datasets of a level, (tile_height, tile_width) at level 0.
+        """
+        group_name = self.get_group_name(group_name)
+        class_name = self.get_class_names(group_name)[0]
+        return self.open()[self.get_dataset_name(group_name, class_name, level)].shape
+
+    def get_window_slices(self, window, shape):
+        """Get the window as (row slice, column slice) clipped to shape. The window is a (row slice, column slice) such as np.s_[0:10, 5:20], or None for the full grid.
+        """
+        if window is None:
+            return slice(0, shape[0]), slice(0, shape[1])
+        slices = []
+        for window_slice, dim in zip(window, shape):
+            start, stop, step = window_slice.indices(dim)
+            if step != 1:
+                raise ValueError("window slices must have a step of 1")
+            slices.append(slice(start, max(start, stop)))
+        return tuple(slices)
+
+    def read_chunk(self, dataset_name, dataset, chunk_row, chunk_col):
+        key = (dataset_name, chunk_row, chunk_col)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        chunk_height, chunk_width = dataset.chunks or (HEATMAP_CHUNK_SIZE, HEATMAP_CHUNK_SIZE)
+        chunk = decode_heatmap(dataset[chunk_row * chunk_height:(chunk_row + 1) * chunk_height,
+                                       chunk_col * chunk_width:(chunk_col + 1) * chunk_width],
+                               dataset.attrs)
+        self.cache[key] = chunk
+        self.cached_bytes += chunk.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
+        return chunk
+
+    def read_class(self, class_name, window=None, group_name=None, level=0, reduction='mean'):
+        """Read the window of a single class.
+
+        Parameters
+        ----------
+        class_name : str
+            Name of the class.
+
+        window : tuple of slice
+            (row slice, column slice) of the tiles to read. Defaults to the full grid.
+
+        group_name : str
+            {patch_size}/{magnification} group to read. Can be omitted if the file has a single group.
+
+        level : int
+            Level of the pyramid to read, 0 is the full grid.
+
+        reduction : str
+            'mean' or 'max' pyramid of levels > 0.
+
+        Returns
+        -------
+        np.ndarray
+            float32 array of shape (rows, columns) of the window.
+        """
+        dataset_name = self.get_dataset_name(self.get_group_name(group_name), class_name,
+                                             level, reduction)
+        dataset = self.open()[dataset_name]
+        rows, cols = self.get_window_slices(window, dataset.shape)
+        chunk_height, chunk_width = dataset.chunks or (HEATMAP_CHUNK_SIZE, HEATMAP_CHUNK_SIZE)
+        values = np.empty((rows.stop - rows.start, cols.stop - cols.start), dtype=np.float32)
+        for chunk_row in range(rows.start // chunk_height, -(-rows.stop // chunk_height)):
+            for chunk_col in range(cols.start // chunk_width, -(-cols.stop // chunk_width)):
+                chunk = self.read_chunk(dataset_name, dataset, chunk_row, chunk_col)
+                row_start = max(rows.start, chunk_row * chunk_height)
+                row_stop = min(rows.stop, (chunk_row + 1) * chunk_height)
+                col_start = max(cols.start, chunk_col * chunk_width)
+                col_stop = min(cols.stop, (chunk_col + 1) * chunk_width)
+                values[row_start - rows.start:row_stop - rows.start,
+                       col_start - cols.start:col_stop - cols.start] = chunk[
+                        row_start - chunk_row * chunk_height:row_stop - chunk_row * chunk_height,
+                        col_start - chunk_col * chunk_width:col_stop - chunk_col * chunk_width]
+        return values
+
+    def read(self, window=None, class_names=None, group_name=None, level=0, reduction='mean'):
+        """Read the window of several classes.
+
+        Parameters
+        ----------
+        window : tuple of slice
+            (row slice, column slice) of the tiles to read. Defaults to the full grid.
+
+        class_names : list of str
+            Classes to read. Defaults to all classes.
+
+        group_name : str
+            {patch_size}/{magnification} group to read. Can be omitted if the file has a single group.
+
+        level : int
+            Level of the pyramid to read, 0 is the full grid.
+
+        reduction : str
+            'mean' or 'max' pyramid of levels > 0.
+
+        Returns
+        -------
+        np.ndarray
+            float32 array of shape (classes, rows, columns) of the window.
+        """
+        group_name = self.get_group_name(group_name)
+        all_class_names = self.get_class_names(group_name)
+        class_names = all_class_names if class_names is None else class_names
+        grid = np.stack([self.read_class(name, window, group_name, level, reduction)
+                         for name in class_names])
+        group = self.open()[group_name]
+        if level == 0 and not any(has_nodata(group[name].attrs) for name in all_class_names):
+            # cells without a patch are where every class is 0, including classes not read
+            nodata = np.all(grid == 0, axis=0)
+            for name in all_class_names:
+                if name not in class_names:
+                    nodata &= self.read_class(name, window, group_name) == 0
+            grid[:, nodata] = np.nan
+        return grid
+
+
+def _read_heatmap_windows(args):
+    heatmap_paths, window, class_names, group_name = args
+    windows = []
+    for heatmap_path in heatmap_paths:
+        try:
+            with HeatmapStore(heatmap_path, cache_bytes=0) as store:
+                windows.append(store.read(window, class_names, group_name))
+        except Exception as e:
+            print(f"could not read {heatmap_path}: {e}")
+            windows.append(None)
+    return windows
+
+
+def read_heatmap_windows(heatmap_paths, window=None, class_names=None, group_name=None,
+                         n_process=None):
+    """Read the same window of the heatmaps of many slides. The files are split between the processes of a pool.
+
+    Parameters
+    ----------
+    heatmap_paths : list of str
+        Paths to the heatmap files.
+
+    window : tuple of slice
+        (row slice, column slice) of the tiles to read, clipped to the grid of each slide.
+
+    class_names : list of str
+        Classes to read. Defaults to all classes.
+
+    group_name : str
+        {patch_size}/{magnification} group to read. Can be omitted if the files have a single group.
+
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    list of np.ndarray
+        float32 array of shape (classes, rows, columns) of each file, None if the file could not be read.
+    """
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(heatmap_paths), 1))
+    batches = [heatmap_paths[idx::n_process] for idx in range(n_process)]
+    jobs = [(batch, window, class_names, group_name) for batch in batches]
+    if n_process == 1:
+        results = list(map(_read_heatmap_windows, jobs))
+    else:
+        with multiprocessing.Pool(processes=n_process) as pool:
+            results = pool.map(_read_heatmap_windows, jobs, chunksize=1)
+    windows = [None] * len(heatmap_paths)
+    for idx, batch_windows in enumerate(results):
+        windows[idx::n_process] = batch_windows
+    return windows
@@ -1,5 +1,11 @@
 import h5py, csv, glob
+import multiprocessing
+import numpy as np
 from submodule_utils import *
+from submodule_utils.predictions import (
+        iter_prediction_chunks, group_indices, PREDICTION_CHUNK_SIZE)
+from submodule_utils.metadata.heatmap_store import (
+        HeatmapStorageOptions, write_heatmap_grid, write_heatmap_pyramid, get_heatmap_path)
 from openslide import OpenSlide
 
 def get_list_from_probability_string(orig_string):
@@ -18,55 +24,176 @@ def get_tile_dimensions(os_slide, patch_size):
     return int(width / patch_size), int(height / patch_size)
 
 
-def create_hdf_datasets(hdf, os_slide, patch_size, magnification, CategoryEnum):
+def create_hdf_datasets(hdf, os_slide, patch_size, magnification, CategoryEnum,
+                        storage_options=None):
+    return create_class_datasets(hdf, os_slide, patch_size, magnification,
+                                 [c.name for c in CategoryEnum], storage_options)
+
+
+def create_class_datasets(hdf, os_slide, patch_size, magnification, class_names,
+                          storage_options=None):
+    """Create the (tile_height, tile_width) dataset of each class in the {patch_size}/{magnification} group.
+
+    Parameters
+    ----------
+    storage_options : HeatmapStorageOptions
+        How the datasets are stored. Defaults to contiguous float32.
+    """
+    storage_options = storage_options or HeatmapStorageOptions()
     tile_width, tile_height = get_tile_dimensions(os_slide, patch_size)
     group_name = "{}/{}".format(patch_size, magnification)
     group = hdf.require_group(group_name)
     datasets = {}
-    for c in CategoryEnum:
-        if c.name in group:
-            del group[c.name]
-        datasets[c.name] = group.create_dataset(c.name,
-                                                (tile_height, tile_width,), dtype='f')
+    for name in class_names:
+        if name in group:
+            del group[name]
+        datasets[name] = storage_options.create_dataset(group, name,
+                                                        (tile_height, tile_width,))
     return datasets
 
 
-def generate_heatmaps(csv_path, patch_pattern, CategoryEnum, slides_path, heatmap_location):
-    reader = csv.reader(open(csv_path))
-    slides = {}
-    for idx, line in enumerate(reader):
-        if idx < 1:
-            continue
-        file_name, predicted_label, real_label, probability, _ = line
-        patch_pattern = create_patch_pattern(patch_pattern)
-        patch_id = create_patch_id(file_name, patch_pattern)
-        slide_id = get_slide_by_patch_id(patch_id, patch_pattern)
-        patch_size = get_patch_size_by_patch_id(patch_id, patch_pattern)
-
-        tile_y, tile_x = get_patch_tile_by_patch_id(patch_id, patch_size)
-        probabilities = get_list_from_probability_string(probability)
-        if slide_id in slides:
-            slides[slide_id]['data'].append([tile_x, tile_y, probabilities])
-        else:
-            slides[slide_id] = {'meta': {'magnification': get_magnification_by_patch_id(patch_id, patch_pattern),
-                                         'patch_size': patch_size},
-                                'data': []}
-
-    for key, value in slides.items():
-        heatmap_filepath = os.path.join(heatmap_location, f'heatmap.0.{key}.h5')
-        hdf = h5py.File(heatmap_filepath, 'w')
-        try:
-            slide_path = glob.glob(f"{os.path.join(slides_path, key)}.*")[0]
-            os_slide = OpenSlide(slide_path)
-        except:
-            print(f"could not find/open {key} at {slides_path}")
-            continue
+def get_heatmap_grid(tile_shape, tiles, probabilities, fill_value=0.):
+    """Scatter the probabilities of the patches of a slide into a (classes, tile_height, tile_width) grid in one vectorized pass.
+
+    Parameters
+    ----------
+    tile_shape : tuple of int
+        (tile_height, tile_width) of the slide.
+
+    tiles : np.ndarray
+        int array of shape (n, 2) with the (row, column) tile of each patch.
+
+    probabilities : np.ndarray
+        Array of shape (n, classes) with the probabilities of each patch.
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of shape (classes, tile_height, tile_width). Tiles without a patch are fill_value. Patches outside of the grid are ignored.
+    """
+    tile_height, tile_width = tile_shape
+    rows, cols = tiles[:, 0], tiles[:, 1]
+    inside = (rows >= 0) & (rows < tile_height) & (cols >= 0) & (cols < tile_width)
+    grid = np.full((probabilities.shape[1], tile_height, tile_width), fill_value,
+                   dtype=np.float32)
+    grid[:, rows[inside], cols[inside]] = probabilities[inside].T
+    return grid
+
+
+class HeatmapRecords(object):
+    """Patch predictions grouped by slide for heatmap generation, built chunk by chunk so it can be fed by iter_prediction_chunks or a PredictionPipeline.
+    """
+    def __init__(self, class_names):
+        self.class_names = class_names
+        self.slides = {}
+
+    def update(self, chunk):
+        """Add the patches of a PredictionChunk.
+        """
+        # (row, column) tile of each patch is (y, x) divided by its patch size
+        tiles = chunk.coords[:, ::-1] // chunk.patch_sizes[:, None]
+        probabilities = chunk.probabilities[:, :len(self.class_names)]
+        for slide_id, idx, rows in zip(*group_indices(chunk.slide_ids)):
+            if slide_id not in self.slides:
+                self.slides[slide_id] = {'meta': {'magnification': int(chunk.magnifications[idx]),
+                                                  'patch_size': int(chunk.patch_sizes[idx])},
+                                         'data': ([], [])}
+            self.slides[slide_id]['data'][0].append(tiles[rows])
+            self.slides[slide_id]['data'][1].append(probabilities[rows])
+        return self
+
+    def get_slides(self):
+        """Get the records in the format of read_heatmap_records.
+        """
+        return {slide_id: {'meta': slide['meta'],
+                           'data': (np.concatenate(slide['data'][0]),
+                                    np.concatenate(slide['data'][1]))}
+                for slide_id, slide in self.slides.items()}
+
+
+def read_heatmap_records(csv_path, patch_pattern, class_names, chunk_size=PREDICTION_CHUNK_SIZE):
+    """Read the patch predictions of a CSV, or of a prediction store converted from it, grouped by slide. The CSV is parsed in chunks by iter_prediction_chunks.
+
+    Returns
+    -------
+    dict
+        {slide_id: {'meta': {'magnification': int, 'patch_size': int}, 'data': (tiles, probabilities)}} where tiles is an int array of shape (n, 2) of the (row, column) tile of each patch and probabilities is a float32 array of shape (n, classes).
+    """
+    records = HeatmapRecords(class_names)
+    for chunk in iter_prediction_chunks(csv_path, patch_pattern, chunk_size=chunk_size):
+        records.update(chunk)
+    return records.get_slides()
+
+
+def generate_slide_heatmap(slide_id, meta, data, class_names, slides_path, heatmap_location,
+                           storage_options=None, pyramid=True):
+    """Write the heatmap of a single slide, each class dataset is written once.
+
+    Returns
+    -------
+    bool
+        Whether the heatmap was written.
+    """
+    try:
+        slide_path = glob.glob(f"{os.path.join(slides_path, slide_id)}.*")[0]
+        os_slide = OpenSlide(slide_path)
+    except:
+        print(f"could not find/open {slide_id} at {slides_path}")
+        return False
+    heatmap_filepath = get_heatmap_path(heatmap_location, slide_id)
+    with h5py.File(heatmap_filepath, 'w') as hdf:
+        storage_options = storage_options or HeatmapStorageOptions()
+        datasets = create_class_datasets(hdf, os_slide, meta['patch_size'],
+                                         meta['magnification'], class_names, storage_options)
+        tile_width, tile_height = get_tile_dimensions(os_slide, meta['patch_size'])
+        grid = get_heatmap_grid((tile_height, tile_width), *data, fill_value=np.nan)
+        for idx, name in enumerate(class_names):
+            write_heatmap_grid(datasets[name], grid[idx], storage_options)
+        if pyramid:
+            group = hdf["{}/{}".format(meta['patch_size'], meta['magnification'])]
+            write_heatmap_pyramid(group, class_names, grid, storage_options)
+    os_slide.close()
+    return True
+
+
+def _generate_slide_heatmap(args):
+    return generate_slide_heatmap(*args)
+
+
+def generate_heatmaps(csv_path, patch_pattern, CategoryEnum, slides_path, heatmap_location,
+                      n_process=None, storage_options=None, pyramid=True):
+    """Generate the heatmap.0.{slide_id}.h5 file of every slide in a prediction CSV. Slides are written concurrently on a process pool.
+
+    Parameters
+    ----------
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    storage_options : HeatmapStorageOptions
+        How the class datasets are stored, i.e. HeatmapStorageOptions.compact(). Defaults to contiguous float32.
 
-        datasets = create_hdf_datasets(hdf, os_slide, slides[key]['meta']['patch_size'],
-                                       slides[key]['meta']['magnification'], CategoryEnum)
+    pyramid : bool
+        Whether to also write the mean and max pyramid of each class grid for zoomed-out reads.
+    """
+    class_names = [c.name for c in CategoryEnum]
+    slides = read_heatmap_records(csv_path, patch_pattern, class_names)
+    return write_heatmaps(slides, class_names, slides_path, heatmap_location,
+                          n_process=n_process, storage_options=storage_options, pyramid=pyramid)
 
-        for record in slides[key]['data']:
-            for idx, c in enumerate(CategoryEnum):
-                datasets[c.name][record[0], record[1]] = record[2][idx]
 
+def write_heatmaps(slides, class_names, slides_path, heatmap_location, n_process=None,
+                   storage_options=None, pyramid=True):
+    """Write the heatmap of every slide of records read by read_heatmap_records or HeatmapRecords. Slides are written concurrently on a process pool.
 
+    Returns
+    -------
+    list of bool
+        Whether the heatmap of each slide was written.
+    """
+    jobs = [(slide_id, slide['meta'], slide['data'], class_names, slides_path, heatmap_location,
+             storage_options, pyramid) for slide_id, slide in slides.items()]
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if n_process == 1:
+        return list(map(_generate_slide_heatmap, jobs))
+    with multiprocessing.Pool(processes=n_process) as pool:
+        return pool.map(_generate_slide_heatmap, jobs, chunksize=1)
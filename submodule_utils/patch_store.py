@@ -0,0 +1,365 @@
+"""Storage of the patch paths extracted from a slide in HDF5 files.
+
+There are two layouts of the patch HDF5 file. Both have the attribute patch_size.
+
+Version 1 has a single dataset 'paths' of full patch path strings.
+
+Version 2 has the attribute format_version=2 and stores the patches as
+
+```
+Attribute prefix: directory prefix shared by all patch paths, ending with '/'
+Attribute pattern: file name pattern of the patches i.e. '{x}_{y}.png'
+Dataset x, y: int32 top-left coordinates of each patch
+Dataset subdirs: directories of the patches relative to prefix
+Dataset subdir_index: index in subdirs of each patch
+```
+
+so the path of patch i is prefix + subdirs[subdir_index[i]] + pattern.format(x=x[i], y=y[i]). The datasets are chunked and compressed, and are resizable so they can be appended to by PatchStoreWriter. The attribute n_patches is the number of patches committed to the file.
+"""
+import os
+import re
+import collections.abc
+
+import h5py
+import numpy as np
+
+PATCH_STORE_VERSION = 2
+PATCH_STORE_CHUNK_SIZE = 16384
+PATCH_STORE_COMPRESSION = 'gzip'
+PATCH_STORE_COMPRESSION_OPTS = 4
+PATCH_PATH_REGEX = re.compile(
+        r"^(.*/)?(\d+)_(\d+)(\.[^./\n]*)?$", re.MULTILINE)
+# Coordinates must not have leading zeros to be written without loss, paths
+# that do not match are stored in the version 1 layout.
+STRICT_PATCH_PATH_REGEX = re.compile(
+        r"^(.*/)?(0|[1-9]\d*)_(0|[1-9]\d*)(\.[^./\n]*)?$", re.MULTILINE)
+
+
+def split_patch_paths(paths, strict=False):
+    """Split patch paths into their directories, coordinates and extensions in one regex pass.
+
+    Parameters
+    ----------
+    paths : list of str
+
+    strict : bool
+        Whether to reject coordinates with leading zeros, which can not be written back exactly.
+
+    Returns
+    -------
+    tuple
+        A tuple of
+         - dirs (np.ndarray of str) directory of each patch ending with '/'
+         - coords (np.ndarray) int64 array of shape (len(paths), 2) with the (x, y) of each patch
+         - extensions (set of str) extensions of the patches
+
+    Raises
+    ------
+    ValueError
+        If a path does not have a file name of the form {x}_{y}.{extension}
+    """
+    if len(paths) == 0:
+        return np.zeros(0, dtype=str), np.zeros((0, 2), dtype=np.int64), set()
+    regex = STRICT_PATCH_PATH_REGEX if strict else PATCH_PATH_REGEX
+    matches = regex.findall('\n'.join(paths))
+    if len(matches) != len(paths):
+        raise ValueError(f"Only {len(matches)} of {len(paths)} patch paths "
+                         "have file names of the form {x}_{y}.{extension}")
+    dirs, xs, ys, extensions = zip(*matches)
+    coords = np.stack([np.array(xs, dtype=np.int64),
+                       np.array(ys, dtype=np.int64)], axis=1)
+    return np.array(dirs), coords, set(extensions)
+
+
+def create_resizable_dataset(hf, name, dtype, chunk_size=PATCH_STORE_CHUNK_SIZE):
+    """Create an empty, resizable, chunked and compressed 1D dataset.
+    """
+    return hf.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                             chunks=(chunk_size,), shuffle=True,
+                             compression=PATCH_STORE_COMPRESSION,
+                             compression_opts=PATCH_STORE_COMPRESSION_OPTS)
+
+
+def append_to_dataset(dataset, data):
+    """Resize a 1D dataset and write data at its end.
+    """
+    n = dataset.shape[0]
+    dataset.resize((n + len(data),))
+    dataset[n:] = data
+
+
+def get_dir_prefix(dirs):
+    """Get the longest common prefix of directories that ends with '/'.
+    """
+    prefix = os.path.commonprefix(list(dirs))
+    return prefix[:prefix.rfind('/') + 1]
+
+
+def encode_patch_paths(paths):
+    """Split patch paths for the version 2 layout.
+
+    Returns
+    -------
+    tuple
+        A tuple of
+         - dirs (np.ndarray of str) directory of each patch ending with '/'
+         - coords (np.ndarray) int64 array of shape (len(paths), 2) with the (x, y) of each patch
+         - extension (str or None) extension of the patches, None if there are no paths
+
+    Raises
+    ------
+    ValueError
+        If the paths do not fit the version 2 layout.
+    """
+    dirs, coords, extensions = split_patch_paths(paths, strict=True)
+    if len(extensions) > 1:
+        raise ValueError(f"Patch paths have more than one extension {extensions}")
+    if coords.size > 0 and coords.max() > np.iinfo(np.int32).max:
+        raise ValueError("Patch coordinates do not fit in int32")
+    return dirs, coords, (extensions.pop() if extensions else None)
+
+
+def create_patch_store(hf, patch_size, prefix, extension, chunk_size=PATCH_STORE_CHUNK_SIZE):
+    """Create the empty datasets and attributes of the version 2 layout in an open HDF5 file.
+    """
+    hf.attrs['format_version'] = PATCH_STORE_VERSION
+    hf.attrs['patch_size'] = patch_size
+    hf.attrs['prefix'] = prefix
+    hf.attrs['pattern'] = '{x}_{y}' + extension
+    hf.attrs['n_patches'] = 0
+    for name in ['x', 'y', 'subdir_index']:
+        create_resizable_dataset(hf, name, np.int32, chunk_size)
+    hf.create_dataset('subdirs', shape=(0,), maxshape=(None,), chunks=(64,),
+                      dtype=h5py.string_dtype())
+
+
+def write_patch_store(hf, paths, patch_size, chunk_size=PATCH_STORE_CHUNK_SIZE):
+    """Write patch paths to an open HDF5 file in the version 2 layout. If the file already has patches in the version 2 layout the paths are appended to them.
+
+    Patches past the n_patches attribute, that is patches of a batch that was being written when a process was interrupted, are overwritten.
+
+    Parameters
+    ----------
+    hf : h5py.File
+
+    paths : list of str
+
+    patch_size : int
+
+    chunk_size : int
+        Number of patches per chunk.
+
+    Raises
+    ------
+    ValueError
+        If the paths do not fit the version 2 layout, or do not match the patches already in the file. Nothing is written in this case.
+    """
+    dirs, coords, extension = encode_patch_paths(paths)
+    unique_dirs, inverse = np.unique(dirs, return_inverse=True)
+    if 'x' not in hf:
+        if len(hf.keys()) > 0:
+            raise ValueError(f"{hf.filename} is not a version 2 patch file")
+        create_patch_store(hf, patch_size, get_dir_prefix(unique_dirs),
+                           extension or '.png', chunk_size=chunk_size)
+    elif hf.attrs['patch_size'] != patch_size:
+        raise ValueError(f"{hf.filename} has patch size {hf.attrs['patch_size']} not {patch_size}")
+    elif extension is not None and hf.attrs['pattern'] != '{x}_{y}' + extension:
+        raise ValueError(f"{hf.filename} has patches of pattern {hf.attrs['pattern']}")
+    if len(paths) == 0:
+        return
+    # move the prefix up if a directory is not under it
+    prefix = hf.attrs['prefix']
+    new_prefix = get_dir_prefix([prefix, *unique_dirs])
+    subdirs = list(hf['subdirs'].asstr()[:])
+    if new_prefix != prefix:
+        moved = prefix[len(new_prefix):]
+        subdirs = [moved + subdir for subdir in subdirs]
+        if len(subdirs) > 0:
+            hf['subdirs'][:] = subdirs
+        hf.attrs['prefix'] = new_prefix
+    subdir_ids = {subdir: idx for idx, subdir in enumerate(subdirs)}
+    new_subdirs = []
+    for d in unique_dirs:
+        subdir = d[len(new_prefix):]
+        if subdir not in subdir_ids:
+            subdir_ids[subdir] = len(subdir_ids)
+            new_subdirs.append(subdir)
+    if len(new_subdirs) > 0:
+        append_to_dataset(hf['subdirs'], new_subdirs)
+    subdir_index = np.array([subdir_ids[d[len(new_prefix):]] for d in unique_dirs],
+                            dtype=np.int32)[inverse]
+    n_patches = int(hf.attrs['n_patches'])
+    for name, data in [('x', coords[:, 0]), ('y', coords[:, 1]),
+                       ('subdir_index', subdir_index)]:
+        hf[name].resize((n_patches,))
+        append_to_dataset(hf[name], data)
+    hf.attrs['n_patches'] = n_patches + len(paths)
+
+
+class PatchStoreWriter(object):
+    """Streaming writer of a patch HDF5 file in the version 2 layout.
+
+    Paths are buffered and written in batches of batch_size, and the file is flushed after each batch so memory is bounded by the batch size instead of the number of patches of the slide. Opening an existing file in mode 'a' keeps appending to it; patches of a batch that was interrupted before it was committed are discarded.
+
+    ```
+    with PatchStoreWriter(hd5_path, patch_size) as writer:
+        for path in accepted_patch_paths:
+            writer.append([path])
+    ```
+    """
+    def __init__(self, hd5_path, patch_size, mode='a', batch_size=PATCH_STORE_CHUNK_SIZE,
+                 chunk_size=PATCH_STORE_CHUNK_SIZE):
+        """
+        Parameters
+        ----------
+        hd5_path : str
+            Path to the patch HDF5 file.
+
+        patch_size : int
+
+        mode : str
+            'a' to append to an existing file or 'w' to overwrite it.
+
+        batch_size : int
+            Number of buffered paths that triggers a write.
+
+        chunk_size : int
+            Number of patches per chunk of new datasets.
+        """
+        self.hd5_path = hd5_path
+        self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.file = h5py.File(hd5_path, mode)
+        if 'paths' in self.file:
+            self.file.close()
+            raise ValueError(f"Can not append to version 1 patch file {hd5_path}")
+        self.buffer = []
+
+    def __len__(self):
+        """Number of patches written and buffered.
+        """
+        return int(self.file.attrs.get('n_patches', 0)) + len(self.buffer)
+
+    def append(self, paths):
+        """Buffer patch paths, writing them once batch_size paths are buffered.
+        """
+        self.buffer.extend(paths)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered paths and flush the file to disk.
+        """
+        if len(self.buffer) > 0:
+            write_patch_store(self.file, self.buffer, self.patch_size,
+                              chunk_size=self.chunk_size)
+            self.buffer = []
+        self.file.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PatchStore(collections.abc.Sequence):
+    """Lazy reader of a patch HDF5 file in either layout.
+
+    Indexing with an int returns a patch path and indexing with a slice returns a list of patch paths. Only the requested patches are read and decoded. The coordinates of version 2 files are read without building any paths.
+    """
+    def __init__(self, hd5_path):
+        """
+        Parameters
+        ----------
+        hd5_path : str
+            Path to the patch HDF5 file.
+        """
+        self.hd5_path = hd5_path
+        self.file = h5py.File(hd5_path, 'r')
+        self.version = int(self.file.attrs.get('format_version', 1))
+        self.patch_size = self.file.attrs['patch_size']
+        if self.version == 1:
+            self.chunk_size = PATCH_STORE_CHUNK_SIZE
+        else:
+            self.prefix = self.file.attrs['prefix']
+            self.pattern = self.file.attrs['pattern']
+            # virtual datasets of consolidated shards are not chunked
+            self.chunk_size = (self.file['x'].chunks or (PATCH_STORE_CHUNK_SIZE,))[0]
+            self.subdirs = [self.prefix + subdir for subdir in
+                            self.file['subdirs'].asstr()[:]]
+
+    def __len__(self):
+        if self.version == 1:
+            return self.file['paths'].shape[0]
+        return int(self.file.attrs['n_patches'])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.get_paths(idx)
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError
+        return self.get_paths(slice(idx, idx + 1))[0]
+
+    def __iter__(self):
+        for paths in self.iter_chunks():
+            yield from paths
+
+    def iter_chunks(self):
+        """Iterate over the patch paths one chunk of the file at a time.
+        """
+        for start in range(0, len(self), self.chunk_size):
+            yield self.get_paths(slice(start, start + self.chunk_size))
+
+    def get_paths(self, selection=slice(None)):
+        """Get the patch paths in a slice.
+
+        Returns
+        -------
+        list of str
+        """
+        if self.version == 1:
+            return [path.decode("utf-8") if isinstance(path, bytes) else path
+                    for path in self.file['paths'][selection]]
+        selection = self._clip(selection)
+        coords = self.get_coords(selection)
+        dirs = [self.subdirs[i] for i in self.file['subdir_index'][selection]]
+        return [d + self.pattern.format(x=x, y=y)
+                for d, (x, y) in zip(dirs, coords.tolist())]
+
+    def get_coords(self, selection=slice(None)):
+        """Get the top-left coordinates of the patches in a slice.
+
+        Returns
+        -------
+        np.ndarray
+            int64 array of shape (n, 2) with the (x, y) of each patch.
+        """
+        if self.version == 1:
+            return split_patch_paths(self.get_paths(selection))[1]
+        selection = self._clip(selection)
+        return np.stack([self.file['x'][selection],
+                         self.file['y'][selection]], axis=1).astype(np.int64)
+
+    def _clip(self, selection):
+        """Clip a slice to the committed patches of a version 2 file.
+        """
+        return slice(*selection.indices(len(self)))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
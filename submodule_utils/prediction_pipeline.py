@@ -0,0 +1,140 @@
+"""Single pass over a prediction CSV feeding several consumers.
+
+A consumer is any object with an update(chunk) method taking a PredictionChunk, such as HeatmapRecords, SlideVoteAccumulator, ThresholdSweepAccumulator or ClassHistograms. PredictionPipeline parses each chunk of the CSV once and passes it to every registered consumer, so another report costs no extra reading or parsing:
+
+```
+pipeline = PredictionPipeline(csv_path, patch_pattern)
+records = pipeline.register('heatmaps', HeatmapRecords(class_names))
+slides = pipeline.register('slides', SlideVoteAccumulator(len(class_names), threshold))
+histograms = pipeline.register('histograms', ClassHistograms(len(class_names)))
+pipeline.run()
+write_heatmaps(records.get_slides(), class_names, slides_path, heatmap_location)
+accuracy.calculate_slide_level_accuracy(accumulator=slides)
+```
+
+The consumers of a chunk run concurrently on a thread pool while the next chunk is parsed. Each consumer receives the chunks in order, one at a time, and at most two chunks are in memory.
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from submodule_utils.predictions import iter_prediction_chunks, PREDICTION_CHUNK_SIZE
+
+DEFAULT_HISTOGRAM_BINS = 20
+
+
+class ClassHistograms(object):
+    """Histograms of the probability of each class, and counts of the predicted and real labels, over all patches.
+
+    Parameters
+    ----------
+    n_classes : int
+
+    bins : int
+        Number of bins of equal width over [0, 1].
+    """
+    def __init__(self, n_classes, bins=DEFAULT_HISTOGRAM_BINS):
+        self.n_classes = n_classes
+        self.bin_edges = np.linspace(0., 1., bins + 1)
+        self.counts = np.zeros((n_classes, bins), dtype=np.int64)
+        self.predicted_counts = np.zeros(n_classes, dtype=np.int64)
+        self.real_counts = np.zeros(n_classes, dtype=np.int64)
+
+    def update(self, chunk):
+        """Add the patches of a PredictionChunk.
+        """
+        bins = len(self.bin_edges) - 1
+        probabilities = chunk.probabilities[:, :self.n_classes]
+        # probability 1 falls in the last bin as with np.histogram
+        bin_index = np.clip((probabilities * bins).astype(np.int64), 0, bins - 1)
+        offsets = np.arange(self.n_classes) * bins
+        self.counts += np.bincount((bin_index + offsets).ravel(),
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+        for counts, labels in [(self.predicted_counts, chunk.predicted_labels),
+                               (self.real_counts, chunk.real_labels)]:
+            counts += np.bincount(labels, minlength=self.n_classes)[:self.n_classes]
+        return self
+
+
+class PredictionPipeline(object):
+    """Reader of a prediction CSV, or prediction store, that feeds each parsed chunk to the registered consumers.
+    """
+    def __init__(self, csv_file, patch_pattern, chunk_size=PREDICTION_CHUNK_SIZE,
+                 starting_line=1, concurrent=True):
+        """
+        Parameters
+        ----------
+        csv_file : str or iterable of list
+            Path to the prediction CSV or prediction store, or an iterable of already split lines such as a csv.reader.
+
+        patch_pattern : str or dict
+            Patch pattern of the patch paths in the CSV.
+
+        chunk_size : int
+            Number of lines per chunk.
+
+        starting_line : int
+            Number of lines to skip at the start, by default the header.
+
+        concurrent : bool
+            Whether to run the consumers of a chunk on a thread pool. Otherwise they run one after another in order of registration.
+        """
+        self.csv_file = csv_file
+        self.patch_pattern = patch_pattern
+        self.chunk_size = chunk_size
+        self.starting_line = starting_line
+        self.concurrent = concurrent
+        self.consumers = collections.OrderedDict()
+
+    def register(self, name, consumer):
+        """Register a consumer with an update(chunk) method.
+
+        Returns
+        -------
+        object
+            The consumer.
+
+        Raises
+        ------
+        ValueError
+            If a consumer is already registered with the name.
+        """
+        if name in self.consumers:
+            raise ValueError(f"A consumer is already registered as {name}")
+        self.consumers[name] = consumer
+        return consumer
+
+    def iter_chunks(self):
+        return iter_prediction_chunks(self.csv_file, self.patch_pattern,
+                                      chunk_size=self.chunk_size,
+                                      starting_line=self.starting_line)
+
+    def run(self):
+        """Read the predictions once and feed every chunk to every consumer.
+
+        Returns
+        -------
+        collections.OrderedDict
+            {name: consumer} of the registered consumers.
+        """
+        consumers = list(self.consumers.values())
+        if not self.concurrent or len(consumers) <= 1:
+            for chunk in self.iter_chunks():
+                for consumer in consumers:
+                    consumer.update(chunk)
+            return self.consumers
+        pending = []
+        with ThreadPoolExecutor(max_workers=len(consumers)) as executor:
+            try:
+                for chunk in self.iter_chunks():
+                    # consumers get the chunks in order, the next chunk is parsed while they run
+                    for future in pending:
+                        future.result()
+                    pending = [executor.submit(consumer.update, chunk) for consumer in consumers]
+                for future in pending:
+                    future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+        return self.consumers
@@ -0,0 +1,289 @@
+"""Binary storage of the patch predictions of a prediction CSV in an HDF5 file, so the CSV is parsed once.
+
+The patches are grouped by slide with the slides in sorted order, and stored column by column
+
+```
+Attribute format_version: PREDICTION_STORE_VERSION
+Attribute n_patches: number of patches
+Attribute n_classes: number of probabilities per patch
+Dataset slide_ids: slide IDs in sorted order
+Dataset slide_offsets: int64, the patches of slide i are rows slide_offsets[i] to slide_offsets[i + 1]
+Dataset slide_patch_sizes, slide_magnifications: int32 patch size and magnification of each slide, only if they are in the patch pattern
+Dataset slide_index: int32 index in slide_ids of each patch
+Dataset x, y: int32 top-left coordinates of each patch, -1 if the file name of the patch is not {x}_{y}
+Dataset predicted_labels, real_labels: int8 labels of each patch
+Dataset probabilities: float32 or float16 probabilities of shape (n_patches, n_classes)
+```
+
+Patch paths are not stored. PredictionStore reads the patches of a slide as a single slice, and iter_prediction_chunks reads a prediction store as it reads a CSV so heatmaps and accuracy accept either.
+"""
+import os
+
+import h5py
+import numpy as np
+
+from submodule_utils.predictions import (
+        PredictionChunk, iter_prediction_chunks, encode_slide_ids, PREDICTION_CHUNK_SIZE)
+
+PREDICTION_STORE_VERSION = 1
+PREDICTION_STORE_CHUNK_SIZE = 16384
+PREDICTION_STORE_COMPRESSION = 'gzip'
+PREDICTION_STORE_COMPRESSION_OPTS = 4
+PREDICTION_STORE_DTYPES = {
+    'slide_index': np.int32,
+    'x': np.int32,
+    'y': np.int32,
+    'predicted_labels': np.int8,
+    'real_labels': np.int8,
+}
+
+
+def is_prediction_store(path):
+    """Whether a path is a prediction store rather than a prediction CSV.
+    """
+    return os.path.isfile(path) and h5py.is_hdf5(path)
+
+
+def create_patch_datasets(hf, n_patches, n_classes, dtype, layout='compressed'):
+    """Create the datasets of the patches.
+
+    Parameters
+    ----------
+    layout : str
+        'compressed' for chunked, compressed and resizable datasets as in the store, 'chunked' for uncompressed resizable datasets, or 'contiguous' for uncompressed datasets of fixed size that are cheap to write in any order.
+    """
+    chunk_size = PREDICTION_STORE_CHUNK_SIZE
+    if layout == 'contiguous':
+        kwargs = {}
+    elif layout == 'chunked':
+        kwargs = dict(maxshape=(None,), chunks=(chunk_size,))
+    else:
+        kwargs = dict(maxshape=(None,), chunks=(chunk_size,), shuffle=True,
+                      compression=PREDICTION_STORE_COMPRESSION,
+                      compression_opts=PREDICTION_STORE_COMPRESSION_OPTS)
+    for name, column_dtype in PREDICTION_STORE_DTYPES.items():
+        hf.create_dataset(name, shape=(n_patches,), dtype=column_dtype, **kwargs)
+    if 'maxshape' in kwargs:
+        kwargs.update(maxshape=(None, n_classes), chunks=(chunk_size, n_classes))
+    hf.create_dataset('probabilities', shape=(n_patches, n_classes), dtype=dtype, **kwargs)
+
+
+def get_chunk_columns(chunk, codes, dtype):
+    """Get the columns of the patches of a PredictionChunk as written to the store.
+    """
+    for labels in [chunk.predicted_labels, chunk.real_labels]:
+        if labels.size > 0 and (labels.min() < 0 or labels.max() > np.iinfo(np.int8).max):
+            raise ValueError("Labels do not fit in int8")
+    if chunk.coords.size > 0 and chunk.coords.max() > np.iinfo(np.int32).max:
+        raise ValueError("Patch coordinates do not fit in int32")
+    return {
+        'slide_index': codes,
+        'x': chunk.coords[:, 0],
+        'y': chunk.coords[:, 1],
+        'predicted_labels': chunk.predicted_labels,
+        'real_labels': chunk.real_labels,
+        'probabilities': chunk.probabilities.astype(dtype),
+    }
+
+
+def convert_predictions(csv_file, output_path, patch_pattern, dtype=np.float32,
+                        chunk_size=PREDICTION_CHUNK_SIZE, starting_line=1):
+    """Convert a prediction CSV into a prediction store.
+
+    The CSV is parsed once, chunk by chunk, into an uncompressed temporary file of the patches in CSV order. The patches are then copied grouped by slide into a second uncompressed temporary file, where writing the rows of a slide at its cursor costs no recompression, and this file is compressed into the store sequentially, a whole number of chunks at a time. Memory is bounded by the chunk size.
+
+    Parameters
+    ----------
+    csv_file : str or iterable of list
+        Path to the prediction CSV, or an iterable of already split lines such as a csv.reader.
+
+    output_path : str
+        Path of the prediction store.
+
+    patch_pattern : str or dict
+        Patch pattern of the patch paths in the CSV.
+
+    dtype : np.dtype
+        np.float32 or np.float16 for the probabilities.
+
+    Returns
+    -------
+    int
+        Number of patches.
+
+    Raises
+    ------
+    ValueError
+        If there are no predictions, or labels do not fit in int8 or coordinates in int32. Nothing is written in this case.
+    """
+    unsorted_path = f"{output_path}.{os.getpid()}.unsorted.tmp"
+    grouped_path = f"{output_path}.{os.getpid()}.grouped.tmp"
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    slide_index = {}
+    patch_sizes = []
+    magnifications = []
+    has_meta = {}
+    try:
+        with h5py.File(unsorted_path, 'w') as hf:
+            for chunk in iter_prediction_chunks(csv_file, patch_pattern, chunk_size=chunk_size,
+                                                starting_line=starting_line):
+                if 'x' not in hf:
+                    create_patch_datasets(hf, 0, chunk.probabilities.shape[1], dtype,
+                                          layout='chunked')
+                    has_meta = {'slide_patch_sizes': chunk.patch_sizes is not None,
+                                'slide_magnifications': chunk.magnifications is not None}
+                n_slides = len(slide_index)
+                codes = encode_slide_ids(chunk.slide_ids, slide_index)
+                # patch size and magnification of the first patch of each new slide
+                _, first = np.unique(codes[codes >= n_slides], return_index=True)
+                first = np.flatnonzero(codes >= n_slides)[first]
+                if chunk.patch_sizes is not None:
+                    patch_sizes.extend(chunk.patch_sizes[first].tolist())
+                if chunk.magnifications is not None:
+                    magnifications.extend(chunk.magnifications[first].tolist())
+                for name, data in get_chunk_columns(chunk, codes, dtype).items():
+                    n = hf[name].shape[0]
+                    hf[name].resize(n + len(data), axis=0)
+                    hf[name][n:] = data
+            if 'x' not in hf:
+                raise ValueError(f"No predictions in {csv_file}")
+            n_patches, n_classes = hf['probabilities'].shape
+            slide_ids = np.array(list(slide_index), dtype=object)
+            # rank of each slide in sorted order
+            order = np.argsort(slide_ids.astype(str), kind='stable')
+            ranks = np.empty(len(order), dtype=np.int64)
+            ranks[order] = np.arange(len(order))
+            counts = np.zeros(len(order), dtype=np.int64)
+            for start in range(0, n_patches, chunk_size):
+                counts += np.bincount(hf['slide_index'][start:start + chunk_size],
+                                      minlength=len(order))
+            offsets = np.concatenate([[0], np.cumsum(counts[order])])
+            names = list(PREDICTION_STORE_DTYPES) + ['probabilities']
+            with h5py.File(grouped_path, 'w') as grouped:
+                create_patch_datasets(grouped, n_patches, n_classes, dtype, layout='contiguous')
+                # next row to write of each slide by rank
+                cursors = offsets[:-1].copy()
+                for start in range(0, n_patches, chunk_size):
+                    columns = {name: hf[name][start:start + chunk_size] for name in names}
+                    columns['slide_index'] = ranks[columns['slide_index']]
+                    chunk_order = np.argsort(columns['slide_index'], kind='stable')
+                    columns = {name: data[chunk_order] for name, data in columns.items()}
+                    chunk_ranks, bounds = np.unique(columns['slide_index'], return_index=True)
+                    bounds = np.append(bounds, len(chunk_order))
+                    for rank, begin, end in zip(chunk_ranks, bounds[:-1], bounds[1:]):
+                        cursor = cursors[rank]
+                        for name, data in columns.items():
+                            grouped[name][cursor:cursor + end - begin] = data[begin:end]
+                        cursors[rank] += end - begin
+        os.remove(unsorted_path)
+        with h5py.File(grouped_path, 'r') as grouped, h5py.File(tmp_path, 'w') as out:
+            out.attrs['format_version'] = PREDICTION_STORE_VERSION
+            out.attrs['n_patches'] = n_patches
+            out.attrs['n_classes'] = n_classes
+            out.create_dataset('slide_ids', data=slide_ids[order].astype(str).tolist(),
+                               dtype=h5py.string_dtype())
+            out.create_dataset('slide_offsets', data=offsets)
+            for name, values in [('slide_patch_sizes', patch_sizes),
+                                 ('slide_magnifications', magnifications)]:
+                if has_meta.get(name):
+                    out.create_dataset(name, data=np.array(values, dtype=np.int32)[order])
+            create_patch_datasets(out, n_patches, n_classes, dtype)
+            # whole chunks so each chunk is compressed once
+            block_size = PREDICTION_STORE_CHUNK_SIZE * max(
+                    chunk_size // PREDICTION_STORE_CHUNK_SIZE, 1)
+            for start in range(0, n_patches, block_size):
+                for name in names:
+                    out[name][start:start + block_size] = grouped[name][start:start + block_size]
+        os.replace(tmp_path, output_path)
+    finally:
+        for path in [unsorted_path, grouped_path, tmp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    return n_patches
+
+
+class PredictionStore(object):
+    """Reader of a prediction store.
+
+    The patches of a slide are read as a single slice in O(1) with get_slide, and the whole store is read chunk by chunk with iter_chunks. Both give PredictionChunk like iter_prediction_chunks, with paths set to None.
+    """
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Path to the prediction store.
+        """
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.version = int(self.file.attrs['format_version'])
+        self.n_classes = int(self.file.attrs['n_classes'])
+        self.slide_ids = list(self.file['slide_ids'].asstr()[:])
+        self.slide_id_array = np.array(self.slide_ids, dtype=object)
+        self.slide_offsets = self.file['slide_offsets'][:]
+        self.slide_positions = {slide_id: idx for idx, slide_id in enumerate(self.slide_ids)}
+        self.patch_sizes = self.read_slide_meta('slide_patch_sizes')
+        self.magnifications = self.read_slide_meta('slide_magnifications')
+
+    def read_slide_meta(self, name):
+        return self.file[name][:].astype(np.int64) if name in self.file else None
+
+    def __len__(self):
+        return int(self.file.attrs['n_patches'])
+
+    def __contains__(self, slide_id):
+        return slide_id in self.slide_positions
+
+    def get_slide_slice(self, slide_id):
+        """Get the rows of the patches of a slide.
+        """
+        idx = self.slide_positions[slide_id]
+        return slice(int(self.slide_offsets[idx]), int(self.slide_offsets[idx + 1]))
+
+    def get_slide(self, slide_id):
+        """Get the patches of a slide.
+
+        Returns
+        -------
+        PredictionChunk
+        """
+        return self.get_rows(self.get_slide_slice(slide_id))
+
+    def get_rows(self, selection):
+        """Get the patches in a slice of rows.
+
+        Returns
+        -------
+        PredictionChunk
+        """
+        slide_index = self.file['slide_index'][selection]
+        get_meta = lambda meta: None if meta is None else meta[slide_index]
+        return PredictionChunk(
+            paths=None,
+            slide_ids=self.slide_id_array[slide_index],
+            predicted_labels=self.file['predicted_labels'][selection].astype(np.int64),
+            real_labels=self.file['real_labels'][selection].astype(np.int64),
+            probabilities=self.file['probabilities'][selection].astype(np.float32),
+            coords=np.stack([self.file['x'][selection],
+                             self.file['y'][selection]], axis=1).astype(np.int64),
+            patch_sizes=get_meta(self.patch_sizes),
+            magnifications=get_meta(self.magnifications))
+
+    def iter_chunks(self, chunk_size=PREDICTION_CHUNK_SIZE):
+        """Iterate over the patches chunk by chunk.
+
+        Yields
+        ------
+        PredictionChunk
+        """
+        for start in range(0, len(self), chunk_size):
+            yield self.get_rows(slice(start, start + chunk_size))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
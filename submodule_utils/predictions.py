@@ -0,0 +1,189 @@
+"""Chunked reading of the patch prediction CSV written by model evaluation.
+
+The CSV has a header line followed by one line per patch with the columns
+
+```
+path, predicted_label, real_label, probability, ...
+```
+
+where probability is a string of the form "[0.333 0.666]". The CSV is read in chunks of a fixed number of lines, and each chunk is parsed into arrays in bulk so memory is constant per chunk regardless of the size of the CSV.
+"""
+import collections
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from submodule_utils import create_patch_pattern
+
+PREDICTION_CHUNK_SIZE = 100000
+PREDICTION_COLUMNS = ['path', 'predicted_label', 'real_label', 'probability']
+
+PredictionChunk = collections.namedtuple('PredictionChunk', [
+    'paths', 'slide_ids', 'predicted_labels', 'real_labels', 'probabilities',
+    'coords', 'patch_sizes', 'magnifications'])
+PredictionChunk.__doc__ = """Parsed lines of a prediction CSV.
+
+paths, slide_ids : np.ndarray of str
+predicted_labels, real_labels : np.ndarray of int64
+probabilities : float32 np.ndarray of shape (n, classes)
+coords : int64 np.ndarray of shape (n, 2) with the (x, y) of each patch, -1 if the file name is not {x}_{y}
+patch_sizes, magnifications : np.ndarray of int64, or None if not in the patch pattern
+"""
+
+
+def parse_probabilities(probabilities):
+    """Parse probability strings of the form "[0.333 0.666]" into an array in one pass.
+
+    The brackets of the whole column are stripped at once and the values of all rows are parsed from a single joined string.
+
+    Parameters
+    ----------
+    probabilities : iterable of str
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of shape (n, classes).
+
+    Raises
+    ------
+    ValueError
+        If the strings do not all have the same number of probabilities.
+    """
+    probabilities = pd.Series(probabilities, dtype=object).astype(str)
+    n = len(probabilities)
+    if n == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    probabilities = probabilities.str.replace(r'[\[\]]', ' ', regex=True)
+    n_values = probabilities.str.count(r'\S+').to_numpy()
+    if (n_values != n_values[0]).any():
+        raise ValueError("Probability strings do not all have the same number of classes")
+    return np.array(' '.join(probabilities).split(),
+                    dtype=np.float32).reshape(n, int(n_values[0]))
+
+
+def group_indices(keys):
+    """Group the positions of equal keys.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+
+    Returns
+    -------
+    tuple
+        A tuple of
+         - unique_keys (np.ndarray) sorted unique keys
+         - first (np.ndarray) position of the first occurrence of each key
+         - groups (list of np.ndarray) positions of each key in order of appearance
+    """
+    unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(unique_keys)))[:-1]
+    return unique_keys, first, np.split(order, bounds)
+
+
+def encode_slide_ids(slide_ids, slide_index):
+    """Integer-encode slide IDs.
+
+    Parameters
+    ----------
+    slide_ids : np.ndarray of str
+
+    slide_index : dict
+        {slide_id: code} of the slides seen so far. Slides that are not in it are added in order of appearance.
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of the code of each slide ID.
+    """
+    # hash-based factorize gives codes in order of appearance without sorting the strings
+    inverse, unique_ids = pd.factorize(slide_ids)
+    codes = np.array([slide_index.setdefault(slide_id, len(slide_index))
+                      for slide_id in unique_ids], dtype=np.int64)
+    return codes[inverse]
+
+
+def parse_prediction_frame(frame, patch_pattern):
+    """Parse a data frame of prediction CSV lines.
+
+    Parameters
+    ----------
+    frame : pd.DataFrame
+        The first four columns are path, predicted_label, real_label and probability.
+
+    patch_pattern : dict
+        Dictionary describing the directory structure of the patch paths.
+
+    Returns
+    -------
+    PredictionChunk
+    """
+    frame = frame.iloc[:, :4]
+    frame.columns = PREDICTION_COLUMNS
+    paths = frame['path'].astype(str)
+    # the patch ID is the file name and the len(patch_pattern) directories above it
+    n_words = len(patch_pattern) + 1
+    words = paths.str.rsplit('/', n=n_words, expand=True).iloc[:, -n_words:]
+    words.columns = range(n_words)
+    get_word = lambda word: words[patch_pattern[word]] if word in patch_pattern else None
+    slide_ids = get_word('slide')
+    coords = words[n_words - 1].str.extract(r'^(\d+)_(\d+)').fillna(-1)
+    to_int = lambda series: None if series is None else series.astype(np.int64).to_numpy()
+    return PredictionChunk(
+        paths=paths.to_numpy(dtype=object),
+        slide_ids=None if slide_ids is None else slide_ids.to_numpy(dtype=object),
+        predicted_labels=to_int(frame['predicted_label']),
+        real_labels=to_int(frame['real_label']),
+        probabilities=parse_probabilities(frame['probability'].astype(str)),
+        coords=coords.astype(np.int64).to_numpy(),
+        patch_sizes=to_int(get_word('patch_size')),
+        magnifications=to_int(get_word('magnification')))
+
+
+def iter_prediction_chunks(csv_file, patch_pattern, chunk_size=PREDICTION_CHUNK_SIZE,
+                           starting_line=1):
+    """Read a prediction CSV in chunks.
+
+    Parameters
+    ----------
+    csv_file : str or iterable of list
+        Path to the prediction CSV or to a prediction store converted from it, or an iterable of already split lines such as a csv.reader.
+
+    patch_pattern : str or dict
+        Patch pattern of the patch paths in the CSV. Not used for a prediction store.
+
+    chunk_size : int
+        Number of lines per chunk.
+
+    starting_line : int
+        Number of lines to skip at the start, by default the header. Not used for a prediction store.
+
+    Yields
+    ------
+    PredictionChunk
+    """
+    # prediction_store imports this module
+    from submodule_utils.prediction_store import PredictionStore, is_prediction_store
+    if isinstance(csv_file, str) and is_prediction_store(csv_file):
+        with PredictionStore(csv_file) as store:
+            yield from store.iter_chunks(chunk_size)
+        return
+    patch_pattern = create_patch_pattern(patch_pattern)
+    if isinstance(csv_file, str):
+        try:
+            frames = pd.read_csv(csv_file, header=None, skiprows=starting_line,
+                                 usecols=range(4), dtype={0: str, 3: str},
+                                 chunksize=chunk_size)
+        except pd.errors.EmptyDataError:
+            # no lines after the header
+            return
+    else:
+        lines = itertools.islice(iter(csv_file), starting_line, None)
+        frames = (pd.DataFrame([line[:4] for line in chunk])
+                  for chunk in iter(lambda: list(itertools.islice(lines, chunk_size)), []))
+    for frame in frames:
+        if len(frame) > 0:
+            yield parse_prediction_frame(frame, patch_pattern)
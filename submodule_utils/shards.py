@@ -0,0 +1,178 @@
+"""Parallel writing of one logical HDF5 file as per-worker shards.
+
+Each worker writes its own shard {root}.shard{worker_id}.h5 next to the output {root}.h5 with the usual writers, i.e. PatchStoreWriter or GradCAMWriter, so no two processes write to the same file. consolidate_shards then writes {root}.h5 as an index of HDF5 virtual datasets that present the shards as a single file without copying their data:
+
+ - the datasets of a group with a commit attribute in SHARDED_DATASETS are concatenated along their first axis, up to the committed length of each shard, and the commit attribute is set to the total
+ - the subdirs of patch stores are merged into their union under the common prefix of the shards, and the subdir_index of each shard is remapped to it and copied, as the shards of workers that read different directories have different prefixes and subdirs
+ - other datasets and attributes must be the same in every shard and are copied from the first shard
+
+The shards must be kept next to the index file, which refers to them by relative path.
+"""
+import os
+import re
+import glob
+
+import h5py
+import numpy as np
+
+from submodule_utils.patch_store import get_dir_prefix
+
+SHARD_PATH_REGEX = re.compile(r"^(.*)\.shard(\d+)(\.[^./]*)$")
+# commit attribute of a group: datasets of the group that are concatenated
+SHARDED_DATASETS = {
+    'n_patches': ['x', 'y'],
+    'n_maps': ['maps', 'tiles'],
+}
+# datasets and attributes of patch stores merged by merge_subdirs
+MERGED_DATASETS = ['subdirs', 'subdir_index']
+MERGED_ATTRS = ['prefix']
+
+
+def get_shard_path(output_path, worker_id):
+    """Get the path of the shard a worker writes instead of output_path.
+    """
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.shard{worker_id}{ext}"
+
+
+def find_shards(output_path):
+    """Find the shards of output_path sorted by worker ID.
+    """
+    root, ext = os.path.splitext(output_path)
+    shards = []
+    for shard_path in glob.glob(f"{glob.escape(root)}.shard*{ext}"):
+        match = SHARD_PATH_REGEX.match(shard_path)
+        if match and match.group(1) == root and match.group(3) == ext:
+            shards.append((int(match.group(2)), shard_path))
+    return [shard_path for _, shard_path in sorted(shards)]
+
+
+def get_commit_attr(group):
+    for attr in SHARDED_DATASETS:
+        if attr in group.attrs:
+            return attr
+    return None
+
+
+def check_same(values, what):
+    first = values[0]
+    for value in values[1:]:
+        if not np.array_equal(np.asarray(value), np.asarray(first)):
+            raise ValueError(f"{what} differs between shards")
+
+
+def merge_subdirs(out_group, groups, counts):
+    """Write the union of the subdirs of patch store shards to out_group and their subdir_index remapped to it.
+    """
+    dirs = {}
+    subdir_index = []
+    for group, count in zip(groups, counts):
+        prefix = group.attrs['prefix']
+        shard_dirs = [prefix + subdir for subdir in group['subdirs'].asstr()[:]]
+        mapping = np.array([dirs.setdefault(shard_dir, len(dirs)) for shard_dir in shard_dirs],
+                           dtype=np.int32)
+        subdir_index.append(mapping[group['subdir_index'][:count]])
+    prefix = get_dir_prefix(dirs) if dirs else groups[0].attrs['prefix']
+    out_group.attrs['prefix'] = prefix
+    out_group.create_dataset('subdirs', data=[shard_dir[len(prefix):] for shard_dir in dirs],
+                             dtype=h5py.string_dtype())
+    out_group.create_dataset('subdir_index', data=np.concatenate(subdir_index),
+                             dtype=np.int32, compression=groups[0]['subdir_index'].compression)
+
+
+def consolidate_group(out_group, groups, shard_paths, index_dir):
+    """Write the virtual datasets and copies of a group of the shards to out_group.
+    """
+    commit_attr = get_commit_attr(groups[0])
+    sharded = SHARDED_DATASETS[commit_attr] if commit_attr else []
+    merged = commit_attr == 'n_patches' and 'subdirs' in groups[0]
+    for key, value in groups[0].attrs.items():
+        if key == commit_attr or (merged and key in MERGED_ATTRS):
+            continue
+        check_same([group.attrs[key] for group in groups], f"attribute {key} of {groups[0].name}")
+        out_group.attrs[key] = value
+    if commit_attr:
+        counts = [int(group.attrs[commit_attr]) for group in groups]
+        out_group.attrs[commit_attr] = sum(counts)
+    if merged:
+        merge_subdirs(out_group, groups, counts)
+    for name, obj in groups[0].items():
+        if isinstance(obj, h5py.Group):
+            consolidate_group(out_group.create_group(name), [group[name] for group in groups],
+                              shard_paths, index_dir)
+        elif merged and name in MERGED_DATASETS:
+            continue
+        elif name in sharded:
+            datasets = [group[name] for group in groups]
+            layout = h5py.VirtualLayout((sum(counts),) + obj.shape[1:], dtype=obj.dtype)
+            offset = 0
+            for shard_path, dataset, count in zip(shard_paths, datasets, counts):
+                if count == 0:
+                    continue
+                source = h5py.VirtualSource(os.path.relpath(shard_path, index_dir),
+                                            dataset.name, shape=dataset.shape,
+                                            dtype=dataset.dtype)
+                layout[offset:offset + count] = source[:count]
+                offset += count
+            out_group.create_virtual_dataset(name, layout)
+        else:
+            check_same([group[name][()] for group in groups], f"dataset {obj.name}")
+            out_group.copy(obj, name)
+
+
+def consolidate_shards(output_path, shard_paths=None):
+    """Write output_path as a virtual dataset index of the shards of the workers.
+
+    Parameters
+    ----------
+    output_path : str
+        Path of the index file.
+
+    shard_paths : list of str
+        Shards in order. Defaults to the shards found next to output_path by find_shards.
+
+    Returns
+    -------
+    list of str
+        Shards in the index.
+
+    Raises
+    ------
+    ValueError
+        If there are no shards, or datasets and attributes that are not concatenated differ between shards.
+    """
+    shard_paths = find_shards(output_path) if shard_paths is None else shard_paths
+    if len(shard_paths) == 0:
+        raise ValueError(f"no shards of {output_path}")
+    index_dir = os.path.dirname(os.path.abspath(output_path))
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    shards = [h5py.File(shard_path, 'r') for shard_path in shard_paths]
+    try:
+        with h5py.File(tmp_path, 'w') as hf:
+            consolidate_group(hf, shards, [os.path.abspath(path) for path in shard_paths],
+                              index_dir)
+        os.replace(tmp_path, output_path)
+    finally:
+        for shard in shards:
+            shard.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return shard_paths
+
+
+def consolidate_shard_dir(directory):
+    """Consolidate the shards of every file in a directory, i.e. the per-slide Grad-CAM files written by several workers.
+
+    Returns
+    -------
+    list of str
+        Paths of the index files.
+    """
+    output_paths = set()
+    for shard_path in glob.glob(os.path.join(directory, '*.shard*')):
+        match = SHARD_PATH_REGEX.match(shard_path)
+        if match:
+            output_paths.add(match.group(1) + match.group(3))
+    for output_path in sorted(output_paths):
+        consolidate_shards(output_path)
+    return sorted(output_paths)
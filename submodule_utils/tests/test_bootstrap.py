@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import pytest
+from sklearn.metrics import (
+        accuracy_score, cohen_kappa_score, confusion_matrix, f1_score, roc_auc_score)
+
+from submodule_utils.accuracy.bootstrap import (
+        get_confusion_matrices, get_confusion_metrics, get_batch_auc, get_average_ranks, bootstrap_metrics,
+        get_confidence_intervals, BOOTSTRAP_METRICS)
+from submodule_utils.accuracy.slide_level_accuracy import SlideLevelAccuracy
+from submodule_utils.tests.test_slide_level_accuracy import (
+        write_random_predictions, PATCH_PATTERN, SubtypeEnum)
+
+
+def get_random_slides(n_slides, n_classes, seed=0):
+    rng = np.random.default_rng(seed)
+    real_labels = rng.integers(0, n_classes, (8, n_slides))
+    votes = rng.integers(0, 5, (8, n_slides, n_classes))
+    votes[np.arange(8)[:, None], np.arange(n_slides), real_labels] += 2
+    votes[..., 0] += 1
+    return real_labels, votes / votes.sum(axis=2, keepdims=True)
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+def test_batch_metrics(n_classes):
+    real_labels, probabilities = get_random_slides(30, n_classes)
+    pred_labels = probabilities.argmax(axis=2)
+    conf_matrices = get_confusion_matrices(real_labels, pred_labels, n_classes)
+    metrics = get_confusion_metrics(conf_matrices)
+    aucs = get_batch_auc(real_labels, probabilities)
+    for r in range(len(real_labels)):
+        real, pred = real_labels[r], pred_labels[r]
+        assert np.array_equal(conf_matrices[r],
+                              confusion_matrix(real, pred, labels=range(n_classes)))
+        assert metrics['weighted_acc'][r] == pytest.approx(accuracy_score(real, pred) * 100)
+        assert metrics['kappa'][r] == pytest.approx(cohen_kappa_score(real, pred))
+        assert metrics['f1_score'][r] == pytest.approx(f1_score(real, pred, average='macro'))
+        if n_classes == 2:
+            expected_auc = roc_auc_score(real, probabilities[r, :, 1])
+        else:
+            expected_auc = roc_auc_score(real, probabilities[r], multi_class='ovr',
+                                         average='macro')
+        assert aucs[r] == pytest.approx(expected_auc)
+
+
+def test_get_average_ranks():
+    values = np.array([[0.3, 0.1, 0.3, 0.2, 0.3], [1., 1., 1., 1., 1.], [0.5, 0.4, 0.3, 0.2, 0.1]])
+    assert get_average_ranks(values).tolist() == [[4., 1., 4., 2., 4.], [3.] * 5,
+                                                  [5., 4., 3., 2., 1.]]
+
+
+def test_batch_auc_undefined():
+    real_labels = np.array([[0, 0, 0], [0, 1, 1]])
+    probabilities = np.full((2, 3, 2), 0.5)
+    aucs = get_batch_auc(real_labels, probabilities)
+    assert np.isnan(aucs[0])
+    assert aucs[1] == pytest.approx(0.5)
+
+
+def test_bootstrap_metrics():
+    real_labels, probabilities = get_random_slides(40, 3)
+    real_labels, probabilities = real_labels[0], probabilities[0]
+    samples = bootstrap_metrics(real_labels, probabilities, n_resamples=300, seed=1,
+                                n_process=1, block_size=64)
+    assert set(samples) == set(BOOTSTRAP_METRICS)
+    assert all(len(values) == 300 for values in samples.values())
+    parallel_samples = bootstrap_metrics(real_labels, probabilities, n_resamples=300, seed=1,
+                                         n_process=2, block_size=64)
+    for metric in BOOTSTRAP_METRICS:
+        assert np.array_equal(samples[metric], parallel_samples[metric], equal_nan=True)
+    other_samples = bootstrap_metrics(real_labels, probabilities, n_resamples=300, seed=2,
+                                      n_process=1, block_size=64)
+    assert not np.array_equal(samples['weighted_acc'], other_samples['weighted_acc'])
+    accuracy = accuracy_score(real_labels, probabilities.argmax(axis=1)) * 100
+    lower, upper = get_confidence_intervals(samples)['weighted_acc']
+    assert lower <= accuracy <= upper
+
+
+def test_bootstrap_confidence_intervals(output_dir, capsys):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_random_predictions(csv_path, n_slides=30, n_patches=1500)
+    accuracy = SlideLevelAccuracy(csv_path, PATCH_PATTERN, SubtypeEnum)
+    results = accuracy.bootstrap_confidence_intervals(n_resamples=200, n_process=1)
+    assert results['metric'].tolist() == BOOTSTRAP_METRICS
+    assert (results['lower'] <= results['upper']).all()
+    assert "CI Lower" in capsys.readouterr().out
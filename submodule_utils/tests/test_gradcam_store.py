@@ -0,0 +1,193 @@
+import os
+import threading
+import pytest
+import h5py
+import numpy as np
+
+from submodule_utils.metadata.gradcam_store import (
+        write_gradcam_h5, GradCAMWriter, AsyncWriter, GRADCAM_FORMAT_VERSION,
+        GRADCAM_CHUNK_MAPS, GradCAMStore, merge_gradcam_shards, merge_gradcam_shard_dirs)
+
+TILES = np.array([[3, 1], [0, 2], [0, 0], [2, 5]])
+MAPS = np.arange(len(TILES) * 32 * 32, dtype=np.float32).reshape(-1, 32, 32)
+
+
+@pytest.mark.parametrize("compression,compression_opts", [
+        ('lzf', None), ('gzip', 4), (None, None)])
+def test_write_gradcam_h5(compression, compression_opts, output_dir):
+    gradcam_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    write_gradcam_h5(gradcam_path, 512, 20, (4096, 2048), TILES, MAPS,
+                     compression, compression_opts)
+    with h5py.File(gradcam_path, 'r') as hdf:
+        group = hdf['512/20']
+        assert group.attrs['format_version'] == GRADCAM_FORMAT_VERSION
+        assert group.attrs['n_maps'] == len(TILES)
+        assert group['maps'].chunks == (GRADCAM_CHUNK_MAPS, 32, 32)
+        assert group['maps'].compression == compression
+        assert group['slide_diminsions'][()].tolist() == [4096, 2048]
+        # maps are sorted by tile
+        assert group['tiles'][()].tolist() == [[0, 0], [0, 2], [2, 5], [3, 1]]
+        assert np.array_equal(group['maps'][()], MAPS[[2, 1, 3, 0]])
+
+
+def test_write_gradcam_h5_invalid_compression(output_dir):
+    with pytest.raises(ValueError):
+        write_gradcam_h5(os.path.join(output_dir, 'VOA-1000A.h5'), 512, 20, (4096, 2048),
+                         TILES, MAPS, 'szip')
+
+
+def test_GradCAMWriter(tmp_path):
+    dimensions = {'VOA-1000A': (4096, 2048), 'VOA-2000B': (1024, 1024)}
+    writer = GradCAMWriter(str(tmp_path), dimensions.get, max_bytes=2 * MAPS[0].nbytes,
+                           expected_counts={'VOA-2000B': 1})
+    for tile, cam in zip(TILES, MAPS):
+        writer.append('VOA-1000A', 512, 20, tile, cam)
+        # the buffered maps are flushed when they exceed the budget
+        assert writer.buffered_bytes <= writer.max_bytes
+    # the third map exceeded the budget
+    assert len(writer.buffers['VOA-1000A']['maps']) == 1
+    gradcam_path = str(tmp_path / 'VOA-1000A.h5')
+    with h5py.File(gradcam_path, 'r') as hdf:
+        assert hdf['512/20'].attrs['n_maps'] == 3
+    writer.append('VOA-2000B', 256, 10, (0, 1), MAPS[0])
+    # the slide is flushed as soon as all of its maps are appended
+    assert 'VOA-2000B' not in writer.buffers
+    writer.append('VOA-3000C', 256, 10, (0, 1), MAPS[0])
+    writer.close()
+    assert writer.buffered_bytes == 0
+    assert sorted(os.listdir(tmp_path)) == ['VOA-1000A.h5', 'VOA-2000B.h5']
+    with h5py.File(gradcam_path, 'r') as hdf:
+        assert hdf['512/20'].attrs['n_maps'] == 4
+        assert hdf['512/20/tiles'][()].tolist() == TILES.tolist()
+        assert np.array_equal(hdf['512/20/maps'][()], MAPS)
+    with h5py.File(str(tmp_path / 'VOA-2000B.h5'), 'r') as hdf:
+        assert hdf['256/10/tiles'][()].tolist() == [[0, 1]]
+
+
+def test_GradCAMWriter_float64(tmp_path):
+    writer = GradCAMWriter(str(tmp_path), lambda slide_id: (4096, 2048),
+                           max_bytes=2 * MAPS[0].nbytes)
+    for tile, cam in zip(TILES, MAPS):
+        writer.append('VOA-1000A', 512, 20, tile, cam.astype(np.float64))
+        assert writer.buffered_bytes <= writer.max_bytes
+    writer.close()
+    assert writer.buffered_bytes == 0
+    with h5py.File(str(tmp_path / 'VOA-1000A.h5'), 'r') as hdf:
+        assert np.array_equal(hdf['512/20/maps'][()], MAPS)
+
+
+def test_GradCAMWriter_resume(tmp_path):
+    gradcam_path = str(tmp_path / 'VOA-1000A.h5')
+    with GradCAMWriter(str(tmp_path), lambda slide_id: (4096, 2048)) as writer:
+        for tile, cam in zip(TILES[:2], MAPS[:2]):
+            writer.append('VOA-1000A', 512, 20, tile, cam)
+    with h5py.File(gradcam_path, 'a') as hdf:
+        # rows written after the last commit
+        for name in ['maps', 'tiles']:
+            hdf['512/20'][name].resize(3, axis=0)
+    with GradCAMWriter(str(tmp_path), lambda slide_id: (4096, 2048)) as writer:
+        # the committed maps are kept and the map of the second tile is not written again
+        for tile, cam in zip(TILES[1:], MAPS[1:]):
+            writer.append('VOA-1000A', 512, 20, tile, cam)
+    with h5py.File(gradcam_path, 'r') as hdf:
+        assert hdf['512/20'].attrs['n_maps'] == 4
+        assert hdf['512/20/tiles'][()].tolist() == TILES.tolist()
+        assert np.array_equal(hdf['512/20/maps'][()], MAPS)
+
+
+def test_AsyncWriter():
+    release = threading.Event()
+    written = []
+
+    def write_fn(idx):
+        release.wait()
+        if idx == 3:
+            raise IOError("disk full")
+        written.append(idx)
+
+    writer = AsyncWriter(write_fn, n_threads=2, max_pending=4)
+    for idx in range(4):
+        writer.submit(idx)
+    # a fifth item blocks until one of the pending items is written
+    producer = threading.Thread(target=writer.submit, args=(4,))
+    producer.start()
+    producer.join(timeout=0.2)
+    assert producer.is_alive()
+    release.set()
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+    assert writer.drain() == (4, 1)
+    assert sorted(written) == [0, 1, 2, 4]
+    assert writer.close() == (4, 1)
+    # the writer threads are stopped
+    with pytest.raises(RuntimeError):
+        writer.executor.submit(write_fn, 5)
+
+
+def write_gradcam_v1(gradcam_path, tiles, maps):
+    """Write a file the way GradCAM_AIM did before the version 2 layout.
+    """
+    with h5py.File(gradcam_path, 'w') as hdf:
+        group = hdf.require_group('512/20')
+        grid = group.create_dataset('grad_cam', (4, 8, 32, 32), dtype='f')
+        coordinates = group.create_dataset('image_coordinates', (1,),
+                                           dtype=h5py.special_dtype(vlen=str))
+        group.create_dataset('slide_diminsions', data=np.array([4096., 2048.]))
+        for (row, col), cam in zip(tiles, maps):
+            grid[row, col] = cam
+        coordinates[0] = ''.join(f"{row}_{col}-" for row, col in tiles)
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_GradCAMStore(version, output_dir):
+    gradcam_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    if version == 1:
+        write_gradcam_v1(gradcam_path, TILES, MAPS)
+    else:
+        write_gradcam_h5(gradcam_path, 512, 20, (4096, 2048), TILES, MAPS)
+    with GradCAMStore(gradcam_path) as store:
+        assert store.version == version
+        assert (store.patch_size, store.magnification) == (512, 20)
+        assert store.slide_dimensions == (4096, 2048)
+        assert len(store) == 4
+        maps, found = store.get_maps([[2, 5], [1, 1], [3, 1]])
+        assert found.tolist() == [True, False, True]
+        assert np.array_equal(maps[0], MAPS[3])
+        assert np.isnan(maps[1]).all()
+        assert np.array_equal(maps[2], MAPS[0])
+        region = store.get_region(np.s_[0:3, 0:3])
+        assert region.shape == (3, 3, 32, 32)
+        assert np.array_equal(region[0, 0], MAPS[2])
+        assert np.array_equal(region[0, 2], MAPS[1])
+        assert np.isnan(region[1, 1]).all()
+        # open bounds are relative to the tile grid, which holds every tile of the file
+        n_cols = 8 if version == 1 else 6
+        assert store.get_grid_shape() == (4, n_cols)
+        region = store[:, 1:]
+        assert region.shape == (4, n_cols - 1, 32, 32)
+        assert np.array_equal(region[3, 0], MAPS[0])
+        assert np.array_equal(store[..., 5:][2, 0], MAPS[3])
+        assert np.array_equal(store[-1:][0, 1], MAPS[0])
+        assert store.get_region(np.s_[3:1, 0:2]).shape == (0, 2, 32, 32)
+
+
+def test_merge_gradcam_shard_dirs(tmp_path):
+    for worker, indices in enumerate([[0, 1], [1, 2, 3]]):
+        os.makedirs(tmp_path / f'worker{worker}')
+        write_gradcam_h5(str(tmp_path / f'worker{worker}' / 'VOA-1000A.h5'), 512, 20,
+                         (4096, 2048), TILES[indices], MAPS[indices])
+    write_gradcam_h5(str(tmp_path / 'worker1' / 'VOA-2000B.h5'), 256, 10,
+                     (1024, 1024), TILES[:1], MAPS[:1])
+    counts = merge_gradcam_shard_dirs([str(tmp_path / 'worker0'), str(tmp_path / 'worker1')],
+                                      str(tmp_path / 'merged'), n_process=1)
+    assert counts == {'VOA-1000A': 4, 'VOA-2000B': 1}
+    with GradCAMStore(str(tmp_path / 'merged' / 'VOA-1000A.h5')) as store:
+        maps, found = store.get_maps(TILES)
+        assert found.all()
+        assert np.array_equal(maps, MAPS)
+    write_gradcam_h5(str(tmp_path / 'worker1' / 'VOA-1000A.h5'), 256, 10,
+                     (1024, 1024), TILES[:1], MAPS[:1])
+    with pytest.raises(ValueError):
+        merge_gradcam_shards([str(tmp_path / 'worker0' / 'VOA-1000A.h5'),
+                              str(tmp_path / 'worker1' / 'VOA-1000A.h5')],
+                             str(tmp_path / 'merged' / 'VOA-1000A.h5'))
@@ -0,0 +1,164 @@
+import os
+import pytest
+import h5py
+import numpy as np
+
+from submodule_utils.metadata.heatmap_store import (
+        HeatmapStorageOptions, decode_heatmap, write_heatmap_grid,
+        read_class_grids, convert_heatmap_file, convert_heatmaps,
+        HeatmapStore, read_heatmap_windows, get_heatmap_pyramid,
+        build_heatmap_pyramids)
+
+GRID = np.full((2, 300, 40), np.nan, dtype=np.float32)
+GRID[:, 0, 0] = [0.75, 0.25]
+GRID[:, 1, 2] = [0., 1.]
+GRID[:, 299, 39] = [0.6, 0.4]
+
+TEST_PARAMETERS = [
+    pytest.param(HeatmapStorageOptions(), 1e-7, id="DEFAULT"),
+    pytest.param(HeatmapStorageOptions.compact('float32'), 1e-7, id="COMPACT_FLOAT32"),
+    pytest.param(HeatmapStorageOptions.compact('float16'), 1e-3, id="COMPACT_FLOAT16"),
+    pytest.param(HeatmapStorageOptions.compact(), 1. / 254, id="COMPACT_UINT8"),
+    pytest.param(HeatmapStorageOptions('uint8', chunk_size=64, compression='lzf'),
+                 1. / 254, id="UINT8_LZF"),
+]
+
+
+def write_heatmap_file(heatmap_path, grid, options, class_names=['A', 'B']):
+    with h5py.File(heatmap_path, 'w') as hdf:
+        group = hdf.require_group('512/20')
+        for idx, name in enumerate(class_names):
+            dataset = options.create_dataset(group, name, grid[idx].shape)
+            write_heatmap_grid(dataset, grid[idx], options)
+
+
+@pytest.mark.parametrize("options,tolerance", TEST_PARAMETERS)
+def test_HeatmapStorageOptions(options, tolerance, output_dir):
+    heatmap_path = os.path.join(output_dir, 'heatmap.0.VOA-1000A.h5')
+    write_heatmap_file(heatmap_path, GRID, options)
+    with h5py.File(heatmap_path, 'r') as hdf:
+        dataset = hdf['512/20/A']
+        assert dataset.dtype == np.dtype(options.dtype)
+        if options.chunk_size is not None:
+            assert dataset.chunks == (min(options.chunk_size, 300), 40)
+        class_names, grid = read_class_grids(hdf['512/20'])
+    assert class_names == ['A', 'B']
+    present = ~np.isnan(GRID)
+    assert np.array_equal(~np.isnan(grid), present)
+    assert np.allclose(grid[present], GRID[present], atol=tolerance)
+
+
+def test_decode_heatmap():
+    attrs = {'heatmap_format': 2, 'scale': 1. / 254, 'nodata': 255}
+    decoded = decode_heatmap(np.array([[0, 127, 254, 255]], dtype=np.uint8), attrs)
+    assert np.allclose(decoded[0, :3], [0., 0.5, 1.])
+    assert np.isnan(decoded[0, 3])
+    # datasets written before the storage options are read as they are
+    decoded = decode_heatmap(np.array([0., 0.5], dtype=np.float32), {})
+    assert decoded.tolist() == [0., 0.5]
+
+
+def test_convert_heatmap_file(output_dir):
+    """Legacy files are converted with cells where every class is 0 taken as no data.
+    """
+    heatmap_path = os.path.join(output_dir, 'heatmap.0.VOA-1000A.h5')
+    output_path = os.path.join(output_dir, 'heatmap.0.VOA-1000A.compact.h5')
+    write_heatmap_file(heatmap_path, np.nan_to_num(GRID), HeatmapStorageOptions())
+    size_before, size_after = convert_heatmap_file(heatmap_path, output_path=output_path,
+                                                   pyramid=False)
+    assert size_after < size_before
+    with h5py.File(output_path, 'r') as hdf:
+        assert hdf['512/20/A'].dtype == np.uint8
+        _, grid = read_class_grids(hdf['512/20'])
+    present = ~np.isnan(GRID)
+    assert np.array_equal(~np.isnan(grid), present)
+    assert np.allclose(grid[present], GRID[present], atol=1. / 254)
+
+
+def test_convert_heatmaps(tmp_path):
+    for slide_id in ['VOA-1000A', 'VOA-2000B']:
+        write_heatmap_file(str(tmp_path / f'heatmap.0.{slide_id}.h5'), np.nan_to_num(GRID),
+                           HeatmapStorageOptions())
+    results = convert_heatmaps(str(tmp_path), n_process=1, pyramid=False)
+    assert [os.path.basename(r[0]) for r in results] == [
+            'heatmap.0.VOA-1000A.h5', 'heatmap.0.VOA-2000B.h5']
+    assert all(r[2] < r[1] for r in results)
+    assert sorted(os.listdir(tmp_path)) == ['heatmap.0.VOA-1000A.h5', 'heatmap.0.VOA-2000B.h5']
+
+
+@pytest.mark.parametrize("options,tolerance", TEST_PARAMETERS)
+def test_HeatmapStore(options, tolerance, output_dir):
+    heatmap_path = os.path.join(output_dir, 'heatmap.0.VOA-1000A.h5')
+    write_heatmap_file(heatmap_path, GRID, options)
+    expected = GRID if options.nodata else np.nan_to_num(GRID)
+    with HeatmapStore.from_slide(output_dir, 'VOA-1000A') as store:
+        assert store.file is None
+        assert store.group_names == ['512/20']
+        assert store.get_class_names() == ['A', 'B']
+        assert store.get_shape() == (300, 40)
+        window = store.read_class('B', np.s_[1:290, 2:50])
+        assert window.shape == (289, 38)
+        assert np.allclose(window, expected[1, 1:290, 2:40], atol=tolerance, equal_nan=True)
+        grid = store.read()
+        assert np.allclose(grid, GRID, atol=tolerance, equal_nan=True)
+        # the chunks of the window were already read
+        misses = store.misses
+        store.read_class('B', np.s_[250:300, 0:10])
+        assert store.misses == misses
+
+
+def test_HeatmapStore_cache_eviction(output_dir):
+    heatmap_path = os.path.join(output_dir, 'heatmap.0.VOA-1000A.h5')
+    options = HeatmapStorageOptions('float32', chunk_size=100)
+    write_heatmap_file(heatmap_path, GRID, options)
+    with HeatmapStore(heatmap_path, cache_bytes=2 * 100 * 40 * 4) as store:
+        store.read_class('A')
+        assert len(store.cache) == 2
+        assert store.cached_bytes <= store.cache_bytes
+        assert list(store.cache) == [('512/20/A', 1, 0), ('512/20/A', 2, 0)]
+
+
+def test_read_heatmap_windows(tmp_path):
+    heatmap_paths = []
+    for idx in range(3):
+        heatmap_path = str(tmp_path / f'heatmap.0.VOA-{idx}.h5')
+        write_heatmap_file(heatmap_path, GRID * (idx + 1), HeatmapStorageOptions.compact('float32'))
+        heatmap_paths.append(heatmap_path)
+    heatmap_paths.append(str(tmp_path / 'heatmap.0.missing.h5'))
+    windows = read_heatmap_windows(heatmap_paths, np.s_[0:2, 0:3], class_names=['B'], n_process=2)
+    assert windows[3] is None
+    for idx in range(3):
+        assert windows[idx].shape == (1, 2, 3)
+        assert np.allclose(windows[idx], GRID[1:, 0:2, 0:3] * (idx + 1), equal_nan=True)
+
+
+def test_get_heatmap_pyramid():
+    levels = get_heatmap_pyramid(GRID)
+    # 300 x 40 is downsampled 9 times to a single cell
+    assert len(levels) == 9
+    assert levels[0]['mean'].shape == (2, 150, 20)
+    assert levels[1]['mean'].shape == (2, 75, 10)
+    assert levels[2]['max'].shape == (2, 38, 5)
+    assert levels[-1]['mean'].shape == (2, 1, 1)
+    # block (0, 0) of level 2 has the tiles (0, 0) and (1, 2)
+    assert np.allclose(levels[1]['mean'][:, 0, 0], [0.375, 0.625])
+    assert np.allclose(levels[1]['max'][:, 0, 0], [0.75, 1.])
+    assert np.isnan(levels[1]['mean'][:, 0, 1]).all()
+    assert np.allclose(levels[-1]['mean'][:, 0, 0], np.nanmean(GRID, axis=(1, 2)))
+    assert np.allclose(levels[-1]['max'][:, 0, 0], np.nanmax(GRID, axis=(1, 2)))
+
+
+def test_build_heatmap_pyramids(tmp_path):
+    heatmap_path = str(tmp_path / 'heatmap.0.VOA-1000A.h5')
+    write_heatmap_file(heatmap_path, np.nan_to_num(GRID), HeatmapStorageOptions())
+    assert build_heatmap_pyramids(str(tmp_path), n_process=1) == [True]
+    with HeatmapStore(heatmap_path) as store:
+        assert store.get_n_levels() == 10
+        assert store.get_shape(level=2) == (75, 10)
+        window = store.read(np.s_[0:2, 0:2], level=2, reduction='max')
+        assert np.allclose(window[:, 0, 0], [0.75, 1.], atol=1. / 254)
+        assert np.isnan(window[:, 1, 1]).all()
+        assert np.allclose(store.read(level=9)[:, 0, 0], np.nanmean(GRID, axis=(1, 2)),
+                           atol=1. / 254)
+        # the full grid is read as before
+        assert np.allclose(store.read(), GRID, equal_nan=True)
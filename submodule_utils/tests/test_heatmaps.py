@@ -0,0 +1,106 @@
+import os
+import csv
+import pytest
+import h5py
+import numpy as np
+
+import submodule_utils as utils
+import submodule_utils.metadata.heatmaps as heatmaps
+from submodule_utils.metadata.heatmaps import (
+        get_heatmap_grid, read_heatmap_records, generate_heatmaps)
+from submodule_utils.metadata.heatmap_store import (
+        HeatmapStorageOptions, HeatmapStore, decode_heatmap)
+
+PATCH_PATTERN = 'annotation/slide/patch_size/magnification'
+PREDICTIONS = [
+    ('/path/to/Tumor/VOA-1000A/512/20/0_0.png', 0, 0, '[0.75 0.25]'),
+    ('/path/to/Tumor/VOA-1000A/512/20/1024_512.png', 1, 0, '[0.1 0.9]'),
+    ('/path/to/Stroma/VOA-1000A/512/20/512_1536.png', 0, 0, '[0.6  0.4]'),
+    ('/path/to/Tumor/VOA-2000B/256/10/256_0.png', 1, 1, '[0.2 0.8]'),
+]
+
+
+def write_predictions_csv(csv_path, predictions):
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'predicted_label', 'target_label', 'probability', 'extra'])
+        for row in predictions:
+            writer.writerow([*row, ''])
+
+
+def test_read_heatmap_records(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    slides = read_heatmap_records(csv_path, PATCH_PATTERN, ['A', 'B'])
+    assert sorted(slides) == ['VOA-1000A', 'VOA-2000B']
+    assert slides['VOA-1000A']['meta'] == {'magnification': 20, 'patch_size': 512}
+    tiles, probabilities = slides['VOA-1000A']['data']
+    assert tiles.tolist() == [[0, 0], [1, 2], [3, 1]]
+    assert np.allclose(probabilities, [[0.75, 0.25], [0.1, 0.9], [0.6, 0.4]])
+    tiles, probabilities = slides['VOA-2000B']['data']
+    assert tiles.tolist() == [[0, 1]]
+
+
+def test_get_heatmap_grid():
+    tiles = np.array([[0, 0], [1, 2], [3, 1], [4, 0]])
+    probabilities = np.array([[0.75, 0.25], [0.1, 0.9], [0.6, 0.4], [0.5, 0.5]])
+    grid = get_heatmap_grid((4, 3), tiles, probabilities)
+    assert grid.shape == (2, 4, 3)
+    assert grid.dtype == np.float32
+    assert np.allclose(grid[:, 0, 0], [0.75, 0.25])
+    assert np.allclose(grid[:, 1, 2], [0.1, 0.9])
+    assert np.allclose(grid[:, 3, 1], [0.6, 0.4])
+    # tile (4, 0) is outside of the grid
+    assert np.isclose(grid.sum(), 3.)
+
+
+class MockSlide(object):
+    def __init__(self, slide_path):
+        self.dimensions = (2048, 2048)
+
+    def close(self):
+        pass
+
+
+def test_generate_heatmaps(output_dir, monkeypatch):
+    monkeypatch.setattr(heatmaps, 'OpenSlide', MockSlide)
+    for slide_id in ['VOA-1000A', 'VOA-2000B']:
+        with open(os.path.join(output_dir, f'{slide_id}.svs'), 'w'):
+            pass
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    CategoryEnum = utils.create_category_enum(False, subtypes={'A': 0, 'B': 1})
+    assert generate_heatmaps(csv_path, PATCH_PATTERN, CategoryEnum, output_dir,
+                             output_dir, n_process=1) == [True, True]
+    with h5py.File(os.path.join(output_dir, 'heatmap.0.VOA-1000A.h5'), 'r') as hdf:
+        # the pyramid is next to the group so its keys are still the class names
+        assert sorted(hdf['512/20'].keys()) == ['A', 'B']
+        assert '512/20_pyramid' in hdf
+        assert hdf['512/20/A'].shape == (4, 4)
+        assert np.isclose(hdf['512/20/A'][0, 0], 0.75)
+        assert np.isclose(hdf['512/20/B'][1, 2], 0.9)
+    with h5py.File(os.path.join(output_dir, 'heatmap.0.VOA-2000B.h5'), 'r') as hdf:
+        assert hdf['256/10/B'].shape == (8, 8)
+        assert np.isclose(hdf['256/10/B'][0, 1], 0.8)
+
+
+def test_generate_heatmaps_compact(output_dir, monkeypatch):
+    monkeypatch.setattr(heatmaps, 'OpenSlide', MockSlide)
+    for slide_id in ['VOA-1000A', 'VOA-2000B']:
+        with open(os.path.join(output_dir, f'{slide_id}.svs'), 'w'):
+            pass
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    CategoryEnum = utils.create_category_enum(False, subtypes={'A': 0, 'B': 1})
+    generate_heatmaps(csv_path, PATCH_PATTERN, CategoryEnum, output_dir, output_dir,
+                      n_process=1, storage_options=HeatmapStorageOptions.compact())
+    with h5py.File(os.path.join(output_dir, 'heatmap.0.VOA-1000A.h5'), 'r') as hdf:
+        dataset = hdf['512/20/A']
+        assert dataset.dtype == np.uint8
+        grid = decode_heatmap(dataset[...], dataset.attrs)
+    assert np.isclose(grid[0, 0], 0.75, atol=1. / 254)
+    assert np.isnan(grid[0, 1])
+    with HeatmapStore.from_slide(output_dir, 'VOA-1000A') as store:
+        assert store.get_n_levels() == 3
+        assert np.allclose(store.read(level=2, reduction='max')[:, 0, 0], [0.75, 0.9],
+                           atol=1. / 254)
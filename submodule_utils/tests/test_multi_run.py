@@ -0,0 +1,32 @@
+import os
+import numpy as np
+import pytest
+
+from submodule_utils.accuracy.multi_run import evaluate_runs, evaluate_run
+from submodule_utils.accuracy.bootstrap import BOOTSTRAP_METRICS
+from submodule_utils.tests.test_slide_level_accuracy import (
+        write_random_predictions, PATCH_PATTERN, SubtypeEnum)
+
+
+def test_evaluate_runs(output_dir, capsys):
+    csv_paths = []
+    for seed in range(3):
+        csv_paths.append(os.path.join(output_dir, f'predictions.{seed}.csv'))
+        write_random_predictions(csv_paths[-1], seed=seed)
+    # runs may be named like the summary rows
+    names = ['split0', 'mean', 'std']
+    runs, summary = evaluate_runs(csv_paths, PATCH_PATTERN, SubtypeEnum, n_process=2, names=names)
+    assert runs.index.tolist() == names
+    assert summary.index.tolist() == ['mean', 'std']
+    subtypes = {c.name: c.value for c in SubtypeEnum}
+    for name, csv_path in zip(names, csv_paths):
+        metrics = evaluate_run(csv_path, PATCH_PATTERN, subtypes)
+        assert 'mean_prob_auc' in metrics
+        for metric, value in metrics.items():
+            assert runs.loc[name, metric] == pytest.approx(value)
+    for metric in BOOTSTRAP_METRICS:
+        assert summary.loc['mean', metric] == pytest.approx(runs[metric].mean())
+        assert summary.loc['std', metric] == pytest.approx(np.std(runs[metric], ddof=1))
+    output = capsys.readouterr().out
+    assert "All weighted_acc:" in output
+    assert "||Metric||Mean ± Std||" in output
@@ -0,0 +1,123 @@
+import os
+import h5py
+import pytest
+import numpy as np
+
+import submodule_utils as utils
+from submodule_utils.patch_store import (
+        PatchStore, PatchStoreWriter, split_patch_paths, PATCH_STORE_VERSION)
+
+PATCH_PATHS_ONE_DIR = [f'/path/to/patches/Tumor/VOA-1000A/512/20/{x}_{y}.png'
+                       for x in range(0, 5120, 512) for y in range(0, 2048, 512)]
+PATCH_PATHS_MANY_DIRS = [
+        f'/path/to/patches/{label}/VOA-1000A/{size}/20/{x}_{y}.png'
+        for label in ['Tumor', 'Stroma'] for size in [512, 256]
+        for x, y in [(0, 0), (1024, 512), (3, 7)]]
+PATCH_PATHS_V1 = ['/path/to/patches/VOA-1000A/0001_0002.png',
+                  '/path/to/patches/VOA-1000A/41984_45056_d_256.png']
+TEST_PARAMETERS = [
+    pytest.param(PATCH_PATHS_ONE_DIR, PATCH_STORE_VERSION, id="ONE_DIR"),
+    pytest.param(PATCH_PATHS_MANY_DIRS, PATCH_STORE_VERSION, id="MANY_DIRS"),
+    pytest.param(PATCH_PATHS_V1, 1, id="V1"),
+]
+
+
+@pytest.mark.parametrize("paths,version", TEST_PARAMETERS)
+def test_save_hdf5(paths, version, output_dir):
+    hd5_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    utils.save_hdf5(hd5_path, paths, 512)
+    actual, patch_size = utils.open_hd5_file(hd5_path)
+    assert actual == paths
+    assert patch_size == 512
+    with PatchStore(hd5_path) as store:
+        assert store.version == version
+        assert len(store) == len(paths)
+        assert store[len(paths) // 2] == paths[len(paths) // 2]
+        assert store[-1] == paths[-1]
+        assert store[1:4] == paths[1:4]
+        assert list(store) == paths
+        if version == PATCH_STORE_VERSION:
+            _, expected, _ = split_patch_paths(paths)
+            assert np.array_equal(store.get_coords(), expected)
+            assert np.array_equal(store.get_coords(slice(2, 5)), expected[2:5])
+
+
+def test_PatchStore_reads_v1(output_dir):
+    """Files written before the version 2 layout are read transparently.
+    """
+    hd5_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    with h5py.File(hd5_path, 'w') as hf:
+        hf.create_dataset('paths', data=PATCH_PATHS_MANY_DIRS)
+        hf.attrs['patch_size'] = 256
+    with PatchStore(hd5_path) as store:
+        assert store.version == 1
+        assert store.patch_size == 256
+        assert list(store) == PATCH_PATHS_MANY_DIRS
+        assert np.array_equal(store.get_coords(),
+                              split_patch_paths(PATCH_PATHS_MANY_DIRS)[1])
+
+
+def test_split_patch_paths():
+    paths = ['/path/to/Tumor/VOA-1000A/512/20/1024_2048.png',
+             '/path/to/Stroma/VOA-1000A/512/20/0_512.png',
+             'relative/99_7']
+    dirs, coords, extensions = split_patch_paths(paths)
+    assert coords.tolist() == [[1024, 2048], [0, 512], [99, 7]]
+    assert dirs.tolist() == ['/path/to/Tumor/VOA-1000A/512/20/',
+                             '/path/to/Stroma/VOA-1000A/512/20/', 'relative/']
+    assert extensions == {'.png', ''}
+    assert split_patch_paths([])[1].shape == (0, 2)
+    with pytest.raises(ValueError):
+        split_patch_paths(['/path/to/41984_45056_d_256.png'])
+
+
+def test_PatchStore_iter_chunks(output_dir):
+    hd5_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    with h5py.File(hd5_path, 'w') as hf:
+        utils.write_patch_store(hf, PATCH_PATHS_ONE_DIR, 512, chunk_size=16)
+        assert hf['x'].chunks == (16,)
+        assert hf['x'].compression is not None
+    with PatchStore(hd5_path) as store:
+        chunks = list(store.iter_chunks())
+    assert [len(chunk) for chunk in chunks] == [16, 16, 8]
+    assert utils.merge_list_of_list(chunks) == PATCH_PATHS_ONE_DIR
+
+
+def test_PatchStoreWriter(output_dir):
+    hd5_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    with PatchStoreWriter(hd5_path, 512, mode='w', batch_size=5, chunk_size=4) as writer:
+        for path in PATCH_PATHS_MANY_DIRS:
+            writer.append([path])
+            # at most one batch is kept in memory
+            assert len(writer.buffer) < 5
+        assert len(writer) == len(PATCH_PATHS_MANY_DIRS)
+    with PatchStore(hd5_path) as store:
+        assert list(store) == PATCH_PATHS_MANY_DIRS
+
+
+def test_PatchStoreWriter_resume(output_dir):
+    """Reopening a file after an interrupted batch keeps only the committed patches.
+    """
+    hd5_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    with PatchStoreWriter(hd5_path, 512, mode='w') as writer:
+        writer.append(PATCH_PATHS_ONE_DIR[:10])
+    with h5py.File(hd5_path, 'a') as hf:
+        # simulate a batch that was written only partially
+        for name in ['x', 'y', 'subdir_index']:
+            hf[name].resize((15,))
+    with PatchStore(hd5_path) as store:
+        assert len(store) == 10
+    with PatchStoreWriter(hd5_path, 512) as writer:
+        writer.append(PATCH_PATHS_ONE_DIR[10:])
+    with PatchStore(hd5_path) as store:
+        assert list(store) == PATCH_PATHS_ONE_DIR
+    with pytest.raises(ValueError):
+        utils.save_hdf5(hd5_path, PATCH_PATHS_ONE_DIR, 256, mode='a')
+
+
+def test_save_hdf5_append(output_dir):
+    hd5_path = os.path.join(output_dir, 'VOA-1000A.h5')
+    utils.save_hdf5(hd5_path, PATCH_PATHS_MANY_DIRS[:3], 512)
+    utils.save_hdf5(hd5_path, PATCH_PATHS_MANY_DIRS[3:], 512, mode='a')
+    paths, _ = utils.open_hd5_file(hd5_path)
+    assert paths == PATCH_PATHS_MANY_DIRS
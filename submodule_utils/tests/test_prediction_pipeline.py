@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pytest
+
+from submodule_utils.metadata.heatmaps import HeatmapRecords, read_heatmap_records
+from submodule_utils.accuracy.slide_level_accuracy import (
+        SlideVoteAccumulator, ThresholdSweepAccumulator)
+from submodule_utils.prediction_pipeline import PredictionPipeline, ClassHistograms
+from submodule_utils.predictions import parse_probabilities
+from submodule_utils.tests.test_predictions import write_predictions_csv
+from submodule_utils.tests.test_prediction_store import HEATMAP_PATCH_PATTERN, PREDICTIONS
+
+
+class FailingConsumer(object):
+    def update(self, chunk):
+        raise RuntimeError("failed")
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_PredictionPipeline(concurrent, output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    pipeline = PredictionPipeline(csv_path, HEATMAP_PATCH_PATTERN, chunk_size=2,
+                                  concurrent=concurrent)
+    records = pipeline.register('heatmaps', HeatmapRecords(['A', 'B']))
+    slides = pipeline.register('slides', SlideVoteAccumulator(2, 0.5))
+    sweep = pipeline.register('sweep', ThresholdSweepAccumulator(2, [0.5, 0.7]))
+    histograms = pipeline.register('histograms', ClassHistograms(2, bins=4))
+    with pytest.raises(ValueError):
+        pipeline.register('slides', SlideVoteAccumulator(2, 0.5))
+    assert list(pipeline.run()) == ['heatmaps', 'slides', 'sweep', 'histograms']
+
+    expected = read_heatmap_records(csv_path, HEATMAP_PATCH_PATTERN, ['A', 'B'])
+    actual = records.get_slides()
+    assert list(actual) == list(expected)
+    for slide_id in expected:
+        assert actual[slide_id]['meta'] == expected[slide_id]['meta']
+        assert np.array_equal(actual[slide_id]['data'][0], expected[slide_id]['data'][0])
+    expected_slides = SlideVoteAccumulator(2, 0.5).update_csv(csv_path, HEATMAP_PATCH_PATTERN)
+    assert slides.slide_ids == expected_slides.slide_ids
+    assert np.array_equal(slides.votes, expected_slides.votes)
+    assert np.array_equal(sweep.get_accumulator(0).votes.sum(), slides.votes.sum())
+
+    probabilities = parse_probabilities([row[3] for row in PREDICTIONS])
+    for c in range(2):
+        counts, _ = np.histogram(probabilities[:, c], bins=histograms.bin_edges)
+        assert histograms.counts[c].tolist() == counts.tolist()
+    assert histograms.predicted_counts.tolist() == [3, 2]
+    assert histograms.real_counts.tolist() == [3, 2]
+
+
+def test_PredictionPipeline_error(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    pipeline = PredictionPipeline(csv_path, HEATMAP_PATCH_PATTERN, chunk_size=2)
+    pipeline.register('histograms', ClassHistograms(2))
+    pipeline.register('failing', FailingConsumer())
+    with pytest.raises(RuntimeError):
+        pipeline.run()
@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import pytest
+
+from submodule_utils.prediction_store import (
+        PredictionStore, convert_predictions, is_prediction_store)
+from submodule_utils.metadata.heatmaps import read_heatmap_records
+from submodule_utils.accuracy.slide_level_accuracy import SlideLevelAccuracy
+from submodule_utils.tests.test_predictions import write_predictions_csv
+from submodule_utils.tests.test_slide_level_accuracy import (
+        write_random_predictions, PATCH_PATTERN, SubtypeEnum)
+
+HEATMAP_PATCH_PATTERN = 'annotation/slide/patch_size/magnification'
+PREDICTIONS = [
+    ('/path/to/Tumor/VOA-2000B/256/10/256_0.png', 1, 1, '[0.2 0.8]'),
+    ('/path/to/Tumor/VOA-1000A/512/20/0_0.png', 0, 0, '[0.75 0.25]'),
+    ('/path/to/Tumor/VOA-1000A/512/20/1024_512.png', 1, 0, '[0.1 0.9]'),
+    ('/path/to/Stroma/VOA-2000B/256/10/0_512.png', 0, 1, '[0.6  0.4]'),
+    ('/path/to/Stroma/VOA-1000A/512/20/512_1536.png', 0, 0, '[0.6  0.4]'),
+]
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_convert_predictions(dtype, output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    store_path = os.path.join(output_dir, 'predictions.h5')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    assert convert_predictions(csv_path, store_path, HEATMAP_PATCH_PATTERN, dtype=dtype,
+                               chunk_size=2) == len(PREDICTIONS)
+    assert is_prediction_store(store_path)
+    assert not is_prediction_store(csv_path)
+    assert sorted(os.listdir(output_dir)) == ['predictions.csv', 'predictions.h5']
+    with PredictionStore(store_path) as store:
+        assert len(store) == len(PREDICTIONS)
+        assert store.slide_ids == ['VOA-1000A', 'VOA-2000B']
+        assert store.file['probabilities'].dtype == dtype
+        assert store.file['x'].dtype == np.int32
+        assert store.file['predicted_labels'].dtype == np.int8
+        slide = store.get_slide('VOA-1000A')
+        assert slide.coords.tolist() == [[0, 0], [1024, 512], [512, 1536]]
+        assert slide.predicted_labels.tolist() == [0, 1, 0]
+        assert np.allclose(slide.probabilities, [[0.75, 0.25], [0.1, 0.9], [0.6, 0.4]],
+                           atol=1e-3)
+        assert slide.patch_sizes.tolist() == [512] * 3
+        slide = store.get_slide('VOA-2000B')
+        assert slide.coords.tolist() == [[256, 0], [0, 512]]
+        assert slide.real_labels.tolist() == [1, 1]
+        assert slide.magnifications.tolist() == [10, 10]
+        chunks = list(store.iter_chunks(chunk_size=4))
+        assert [len(chunk.slide_ids) for chunk in chunks] == [4, 1]
+
+
+def test_convert_predictions_empty(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    store_path = os.path.join(output_dir, 'predictions.h5')
+    write_predictions_csv(csv_path, [])
+    with pytest.raises(ValueError):
+        convert_predictions(csv_path, store_path, HEATMAP_PATCH_PATTERN)
+    assert os.listdir(output_dir) == ['predictions.csv']
+
+
+def test_read_heatmap_records_from_store(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    store_path = os.path.join(output_dir, 'predictions.h5')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    convert_predictions(csv_path, store_path, HEATMAP_PATCH_PATTERN)
+    expected = read_heatmap_records(csv_path, HEATMAP_PATCH_PATTERN, ['A', 'B'])
+    slides = read_heatmap_records(store_path, HEATMAP_PATCH_PATTERN, ['A', 'B'])
+    assert sorted(slides) == sorted(expected)
+    for slide_id, slide in slides.items():
+        assert slide['meta'] == expected[slide_id]['meta']
+        for actual, data in zip(slide['data'], expected[slide_id]['data']):
+            assert np.allclose(actual, data)
+
+
+def test_slide_level_accuracy_from_store(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    store_path = os.path.join(output_dir, 'predictions.h5')
+    write_random_predictions(csv_path)
+    convert_predictions(csv_path, store_path, PATCH_PATTERN, chunk_size=64)
+    expected = SlideLevelAccuracy(csv_path, PATCH_PATTERN, SubtypeEnum).get_accumulator()
+    accumulator = SlideLevelAccuracy(store_path, PATCH_PATTERN, SubtypeEnum).get_accumulator()
+    assert accumulator.slide_ids == sorted(expected.slide_ids)
+    order = [expected.slide_index[slide_id] for slide_id in accumulator.slide_ids]
+    assert np.array_equal(accumulator.votes, expected.votes[order])
+    assert np.allclose(accumulator.prob_sums, expected.prob_sums[order])
+    assert np.array_equal(accumulator.real_labels, expected.real_labels[order])
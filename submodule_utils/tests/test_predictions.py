@@ -0,0 +1,78 @@
+import os
+import csv
+import pytest
+import numpy as np
+
+from submodule_utils.predictions import (
+        parse_probabilities, group_indices, encode_slide_ids, iter_prediction_chunks)
+
+PATCH_PATTERN = 'annotation/slide/patch_size/magnification'
+PREDICTIONS = [
+    ('/path/to/Tumor/VOA-1000A/512/20/0_0.png', 0, 0, '[0.75 0.25]'),
+    ('/path/to/Tumor/VOA-1000A/512/20/1024_512.png', 1, 0, '[0.1 0.9]'),
+    ('/path/to/Stroma/VOA-2000B/256/10/512_1536.png', 0, 1, '[ 0.6  0.4]'),
+]
+
+
+def write_predictions_csv(csv_path, predictions):
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'predicted_label', 'target_label', 'probability', 'extra'])
+        for row in predictions:
+            writer.writerow([*row, ''])
+
+
+def test_parse_probabilities():
+    probabilities = parse_probabilities(['[0.75 0.25]', '[ 0.1  0.9 ]', '[0.6\n 0.4]'])
+    assert probabilities.dtype == np.float32
+    assert np.allclose(probabilities, [[0.75, 0.25], [0.1, 0.9], [0.6, 0.4]])
+    with pytest.raises(ValueError):
+        parse_probabilities(['[0.75 0.25]', '[0.1 0.2 0.7]'])
+    with pytest.raises(ValueError):
+        # 6 values over 2 rows, but 1 and 5 per row
+        parse_probabilities(['[1.0]', '[0.1 0.2 0.3 0.2 0.2]'])
+    with pytest.raises(ValueError):
+        # 6 values over 3 rows, but not 2 per row
+        parse_probabilities(['[0.1 0.9]', '[1.0]', '[0.2 0.3 0.5]'])
+
+
+def test_group_indices():
+    keys, first, groups = group_indices(np.array(['b', 'a', 'b', 'c', 'a']))
+    assert keys.tolist() == ['a', 'b', 'c']
+    assert first.tolist() == [1, 0, 3]
+    assert [group.tolist() for group in groups] == [[1, 4], [0, 2], [3]]
+
+
+def test_encode_slide_ids():
+    slide_index = {'b': 0}
+    codes = encode_slide_ids(np.array(['c', 'b', 'a', 'c'], dtype=object), slide_index)
+    assert codes.tolist() == [1, 0, 2, 1]
+    assert slide_index == {'b': 0, 'c': 1, 'a': 2}
+    assert encode_slide_ids(np.array([], dtype=object), slide_index).tolist() == []
+
+
+@pytest.mark.parametrize("from_reader", [False, True])
+def test_iter_prediction_chunks(from_reader, output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_predictions_csv(csv_path, PREDICTIONS)
+    if from_reader:
+        with open(csv_path) as f:
+            chunks = list(iter_prediction_chunks(csv.reader(f), PATCH_PATTERN, chunk_size=2))
+    else:
+        chunks = list(iter_prediction_chunks(csv_path, PATCH_PATTERN, chunk_size=2))
+    assert [len(chunk.paths) for chunk in chunks] == [2, 1]
+    assert chunks[0].slide_ids.tolist() == ['VOA-1000A', 'VOA-1000A']
+    assert chunks[1].slide_ids.tolist() == ['VOA-2000B']
+    assert chunks[0].predicted_labels.tolist() == [0, 1]
+    assert chunks[1].real_labels.tolist() == [1]
+    assert chunks[0].coords.tolist() == [[0, 0], [1024, 512]]
+    assert chunks[1].patch_sizes.tolist() == [256]
+    assert chunks[1].magnifications.tolist() == [10]
+    assert np.allclose(chunks[1].probabilities, [[0.6, 0.4]])
+
+
+def test_iter_prediction_chunks_header_only(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_predictions_csv(csv_path, [])
+    assert list(iter_prediction_chunks(csv_path, PATCH_PATTERN)) == []
+    assert list(iter_prediction_chunks(csv_path, {'slide': 0})) == []
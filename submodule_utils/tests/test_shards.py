@@ -0,0 +1,82 @@
+import os
+import pytest
+import numpy as np
+
+import submodule_utils as utils
+from submodule_utils.patch_store import PatchStore, PatchStoreWriter
+from submodule_utils.shards import find_shards, consolidate_shard_dir
+from submodule_utils.metadata.gradcam_store import GradCAMWriter, GradCAMStore
+
+PATCH_PATHS = [f'/path/to/patches/Tumor/VOA-1000A/512/20/{x}_{y}.png'
+               for x in range(0, 5120, 512) for y in range(0, 2048, 512)]
+
+
+def test_consolidate_shards_patch_store(tmp_path):
+    hd5_path = str(tmp_path / 'VOA-1000A.h5')
+    for worker_id, start in enumerate(range(0, len(PATCH_PATHS), 15)):
+        with PatchStoreWriter(utils.get_shard_path(hd5_path, worker_id), 512, mode='w') as writer:
+            writer.append(PATCH_PATHS[start:start + 15])
+    # files of other slides are not shards of VOA-1000A
+    (tmp_path / 'VOA-1000A.shard.h5').write_bytes(b'')
+    (tmp_path / 'VOA-1000AB.shard0.h5').write_bytes(b'')
+    assert [os.path.basename(path) for path in find_shards(hd5_path)] == [
+            'VOA-1000A.shard0.h5', 'VOA-1000A.shard1.h5', 'VOA-1000A.shard2.h5']
+    utils.consolidate_shards(hd5_path)
+    with PatchStore(hd5_path) as store:
+        assert len(store) == len(PATCH_PATHS)
+        assert list(store) == PATCH_PATHS
+    paths, patch_size = utils.open_hd5_file(hd5_path)
+    assert paths == PATCH_PATHS and patch_size == 512
+    # the index refers to the shards relative to its directory
+    os.rename(tmp_path, str(tmp_path) + '_moved')
+    with PatchStore(str(tmp_path) + '_moved/VOA-1000A.h5') as store:
+        assert store[-1] == PATCH_PATHS[-1]
+
+
+def test_consolidate_shards_patch_store_subdirs(tmp_path):
+    hd5_path = str(tmp_path / 'VOA-1000A.h5')
+    tumor = PATCH_PATHS[:6]
+    stroma = [path.replace('/Tumor/', '/Stroma/') for path in PATCH_PATHS[6:12]]
+    other = [path.replace('/path/to/patches/', '/other/patches/') for path in PATCH_PATHS[12:15]]
+    # the shards have different prefixes and their subdirs are in a different order
+    shard_paths = [tumor + stroma[:2], stroma[2:] + tumor[:1], other]
+    for worker_id, paths in enumerate(shard_paths):
+        with PatchStoreWriter(utils.get_shard_path(hd5_path, worker_id), 512, mode='w') as writer:
+            writer.append(paths)
+    utils.consolidate_shards(hd5_path)
+    with PatchStore(hd5_path) as store:
+        assert store.prefix == '/'
+        assert sorted(store.subdirs) == ['/other/patches/Tumor/VOA-1000A/512/20/',
+                                         '/path/to/patches/Stroma/VOA-1000A/512/20/',
+                                         '/path/to/patches/Tumor/VOA-1000A/512/20/']
+        assert list(store) == [path for paths in shard_paths for path in paths]
+
+
+def test_consolidate_shards_mismatch(tmp_path):
+    hd5_path = str(tmp_path / 'VOA-1000A.h5')
+    for worker_id, patch_size in enumerate([512, 256]):
+        with PatchStoreWriter(utils.get_shard_path(hd5_path, worker_id), patch_size,
+                              mode='w') as writer:
+            writer.append(PATCH_PATHS[:3])
+    with pytest.raises(ValueError):
+        utils.consolidate_shards(hd5_path)
+    assert not os.path.exists(hd5_path)
+    with pytest.raises(ValueError):
+        utils.consolidate_shards(str(tmp_path / 'VOA-2000B.h5'))
+
+
+def test_consolidate_shard_dir_gradcam(tmp_path):
+    tiles = [(row, col) for row in range(4) for col in range(8)]
+    maps = np.random.RandomState(0).rand(len(tiles), 32, 32).astype(np.float32)
+    dimensions = {'VOA-1000A': (4096, 2048), 'VOA-2000B': (2048, 2048)}
+    for worker_id in range(2):
+        with GradCAMWriter(str(tmp_path), dimensions.get, worker_id=worker_id) as writer:
+            for idx in range(worker_id, len(tiles), 2):
+                writer.append('VOA-1000A', 512, 20, tiles[idx], maps[idx])
+            writer.append('VOA-2000B', 512, 20, tiles[worker_id], maps[worker_id])
+    output_paths = consolidate_shard_dir(str(tmp_path))
+    assert [os.path.basename(path) for path in output_paths] == ['VOA-1000A.h5', 'VOA-2000B.h5']
+    with GradCAMStore(output_paths[0]) as store:
+        assert len(store) == len(tiles)
+        region = store.get_region(np.s_[0:4, 0:8])
+    assert np.array_equal(region.reshape(-1, 32, 32), maps)
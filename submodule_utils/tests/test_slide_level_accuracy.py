@@ -0,0 +1,180 @@
+import os
+import csv
+import enum
+import pytest
+import numpy as np
+from sklearn.metrics import roc_auc_score
+
+from submodule_utils.accuracy.slide_level_accuracy import (
+        SlideLevelAccuracy, SlideVoteAccumulator, ThresholdSweepAccumulator, count_votes,
+        accumulate_csv_files)
+
+PATCH_PATTERN = {'annotation': 0, 'slide': 1}
+SubtypeEnum = enum.Enum('SubtypeEnum', ['CC', 'HGSC', 'LGSC'], start=0)
+
+
+def write_random_predictions(csv_path, n_slides=12, n_patches=500, seed=0, slide_ids=None):
+    """Write a prediction CSV of random patches and get the votes of the considered patches counted row by row.
+    """
+    rng = np.random.default_rng(seed)
+    n_classes = len(SubtypeEnum)
+    threshold = 1 / n_classes
+    slide_real_labels = rng.integers(0, n_classes, n_slides)
+    votes = {}
+    real_labels = {}
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'predicted_label', 'target_label', 'probability'])
+        for _ in range(n_patches):
+            slide = rng.integers(n_slides)
+            probability = rng.dirichlet(np.ones(n_classes) * 0.5)
+            predicted_label = int(probability.argmax())
+            slide_id = slide_ids[slide] if slide_ids else f"VOA-{slide}"
+            writer.writerow([f"/path/Tumor/{slide_id}/{rng.integers(99)}_{rng.integers(99)}.png",
+                             predicted_label, slide_real_labels[slide],
+                             f"[{' '.join(str(p) for p in probability)}]"])
+            if probability.max() > threshold:
+                if slide_id not in votes:
+                    votes[slide_id] = [0] * n_classes
+                    real_labels[slide_id] = int(slide_real_labels[slide])
+                votes[slide_id][predicted_label] += 1
+    return votes, real_labels
+
+
+def test_count_votes():
+    votes = count_votes(np.array([0, 2, 0, 0]), np.array([1, 0, 1, 0]), 3, 2)
+    assert votes.tolist() == [[1, 2], [0, 0], [1, 0]]
+
+
+def test_get_slide_votes(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    expected_votes, expected_real_labels = write_random_predictions(csv_path)
+    accuracy = SlideLevelAccuracy(csv_path, PATCH_PATTERN, SubtypeEnum)
+    slide_ids, votes, real_labels = accuracy.get_slide_votes()
+    assert slide_ids == list(expected_votes)
+    assert votes.tolist() == list(expected_votes.values())
+    assert real_labels.tolist() == list(expected_real_labels.values())
+    probs = accuracy.get_probs_from_votes(votes)
+    assert np.allclose(probs.sum(axis=1), 1)
+
+
+def test_SlideVoteAccumulator(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    expected_votes, expected_real_labels = write_random_predictions(csv_path)
+    accumulator = SlideVoteAccumulator(len(SubtypeEnum), 1 / len(SubtypeEnum))
+    accumulator.update_csv(csv_path, 'annotation/slide', chunk_size=37)
+    assert accumulator.slide_ids == list(expected_votes)
+    assert accumulator.votes.tolist() == list(expected_votes.values())
+    assert accumulator.real_labels.tolist() == list(expected_real_labels.values())
+    mean_probabilities = accumulator.get_mean_probabilities()
+    assert mean_probabilities.shape == (len(expected_votes), len(SubtypeEnum))
+    assert np.allclose(mean_probabilities.sum(axis=1), 1)
+
+
+def test_accumulate_csv_files(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_random_predictions(csv_path)
+    with open(csv_path) as f:
+        lines = f.readlines()
+    csv_paths = []
+    for idx, bounds in enumerate([(1, 200), (200, 201), (201, len(lines))]):
+        csv_paths.append(os.path.join(output_dir, f'predictions.{idx}.csv'))
+        with open(csv_paths[-1], 'w') as f:
+            f.writelines([lines[0]] + lines[slice(*bounds)])
+    expected = SlideVoteAccumulator(len(SubtypeEnum), 0.5).update_csv(csv_path, PATCH_PATTERN)
+    merged = accumulate_csv_files(csv_paths, PATCH_PATTERN, len(SubtypeEnum), 0.5, n_process=2)
+    order = [merged.slide_index[slide_id] for slide_id in expected.slide_ids]
+    assert sorted(merged.slide_ids) == sorted(expected.slide_ids)
+    assert np.array_equal(merged.votes[order], expected.votes)
+    assert np.allclose(merged.prob_sums[order], expected.prob_sums)
+    assert np.array_equal(merged.real_labels[order], expected.real_labels)
+    for n_process in [1, 2]:
+        slide_ids, votes, _ = SlideLevelAccuracy(csv_paths, PATCH_PATTERN, SubtypeEnum,
+                                                 threshold=0.5,
+                                                 n_process=n_process).get_slide_votes()
+        assert slide_ids == expected.slide_ids
+        assert np.array_equal(votes, expected.votes)
+
+
+def test_ThresholdSweepAccumulator(output_dir):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_random_predictions(csv_path)
+    thresholds = [0.9, 0.5, 1 / 3, 0.7, 0.99]
+    sweep = ThresholdSweepAccumulator(len(SubtypeEnum), thresholds)
+    sweep.update_csv(csv_path, PATCH_PATTERN, chunk_size=64)
+    assert np.array_equal(sweep.threshold, sorted(thresholds))
+    for idx, threshold in enumerate(sweep.threshold):
+        expected = SlideVoteAccumulator(len(SubtypeEnum), threshold).update_csv(
+                csv_path, PATCH_PATTERN)
+        accumulator = sweep.get_accumulator(idx)
+        # slides are in order of their first patch rather than of their first considered patch
+        order = [accumulator.slide_index[slide_id] for slide_id in expected.slide_ids]
+        assert sorted(accumulator.slide_ids) == sorted(expected.slide_ids)
+        assert np.array_equal(accumulator.votes[order], expected.votes)
+        assert np.allclose(accumulator.prob_sums[order], expected.prob_sums)
+        assert np.array_equal(accumulator.real_labels[order], expected.real_labels)
+    with pytest.raises(ValueError):
+        sweep.merge(ThresholdSweepAccumulator(len(SubtypeEnum), [0.5]))
+
+
+def test_sweep_thresholds(output_dir, capsys):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    write_random_predictions(csv_path)
+    accuracy = SlideLevelAccuracy(csv_path, PATCH_PATTERN, SubtypeEnum)
+    results = accuracy.sweep_thresholds(np.arange(0.4, 1.01, 0.2))
+    assert np.allclose(results['threshold'], [0.4, 0.6, 0.8, 1.])
+    assert results['slides'].tolist()[-1] == 0
+    assert results['slides'].is_monotonic_decreasing
+    for row in results.itertuples():
+        if row.slides > 0:
+            accumulator = SlideLevelAccuracy(csv_path, PATCH_PATTERN, SubtypeEnum,
+                                             threshold=row.threshold).get_accumulator()
+            _, _, weighted_acc, kappa, _, _ = accuracy.get_level_metrics(
+                    accumulator.votes, accumulator.real_labels)
+            assert row.weighted_acc == pytest.approx(weighted_acc)
+            assert row.kappa == pytest.approx(kappa)
+    assert "||Threshold||Slides||" in capsys.readouterr().out
+
+
+def test_patient_accumulator(output_dir, capsys):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    slide_to_patient = {'VOA-10A': '10', 'VOA-10B': '10', 'VOA-20A': '20', 'VOA-30C': '30'}
+    write_random_predictions(csv_path, n_slides=4, slide_ids=list(slide_to_patient))
+    manifest = {'slide_id': list(slide_to_patient), 'origin': ['OVCARE'] * 4,
+                'patient_id': list(slide_to_patient.values())}
+    for kwargs in [{'dataset_origin': ['ovcare']}, {'manifest': manifest}]:
+        accuracy = SlideLevelAccuracy(csv_path, PATCH_PATTERN, SubtypeEnum, **kwargs)
+        accumulator = accuracy.get_accumulator()
+        patients = accuracy.get_patient_accumulator(accumulator)
+        prefix = 'ovcare__' if 'manifest' in kwargs else ''
+        for patient_id in ['10', '20', '30']:
+            slides = [idx for idx, slide_id in enumerate(accumulator.slide_ids)
+                      if slide_to_patient[slide_id] == patient_id]
+            idx = patients.slide_index[prefix + patient_id]
+            assert np.array_equal(patients.votes[idx], accumulator.votes[slides].sum(axis=0))
+            assert np.allclose(patients.get_mean_probabilities()[idx],
+                               accumulator.prob_sums[slides].sum(axis=0)
+                               / accumulator.votes[slides].sum())
+            assert patients.real_labels[idx] == accumulator.real_labels[slides[0]]
+        accuracy.calculate_slide_level_accuracy(accumulator=accumulator)
+        assert "Patient Level Results:" in capsys.readouterr().out
+
+
+def test_calculate_slide_level_accuracy(output_dir, capsys):
+    csv_path = os.path.join(output_dir, 'predictions.csv')
+    votes, real_labels = write_random_predictions(csv_path)
+    with open(csv_path) as f:
+        SlideLevelAccuracy(csv.reader(f), PATCH_PATTERN, SubtypeEnum,
+                           verbose=True).calculate_slide_level_accuracy()
+    output = capsys.readouterr().out
+    n_correct = sum(real_labels[slide_id] == int(np.argmax(slide_votes))
+                    for slide_id, slide_votes in votes.items())
+    assert f"|{100 * n_correct / len(votes):.2f}%|" in output
+    accumulator = SlideVoteAccumulator(len(SubtypeEnum), 1 / len(SubtypeEnum)).update_csv(
+            csv_path, PATCH_PATTERN)
+    mean_prob_auc = roc_auc_score(accumulator.real_labels, accumulator.get_mean_probabilities(),
+                                  multi_class='ovr', average='macro')
+    assert "||Slide AUC||Mean Prob AUC||" in output
+    assert f"|{mean_prob_auc:.4f}|" in output
+    for slide_id in votes:
+        assert f"|{slide_id}|" in output
@@ -0,0 +1,265 @@
+import os
+import h5py
+import pytest
+import numpy as np
+import shapely.geometry
+from PIL import Image
+
+import submodule_utils as utils
+from submodule_utils.thumbnail import (
+        PlotThumbnail, get_patch_outline_mask, scale_polylines,
+        get_polygon_exteriors, get_thumbnail_path, is_thumbnail_up_to_date,
+        plot_thumbnails, read_thumbnail, ThumbnailCache, get_thumbnail_size,
+        get_thumbnail_level, get_slide_thumbnail, PATCH_COLOR,
+        get_colormap_lut, draw_heatmap, PlotHeatmapOverlay, get_overlay_path,
+        plot_heatmap_overlays)
+from submodule_utils.metadata.heatmap_store import (
+        HeatmapStorageOptions, write_heatmap_grid, write_heatmap_pyramid)
+
+
+class MockSlide(object):
+    """Stand-in for OpenSlide with a single uniform level.
+    """
+    def __init__(self, dimensions=(4096, 2048), down_sample=16.):
+        self.dimensions = dimensions
+        self.level_downsamples = [1., down_sample]
+        self.level_dimensions = [dimensions,
+                tuple(int(d / down_sample) for d in dimensions)]
+
+        self.thumbnail_reads = 0
+
+    def get_thumbnail(self, size):
+        self.thumbnail_reads += 1
+        return Image.new('RGB', size, (255, 255, 255))
+
+
+class ArraySlide(object):
+    """Stand-in for a single level OpenSlide backed by an RGB array.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.dimensions = (image.shape[1], image.shape[0])
+        self.level_downsamples = [1.]
+        self.level_dimensions = [self.dimensions]
+        self.region_pixels = []
+
+    def read_region(self, location, level, size):
+        x, y = location
+        width, height = size
+        self.region_pixels.append(width * height)
+        region = np.full((height, width, 4), 255, dtype=np.uint8)
+        region[..., :3] = self.image[y:y + height, x:x + width]
+        return Image.fromarray(region)
+
+
+def test_get_patch_outline_mask():
+    coords = np.array([[0, 0], [160, 320], [4000, 2000]])
+    mask = get_patch_outline_mask((128, 256), coords, 160, 16., thickness=2)
+    # first patch spans pixels 0..10 on both axes
+    assert mask[0, :11].all() and mask[1, :11].all()
+    assert mask[:11, 0].all() and mask[:11, 10].all()
+    assert not mask[2:9, 2:9].any()
+    # second patch spans pixels x 10..20 and y 20..30
+    assert mask[20, 10:21].all() and mask[30, 10:21].all()
+    # patches outside of the thumbnail are clipped
+    assert mask[125:, 250:].any()
+
+
+def test_scale_polylines():
+    polygon = shapely.geometry.Polygon([(0, 0), (160, 0), (160, 160)])
+    multi = shapely.geometry.MultiPolygon([
+            shapely.geometry.Polygon([(320, 320), (480, 320), (480, 480)]),
+            shapely.geometry.Polygon([(640, 0), (800, 0), (800, 160)])])
+    exteriors = get_polygon_exteriors([polygon, multi])
+    assert len(exteriors) == 3
+    polylines = scale_polylines(exteriors, 16.)
+    assert [p.dtype for p in polylines] == [np.int32] * 3
+    assert polylines[0].tolist() == [[0, 0], [10, 0], [10, 10], [0, 0]]
+    assert polylines[2].tolist() == [[40, 0], [50, 0], [50, 10], [40, 0]]
+    assert scale_polylines([], 16.) == []
+
+
+def test_PlotThumbnail(tmp_path):
+    hd5_file_path = str(tmp_path / 'VOA-1000A.h5')
+    paths = [f'/path/to/Tumor/VOA-1000A/512/20/{x}_{y}.png'
+             for x, y in [(0, 0), (512, 0), (1024, 1024)]]
+    utils.save_hdf5(hd5_file_path, paths, 512)
+    PlotThumbnail('VOA-1000A', MockSlide(), hd5_file_path)
+    thumbnail = np.array(Image.open(tmp_path / 'Thumbnails' / 'VOA-1000A.png'))
+    assert thumbnail.shape == (128, 256, 3)
+    assert tuple(thumbnail[0, 0]) == PATCH_COLOR
+    assert tuple(thumbnail[64, 64]) == PATCH_COLOR
+    assert tuple(thumbnail[100, 200]) == (255, 255, 255)
+
+
+def test_plot_thumbnails_skips_up_to_date(tmp_path):
+    slide_path = tmp_path / 'VOA-1000A.svs'
+    hd5_file_path = tmp_path / 'VOA-1000A.h5'
+    slide_path.write_bytes(b'')
+    hd5_file_path.write_bytes(b'')
+    thumbnail_path = get_thumbnail_path(str(hd5_file_path), 'VOA-1000A')
+    assert not is_thumbnail_up_to_date(thumbnail_path, [str(slide_path)])
+    os.makedirs(os.path.dirname(thumbnail_path))
+    with open(thumbnail_path, 'wb'):
+        pass
+    os.utime(slide_path, (0, 0))
+    os.utime(hd5_file_path, (0, 0))
+    jobs = [(str(slide_path), str(hd5_file_path), None, None)]
+    assert plot_thumbnails(jobs, n_process=2) == [('VOA-1000A', 'skipped', 0.)]
+    # the slide is not a readable WSI so plotting it fails but is reported
+    results = plot_thumbnails(jobs, n_process=2, overwrite=True)
+    assert [r[:2] for r in results] == [('VOA-1000A', 'failed')]
+
+
+def test_ThumbnailCache(tmp_path):
+    slide_path = tmp_path / 'VOA-1000A.svs'
+    slide_path.write_bytes(b'slide')
+    os_slide = MockSlide()
+    cache = ThumbnailCache(str(tmp_path / 'cache'))
+    size = os_slide.level_dimensions[-1]
+    expected = read_thumbnail(os_slide, size, str(slide_path), cache)
+    actual = read_thumbnail(os_slide, size, str(slide_path), cache)
+    assert os_slide.thumbnail_reads == 1
+    assert actual.flags.writeable
+    assert np.array_equal(expected, actual)
+    # a different size or a modified slide is a cache miss
+    read_thumbnail(os_slide, (64, 32), str(slide_path), cache)
+    assert os_slide.thumbnail_reads == 2
+    os.utime(slide_path, (1, 1))
+    read_thumbnail(os_slide, size, str(slide_path), cache)
+    assert os_slide.thumbnail_reads == 3
+
+
+def test_PlotThumbnail_thumbnail_cache(tmp_path):
+    hd5_file_path = str(tmp_path / 'VOA-1000A.h5')
+    utils.save_hdf5(hd5_file_path, ['/path/to/Tumor/VOA-1000A/512/20/0_0.png'], 512)
+    slide_path = tmp_path / 'VOA-1000A.svs'
+    slide_path.write_bytes(b'slide')
+    os_slide = MockSlide()
+    # the thumbnail is decoded once and shared by the renderers through the cache directory
+    for _ in range(2):
+        PlotThumbnail('VOA-1000A', os_slide, hd5_file_path, slide_path=str(slide_path),
+                      thumbnail_cache=str(tmp_path / 'cache'))
+    assert os_slide.thumbnail_reads == 1
+    PlotThumbnail('VOA-1000A', os_slide, hd5_file_path, slide_path=str(slide_path),
+                  thumbnail_cache=None)
+    assert os_slide.thumbnail_reads == 2
+
+
+def test_ThumbnailCache_evict(tmp_path):
+    slide_paths = []
+    for idx in range(3):
+        slide_path = tmp_path / f'slide_{idx}.svs'
+        slide_path.write_bytes(b'slide')
+        slide_paths.append(str(slide_path))
+    thumbnail = np.zeros((100, 100, 3), dtype=np.uint8)
+    cache = ThumbnailCache(str(tmp_path / 'cache'), max_bytes=2 * thumbnail.nbytes + 256)
+    for idx, slide_path in enumerate(slide_paths[:2]):
+        cache.put(slide_path, (100, 100), thumbnail)
+        os.utime(cache.get_cache_path(cache.get_key(slide_path, (100, 100))), (idx, idx))
+    # using the oldest entry makes the second one least recently used
+    assert cache.get(slide_paths[0], (100, 100)) is not None
+    cache.put(slide_paths[2], (100, 100), thumbnail)
+    assert cache.get(slide_paths[1], (100, 100)) is None
+    assert cache.get(slide_paths[0], (100, 100)) is not None
+    assert cache.get(slide_paths[2], (100, 100)) is not None
+
+
+def test_get_thumbnail_size():
+    os_slide = MockSlide(dimensions=(4096, 2048), down_sample=16.)
+    assert get_thumbnail_size(os_slide) == ((256, 128), 16.)
+    assert get_thumbnail_size(os_slide, max_dimension=512) == ((256, 128), 16.)
+    assert get_thumbnail_size(os_slide, max_dimension=64) == ((64, 32), 64.)
+    # a shallow pyramid is bounded by default
+    shallow_slide = MockSlide(dimensions=(40960, 20480), down_sample=2.)
+    assert get_thumbnail_size(shallow_slide) == ((4096, 2048), 10.)
+    assert get_thumbnail_size(shallow_slide, max_dimension=None) == ((20480, 10240), 2.)
+    # the downsample is of the axis that was rounded down the most
+    assert get_thumbnail_size(MockSlide(dimensions=(10000, 3333), down_sample=1.),
+                              max_dimension=100) == ((100, 33), 101.)
+    assert get_thumbnail_level(os_slide, (64, 32)) == 1
+    assert get_thumbnail_level(os_slide, (512, 256)) == 0
+
+
+@pytest.mark.parametrize("max_bytes", [4000 * 4, 400 * 4])
+def test_get_slide_thumbnail_streamed(max_bytes):
+    rng = np.random.RandomState(256)
+    image = rng.randint(0, 256, size=(300, 200, 3)).astype(np.uint8)
+    os_slide = ArraySlide(image)
+    thumbnail = get_slide_thumbnail(os_slide, (20, 30), max_bytes=max_bytes)
+    assert thumbnail.shape == (30, 20, 3)
+    assert max(os_slide.region_pixels) <= max_bytes // 4
+    expected = image.reshape(30, 10, 20, 10, 3).mean(axis=(1, 3))
+    assert np.abs(thumbnail - expected).max() <= 1
+
+
+def write_heatmap_file(heatmap_path, grid, patch_size, pyramid, options=None):
+    options = options or HeatmapStorageOptions.compact()
+    with h5py.File(heatmap_path, 'w') as hdf:
+        group = hdf.require_group(f'{patch_size}/20')
+        for idx, name in enumerate(['A', 'B']):
+            dataset = options.create_dataset(group, name, grid[idx].shape)
+            write_heatmap_grid(dataset, grid[idx], options)
+        if pyramid:
+            write_heatmap_pyramid(group, ['A', 'B'], grid, options)
+
+
+def test_draw_heatmap():
+    lut = get_colormap_lut('gray')
+    assert lut.shape == (256, 3)
+    assert tuple(lut[0]) == (0, 0, 0) and tuple(lut[255]) == (255, 255, 255)
+    image = np.full((20, 30, 3), 100, dtype=np.uint8)
+    grid = np.array([[1., np.nan], [0., 1.]])
+    # each cell covers 10 by 10 pixels, pixels beyond the last column are left out
+    draw_heatmap(image, grid, 2., 20, lut, alpha=0.5)
+    assert tuple(image[5, 5]) == (178, 178, 178)
+    assert tuple(image[5, 15]) == (100, 100, 100)
+    assert tuple(image[15, 5]) == (50, 50, 50)
+    assert tuple(image[15, 15]) == (178, 178, 178)
+    assert tuple(image[15, 25]) == (100, 100, 100)
+
+
+@pytest.mark.parametrize("patch_size,pyramid", [(512, False), (4, True)])
+def test_PlotHeatmapOverlay(patch_size, pyramid, tmp_path):
+    heatmap_path = str(tmp_path / 'heatmap.0.VOA-1000A.h5')
+    grid = np.full((2, 2048 // patch_size, 4096 // patch_size), np.nan, dtype=np.float32)
+    # the top left quarter of the slide is predicted as class B
+    grid[:, :grid.shape[1] // 2, :grid.shape[2] // 2] = np.array([0., 1.])[:, None, None]
+    write_heatmap_file(heatmap_path, grid, patch_size, pyramid)
+    PlotHeatmapOverlay('VOA-1000A', MockSlide(), heatmap_path, colormap='gray', alpha=1.)
+    for class_name, value in [('A', 0), ('B', 255)]:
+        overlay = np.array(Image.open(get_overlay_path(heatmap_path, 'VOA-1000A', class_name)))
+        assert overlay.shape == (128, 256, 3)
+        assert tuple(overlay[10, 10]) == (value, value, value)
+        assert tuple(overlay[100, 200]) == (255, 255, 255)
+
+
+def test_PlotHeatmapOverlay_class_subset(tmp_path):
+    heatmap_path = str(tmp_path / 'heatmap.0.VOA-1000A.h5')
+    grid = np.full((2, 4, 8), np.nan, dtype=np.float32)
+    grid[:, :2, :4] = np.array([0., 1.])[:, None, None]
+    # default options store cells without a patch as 0 in every class
+    write_heatmap_file(heatmap_path, grid, 512, False, HeatmapStorageOptions())
+    PlotHeatmapOverlay('VOA-1000A', MockSlide(), heatmap_path, class_names=['A'],
+                       colormap='gray', alpha=1.)
+    overlay = np.array(Image.open(get_overlay_path(heatmap_path, 'VOA-1000A', 'A')))
+    assert tuple(overlay[10, 10]) == (0, 0, 0)
+    assert tuple(overlay[100, 200]) == (255, 255, 255)
+
+
+def test_plot_heatmap_overlays(tmp_path):
+    slide_path = tmp_path / 'VOA-1000A.svs'
+    heatmap_path = tmp_path / 'heatmap.0.VOA-1000A.h5'
+    slide_path.write_bytes(b'')
+    heatmap_path.write_bytes(b'')
+    jobs = [(str(slide_path), str(heatmap_path))]
+    for class_name in ['A', 'B']:
+        overlay_path = get_overlay_path(str(heatmap_path), 'VOA-1000A', class_name)
+        os.makedirs(os.path.dirname(overlay_path), exist_ok=True)
+        with open(overlay_path, 'wb'):
+            pass
+    os.utime(slide_path, (0, 0))
+    os.utime(heatmap_path, (0, 0))
+    assert plot_heatmap_overlays(jobs, ['A', 'B'], n_process=2) == [('VOA-1000A', 'skipped', 0.)]
+    results = plot_heatmap_overlays(jobs, ['A', 'B'], n_process=2, overwrite=True)
+    assert [r[:2] for r in results] == [('VOA-1000A', 'failed')]
@@ -1,12 +1,437 @@
 import os
+import time
+import hashlib
+import functools
+import tempfile
+import multiprocessing
 
 import submodule_utils as utils
 import cv2
+import matplotlib
 import numpy as np
 from PIL import Image
+from openslide import OpenSlide
+from submodule_utils.metadata.annotation import GroovyAnnotation
+from submodule_utils.metadata.tissue_mask import TissueMask
+from submodule_utils.metadata.heatmap_store import HeatmapStore
+
+# Colours are RGB, the thumbnail is kept in RGB from reading to saving.
+ANNOTATION_COLORS = {
+    'Tumor': (255, 0, 0), # Red
+    'Stroma': (0, 255, 0), # Green
+    'Necrosis': (0, 255, 0), # Green
+}
+DEFAULT_ANNOTATION_COLOR = (192, 192, 192) # Silver
+MASK_COLOR = (100, 100, 100)
+PATCH_COLOR = (0, 0, 255) # Blue
+LINE_THICKNESS = 2
+# Number of patches rasterized at once, bounds the size of the index arrays.
+PATCH_BATCH_SIZE = 8192
+# Number of slides a pool worker renders before it is replaced, so memory
+# held by OpenSlide caches and large thumbnails is returned to the system.
+MAX_SLIDES_PER_WORKER = 8
+DEFAULT_THUMBNAIL_CACHE_BYTES = 2 * 1024 ** 3
+# ThumbnailCache shared by the thumbnail renderers unless they are given another one or None.
+DEFAULT_THUMBNAIL_CACHE_DIR = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+        'submodule_utils', 'thumbnails')
+# Maximum number of bytes of a slide level read at once when a thumbnail is
+# streamed from a level that is too large to decode in one go.
+THUMBNAIL_STRIP_BYTES = 64 * 1024 ** 2
+# Maximum width and height of a thumbnail, so slides with shallow pyramids are
+# not rendered close to full resolution.
+DEFAULT_THUMBNAIL_MAX_DIMENSION = 4096
+DEFAULT_HEATMAP_COLORMAP = 'jet'
+DEFAULT_HEATMAP_ALPHA = 0.5
+
+
+def get_polygon_exteriors(polygons):
+    """Get the exterior coordinates of a list of shapely Polygon and MultiPolygon.
+
+    Parameters
+    ----------
+    polygons : list of shapely.geometry.Polygon or shapely.geometry.MultiPolygon
+
+    Returns
+    -------
+    list of np.ndarray
+        One (n, 2) array of coordinates per polygon.
+    """
+    exteriors = []
+    for polygon in polygons:
+        if polygon.geom_type == 'Polygon':
+            exteriors.append(np.asarray(polygon.exterior.coords))
+        else:
+            exteriors.extend(np.asarray(polygon_.exterior.coords)
+                             for polygon_ in polygon.geoms)
+    return exteriors
+
+
+def scale_polylines(exteriors, down_sample):
+    """Scale polygon exteriors to thumbnail coordinates in one pass over all vertices.
+
+    Parameters
+    ----------
+    exteriors : list of np.ndarray
+        Slide level coordinates of each polygon.
+
+    down_sample : float
+        Downsample of the thumbnail relative to the slide.
+
+    Returns
+    -------
+    list of np.ndarray
+        One int32 (n, 2) array of thumbnail coordinates per polygon.
+    """
+    if len(exteriors) == 0:
+        return []
+    lengths = np.cumsum([len(exterior) for exterior in exteriors])[:-1]
+    points = (np.concatenate(exteriors) / down_sample).round().astype(np.int32)
+    return np.split(points, lengths)
+
+
+def draw_polygons(image, polygons, down_sample, color, thickness=LINE_THICKNESS):
+    """Draw the outlines of all polygons on the image with a single cv2.polylines call.
+    """
+    polylines = scale_polylines(get_polygon_exteriors(polygons), down_sample)
+    if len(polylines) > 0:
+        cv2.polylines(image, polylines, False, color, thickness)
+
+
+def _segment_indices(fixed, start, stop):
+    """Expand segments [start, stop] along one axis into pixel indices.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        The fixed and varying index of every pixel on the segments.
+    """
+    lengths = np.maximum(stop - start + 1, 0)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    varying = np.arange(lengths.sum()) - offsets + np.repeat(start, lengths)
+    return np.repeat(fixed, lengths), varying
+
+
+def get_patch_outline_mask(shape, coords, patch_size, down_sample,
+                           thickness=LINE_THICKNESS):
+    """Rasterize the outlines of all patches as a boolean mask on the thumbnail grid.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (height, width) of the thumbnail.
+
+    coords : np.ndarray
+        Array of shape (n, 2) with the slide level (x, y) of each patch.
+
+    patch_size : int
+
+    down_sample : float
+        Downsample of the thumbnail relative to the slide.
+
+    thickness : int
+        Thickness of the outline in thumbnail pixels, drawn inside the patch.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the given shape that is True on patch outlines.
+    """
+    height, width = shape[:2]
+    mask = np.zeros((height, width), dtype=bool)
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    for idx in range(0, len(coords), PATCH_BATCH_SIZE):
+        batch = coords[idx:idx + PATCH_BATCH_SIZE]
+        x0 = (batch[:, 0] / down_sample).astype(np.int64)
+        y0 = (batch[:, 1] / down_sample).astype(np.int64)
+        x1 = ((batch[:, 0] + patch_size) / down_sample).astype(np.int64)
+        y1 = ((batch[:, 1] + patch_size) / down_sample).astype(np.int64)
+        rows, cols = [], []
+        for offset in range(thickness):
+            # top and bottom edges
+            for y in (y0 + offset, y1 - offset):
+                r, c = _segment_indices(y, x0, x1)
+                rows.append(r)
+                cols.append(c)
+            # left and right edges
+            for x in (x0 + offset, x1 - offset):
+                c, r = _segment_indices(x, y0, y1)
+                rows.append(r)
+                cols.append(c)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        mask[rows[inside], cols[inside]] = True
+    return mask
+
+
+def draw_patches(image, coords, patch_size, down_sample, color,
+                 thickness=LINE_THICKNESS):
+    """Draw the outlines of all patches on the image in place.
+    """
+    mask = get_patch_outline_mask(image.shape, coords, patch_size,
+                                  down_sample, thickness=thickness)
+    image[mask] = color
+
+
+def get_thumbnail_size(os_slide, max_dimension=DEFAULT_THUMBNAIL_MAX_DIMENSION):
+    """Get the size of a slide thumbnail and its downsample relative to the slide.
+
+    Parameters
+    ----------
+    os_slide : OpenSlide
+
+    max_dimension : int or None
+        Maximum width and height of the thumbnail, DEFAULT_THUMBNAIL_MAX_DIMENSION by default. If None the size of the lowest resolution level is used as is, which is close to full resolution for slides with shallow pyramids.
+
+    Returns
+    -------
+    tuple
+        A tuple of
+         - size (tuple of int) (width, height) of the thumbnail
+         - down_sample (float) downsample of the thumbnail relative to the slide, the larger of the downsamples of its width and height so everything drawn at this downsample is inside the thumbnail
+    """
+    width, height = os_slide.level_dimensions[-1]
+    if max_dimension is None or max(width, height) <= max_dimension:
+        return (width, height), os_slide.level_downsamples[-1]
+    slide_width, slide_height = os_slide.level_dimensions[0]
+    down_sample = max(slide_width, slide_height) / max_dimension
+    size = (max(1, int(slide_width / down_sample)),
+            max(1, int(slide_height / down_sample)))
+    return size, max(slide_width / size[0], slide_height / size[1])
+
+
+def get_thumbnail_level(os_slide, size):
+    """Get the lowest resolution level that is at least as large as the thumbnail.
+    """
+    level = 0
+    for idx, (width, height) in enumerate(os_slide.level_dimensions):
+        if width >= size[0] and height >= size[1]:
+            level = idx
+    return level
+
+
+def _rgba_to_rgb(rgba):
+    """Blend an RGBA region read from OpenSlide onto a white background.
+    """
+    alpha = rgba[..., 3:].astype(np.uint16)
+    rgb = rgba[..., :3] * alpha + 255 * (255 - alpha)
+    return (rgb // 255).astype(np.uint8)
+
+
+def stream_thumbnail(os_slide, level, size, max_bytes=THUMBNAIL_STRIP_BYTES):
+    """Build a thumbnail by reading a slide level in blocks of at most max_bytes and downsampling each block into place.
+
+    Parameters
+    ----------
+    os_slide : OpenSlide
+
+    level : int
+        Slide level to read from.
+
+    size : tuple of int
+        (width, height) of the thumbnail.
+
+    max_bytes : int
+        Maximum number of bytes of the level to read at once.
+
+    Returns
+    -------
+    np.ndarray
+        (height, width, 3) RGB thumbnail.
+    """
+    level_width, level_height = os_slide.level_dimensions[level]
+    level_downsample = os_slide.level_downsamples[level]
+    width, height = size
+    scale_x, scale_y = level_width / width, level_height / height
+    max_pixels = max_bytes // 4
+    rows = max(1, int(max_pixels / (level_width * scale_y)))
+    if rows == 1 and level_width * scale_y > max_pixels:
+        # even a single row of the thumbnail is too wide, split it in columns
+        cols = max(1, int(max_pixels / (scale_x * scale_y)))
+    else:
+        cols = width
+    thumbnail = np.empty((height, width, 3), dtype=np.uint8)
+    for r0 in range(0, height, rows):
+        r1 = min(r0 + rows, height)
+        y0 = int(round(r0 * scale_y))
+        y1 = max(min(int(round(r1 * scale_y)), level_height), y0 + 1)
+        for c0 in range(0, width, cols):
+            c1 = min(c0 + cols, width)
+            x0 = int(round(c0 * scale_x))
+            x1 = max(min(int(round(c1 * scale_x)), level_width), x0 + 1)
+            region = os_slide.read_region(
+                    (int(x0 * level_downsample), int(y0 * level_downsample)),
+                    level, (x1 - x0, y1 - y0))
+            block = _rgba_to_rgb(np.array(region))
+            thumbnail[r0:r1, c0:c1] = cv2.resize(block, (c1 - c0, r1 - r0),
+                                                 interpolation=cv2.INTER_AREA)
+    return thumbnail
+
+
+def get_slide_thumbnail(os_slide, size, max_bytes=THUMBNAIL_STRIP_BYTES):
+    """Get the RGB thumbnail of a slide with bounded peak memory.
+
+    The lowest resolution level that is at least as large as the thumbnail is used. If that level fits in max_bytes it is decoded by OpenSlide in one go, otherwise it is streamed through stream_thumbnail.
+
+    Parameters
+    ----------
+    os_slide : OpenSlide
+
+    size : tuple of int
+        (width, height) of the thumbnail.
+
+    max_bytes : int
+        Maximum number of bytes of a slide level to decode at once.
+
+    Returns
+    -------
+    np.ndarray
+        (height, width, 3) RGB thumbnail.
+    """
+    level = get_thumbnail_level(os_slide, size)
+    level_width, level_height = os_slide.level_dimensions[level]
+    if level_width * level_height * 4 <= max_bytes:
+        return np.array(os_slide.get_thumbnail(size).convert('RGB'))
+    return stream_thumbnail(os_slide, level, size, max_bytes=max_bytes)
+
+
+class ThumbnailCache(object):
+    """On-disk cache of decoded RGB slide thumbnails.
+
+    Thumbnails are stored as uncompressed .npy files so they can be memory mapped, and are keyed by the slide path, the thumbnail size and the modification time of the slide so a changed slide is decoded again. When the cache grows beyond max_bytes the least recently used thumbnails are removed.
+    """
+    EXTENSION = '.npy'
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_THUMBNAIL_CACHE_BYTES):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Directory to store cached thumbnails in.
+
+        max_bytes : int
+            Maximum total size of the cached thumbnails.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, slide_path, size):
+        """Get the cache key of a slide thumbnail. Returns None if the slide does not exist.
+        """
+        try:
+            stat = os.stat(slide_path)
+        except OSError:
+            return None
+        key = f"{os.path.abspath(slide_path)}|{size[0]}x{size[1]}|{stat.st_mtime_ns}|{stat.st_size}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_cache_path(self, key):
+        return os.path.join(self.cache_dir, key + self.EXTENSION)
+
+    def get(self, slide_path, size):
+        """Get a cached thumbnail.
+
+        Returns
+        -------
+        np.ndarray or None
+            Read-only memory mapped (height, width, 3) RGB array, or None if the thumbnail is not cached.
+        """
+        key = self.get_key(slide_path, size)
+        if key is None:
+            return None
+        cache_path = self.get_cache_path(key)
+        try:
+            thumbnail = np.load(cache_path, mmap_mode='r')
+            # the modification time of a cached thumbnail marks its last use
+            os.utime(cache_path, None)
+        except (OSError, ValueError):
+            return None
+        return thumbnail
+
+    def put(self, slide_path, size, thumbnail):
+        """Store a thumbnail in the cache and evict old thumbnails if the cache is full.
+        """
+        key = self.get_key(slide_path, size)
+        if key is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(thumbnail, dtype=np.uint8))
+        # rename is atomic so concurrent readers never see a partial file
+        os.replace(tmp_path, self.get_cache_path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used thumbnails until the cache fits in max_bytes.
+        """
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(self.EXTENSION):
+                continue
+            cache_path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(cache_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, cache_path))
+        total_bytes = sum(entry[1] for entry in entries)
+        for _, file_size, cache_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            total_bytes -= file_size
+
+
+def get_thumbnail_cache(thumbnail_cache):
+    """Get the ThumbnailCache of a cache, cache directory or None.
+    """
+    if thumbnail_cache is None or isinstance(thumbnail_cache, ThumbnailCache):
+        return thumbnail_cache
+    return ThumbnailCache(thumbnail_cache)
+
+
+def read_thumbnail(os_slide, size, slide_path=None, thumbnail_cache=DEFAULT_THUMBNAIL_CACHE_DIR):
+    """Read the RGB thumbnail of a slide, going through the thumbnail cache unless it is None.
+
+    Parameters
+    ----------
+    os_slide : OpenSlide
+
+    size : tuple of int
+        (width, height) of the thumbnail.
+
+    slide_path : str
+        Path of the slide used as the cache key. The cache is not used without it.
+
+    thumbnail_cache : ThumbnailCache, str or None
+        Cache, or directory of the cache, to read the decoded thumbnail from. None to always decode it from the slide.
+
+    Returns
+    -------
+    np.ndarray
+        Writable (height, width, 3) RGB array.
+    """
+    use_cache = thumbnail_cache is not None and slide_path is not None
+    if use_cache:
+        thumbnail_cache = get_thumbnail_cache(thumbnail_cache)
+        thumbnail = thumbnail_cache.get(slide_path, size)
+        if thumbnail is not None:
+            return np.array(thumbnail)
+    thumbnail = get_slide_thumbnail(os_slide, size)
+    if use_cache:
+        thumbnail_cache.put(slide_path, size, thumbnail)
+    return thumbnail
+
 
 class PlotThumbnail(object):
-    def __init__(self, slide_name, os_slide, hd5_file_path, annotation=None, mask=None):
+    def __init__(self, slide_name, os_slide, hd5_file_path, annotation=None, mask=None,
+                 slide_path=None, thumbnail_cache=DEFAULT_THUMBNAIL_CACHE_DIR,
+                 max_dimension=DEFAULT_THUMBNAIL_MAX_DIMENSION):
         """
         Parameters
         ----------
@@ -16,105 +441,52 @@ class PlotThumbnail(object):
 
         annotation : dict
 
+        slide_path : str
+            Path of the slide, used to look up the thumbnail in thumbnail_cache.
+
+        thumbnail_cache : ThumbnailCache, str or None
+            Cache, or directory of the cache, to read the decoded thumbnail from instead of the slide. Defaults to the cache in DEFAULT_THUMBNAIL_CACHE_DIR shared by the thumbnail renderers, None to always decode the thumbnail from the slide.
+
+        max_dimension : int or None
+            Maximum width and height of the thumbnail. None to use the size of the lowest resolution level whatever it is.
         """
         self.os_slide = os_slide
+        self.slide_path = slide_path
+        self.thumbnail_cache = thumbnail_cache
         self.hd5_file_path = hd5_file_path
         self.annotation = annotation
         self.mask = mask
         self.slide_name = slide_name
-        self.store_path = os.path.join(os.path.dirname(self.hd5_file_path),
-                                       'Thumbnails')
-        # Get maximum downsample and minimum dimension
-        self.down_sample = self.os_slide.level_downsamples[-1]
-        self.dimensions  = self.os_slide.level_dimensions[-1]
+        self.store_path = get_thumbnail_dir(self.hd5_file_path)
+        self.dimensions, self.down_sample = get_thumbnail_size(self.os_slide,
+                                                               max_dimension)
         self.run()
 
     def get_thumbnail(self):
-        thumbnail = self.os_slide.get_thumbnail(self.dimensions)
-        self.thumbnail = cv2.cvtColor(np.array(thumbnail), cv2.COLOR_RGB2BGR)
-
-        # thumbnail.save(f'thumbnail_slide_{slide_name}.png')
+        self.thumbnail = read_thumbnail(self.os_slide, self.dimensions,
+                                        slide_path=self.slide_path,
+                                        thumbnail_cache=self.thumbnail_cache)
 
     def draw_annotation(self):
         if self.annotation is not None:
-            overlay = self.thumbnail.copy()
-            poly = self.annotation.polygons
-            alpha = 0.2 # that's the transparency factor
-            for label, polygons in poly.items():
-                if label=='Tumor': color=(0, 0, 255) # Red # color=(0, 255, 255) # Yellow
-                elif label=='Stroma' or label=='Necrosis': color=(0, 255, 0) # Green # color=(255, 255, 0) # Cyan / Aqua
-                else: color=(192,192,192) # Silver
-                for polygon in polygons:
-                    int_coords = lambda x: (np.array(x)/self.down_sample).round().astype(np.int32)
-                    if polygon.type=='Polygon':
-                        # draw a line
-                        exterior = int_coords(polygon.exterior.coords)
-                        xs, ys = exterior[:,0], exterior[:,1]
-                        draw_points = (np.asarray([xs, ys]).T).astype(np.int32)
-                        cv2.polylines(self.thumbnail, [draw_points], False, color, 2)
-                        # draw a polygon
-                        # exterior = [int_coords(polygon.exterior.coords)]
-                        # cv2.fillPoly(overlay, exterior, color=color)
-                    else:
-                        for polygon_ in polygon:
-
-                            # draw a line
-                            exterior = int_coords(polygon_.exterior.coords)
-                            xs, ys = exterior[:,0], exterior[:,1]
-                            draw_points = (np.asarray([xs, ys]).T).astype(np.int32)
-                            cv2.polylines(self.thumbnail, [draw_points], False, color, 2)
-                            # draw a polygon
-                            # exterior = [int_coords(polygon_.exterior.coords)]
-                            # cv2.fillPoly(overlay, exterior, color=color)
-            # draw a polygon
-            # cv2.addWeighted(overlay, alpha, self.thumbnail, 1 - alpha, 0, self.thumbnail)
+            for label, polygons in self.annotation.polygons.items():
+                color = ANNOTATION_COLORS.get(label, DEFAULT_ANNOTATION_COLOR)
+                draw_polygons(self.thumbnail, polygons, self.down_sample, color)
 
     def draw_mask(self):
         if self.mask is not None:
-            overlay = self.thumbnail.copy()
-            poly = self.mask.polygons
-            alpha = 0.3 # that's the transparency factor
-            for polygons in poly.values():
-                color=(100, 100, 100)
-                for polygon in polygons:
-                    int_coords = lambda x: (np.array(x)/self.down_sample).round().astype(np.int32)
-                    if polygon.type=='Polygon':
-                        # draw a line
-                        exterior = int_coords(polygon.exterior.coords)
-                        xs, ys = exterior[:,0], exterior[:,1]
-                        draw_points = (np.asarray([xs, ys]).T).astype(np.int32)
-                        cv2.polylines(self.thumbnail, [draw_points], False, color, 2)
-                        # draw a polygon
-                        # exterior = [int_coords(polygon.exterior.coords)]
-                        # cv2.fillPoly(overlay, exterior, color=color)
-                    else:
-                        for polygon_ in polygon:
-                            # draw a line
-                            exterior = int_coords(polygon_.exterior.coords)
-                            xs, ys = exterior[:,0], exterior[:,1]
-                            draw_points = (np.asarray([xs, ys]).T).astype(np.int32)
-                            cv2.polylines(self.thumbnail, [draw_points], False, color, 2)
-                            # draw a polygon
-                            # exterior = [int_coords(polygon_.exterior.coords)]
-                            # cv2.fillPoly(overlay, exterior, color=color)
-            # draw a polygon
-            # cv2.addWeighted(overlay, alpha, self.thumbnail, 1 - alpha, 0, self.thumbnail)
+            polygons = utils.merge_list_of_list(self.mask.polygons.values())
+            draw_polygons(self.thumbnail, polygons, self.down_sample, MASK_COLOR)
 
     def draw_patches(self):
-        paths, patch_size = utils.open_hd5_file(self.hd5_file_path)
-        for path in paths:
-            (x,  y ) = os.path.splitext(os.path.basename(path))[0].split('_')
-            # resize_size = int(utils.get_patchsize_by_patch_path(path))
-            (x,  y ) = (int(x),  int(y))
-            # (x_, y_) = (x+resize_size, y+resize_size)
-            (x_, y_) = (x+patch_size, y+patch_size)
-            (x,  y ) = (int(x/self.down_sample), int(y/self.down_sample))
-            (x_, y_) = (int(x_/self.down_sample), int(y_/self.down_sample))
-            cv2.rectangle(self.thumbnail, (x, y), (x_, y_), (255,0,0), 2)
+        with utils.PatchStore(self.hd5_file_path) as store:
+            coords = store.get_coords()
+            patch_size = store.patch_size
+        draw_patches(self.thumbnail, coords, patch_size, self.down_sample, PATCH_COLOR)
 
     def save_thumbnail(self):
-        self.thumbnail = Image.fromarray(cv2.cvtColor(self.thumbnail, cv2.COLOR_BGR2RGB))
-        self.thumbnail.save(f'{os.path.join(self.store_path, self.slide_name)}.png')
+        self.thumbnail = Image.fromarray(self.thumbnail)
+        self.thumbnail.save(get_thumbnail_path(self.hd5_file_path, self.slide_name))
 
     def run(self):
         os.makedirs(self.store_path, exist_ok=True)
@@ -123,3 +495,391 @@ class PlotThumbnail(object):
         self.draw_mask()
         self.draw_patches()
         self.save_thumbnail()
+
+
+def get_thumbnail_dir(hd5_file_path):
+    """Get the directory PlotThumbnail saves the thumbnails of a patch HDF5 file in.
+    """
+    return os.path.join(os.path.dirname(hd5_file_path), 'Thumbnails')
+
+
+def get_thumbnail_path(hd5_file_path, slide_name):
+    """Get the path of the PNG PlotThumbnail saves for a slide.
+    """
+    return f'{os.path.join(get_thumbnail_dir(hd5_file_path), slide_name)}.png'
+
+
+def is_thumbnail_up_to_date(thumbnail_path, input_paths):
+    """Check whether a thumbnail exists and is newer than all of its inputs.
+
+    Parameters
+    ----------
+    thumbnail_path : str
+
+    input_paths : list of str
+        Paths of the inputs the thumbnail is drawn from. None entries are ignored.
+
+    Returns
+    -------
+    bool
+    """
+    if not os.path.isfile(thumbnail_path):
+        return False
+    thumbnail_mtime = os.path.getmtime(thumbnail_path)
+    return all(os.path.getmtime(path) < thumbnail_mtime
+               for path in input_paths if path is not None)
+
+
+def plot_thumbnail_job(job, thumbnail_cache_dir=DEFAULT_THUMBNAIL_CACHE_DIR,
+                       max_dimension=DEFAULT_THUMBNAIL_MAX_DIMENSION):
+    """Open the inputs of a single job and plot its thumbnail with PlotThumbnail.
+
+    Parameters
+    ----------
+    job : tuple
+        A tuple of (slide_path, hd5_file_path, annotation_path, mask_path) where annotation_path and mask_path can be None.
+
+    thumbnail_cache_dir : str or None
+        Directory of the ThumbnailCache to read decoded thumbnails from, None to not use a cache.
+
+    max_dimension : int or None
+        Maximum width and height of the thumbnail.
+
+    Returns
+    -------
+    tuple
+        A tuple of
+         - slide_name (str)
+         - status (str) one of 'done' or 'failed'
+         - seconds (float) time taken to plot the thumbnail
+    """
+    slide_path, hd5_file_path, annotation_path, mask_path = job
+    slide_name = utils.path_to_filename(slide_path)
+    start = time.time()
+    try:
+        os_slide = OpenSlide(slide_path)
+        annotation = None if annotation_path is None else \
+                GroovyAnnotation(annotation_path, 0, 0, False)
+        mask = None if mask_path is None else \
+                TissueMask(mask_path, 0, 0, os_slide.dimensions)
+        PlotThumbnail(slide_name, os_slide, hd5_file_path, annotation, mask,
+                      slide_path=slide_path, thumbnail_cache=thumbnail_cache_dir,
+                      max_dimension=max_dimension)
+        os_slide.close()
+    except Exception as e:
+        print(f"could not plot thumbnail of {slide_name}: {e}")
+        return slide_name, 'failed', time.time() - start
+    return slide_name, 'done', time.time() - start
+
+
+def plot_thumbnails(jobs, n_process=None, overwrite=False,
+                    thumbnail_cache_dir=DEFAULT_THUMBNAIL_CACHE_DIR,
+                    max_dimension=DEFAULT_THUMBNAIL_MAX_DIMENSION):
+    """Plot the thumbnails of a cohort of slides on a process pool.
+
+    Slides are handed out one at a time so at most n_process slides are in memory at once, and workers are replaced after MAX_SLIDES_PER_WORKER slides. A slide is skipped if its thumbnail is newer than its slide, HDF5, annotation and mask files.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        List of (slide_path, hd5_file_path, annotation_path, mask_path) where annotation_path and mask_path can be None.
+
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    overwrite : bool
+        Whether to plot thumbnails that are already up to date.
+
+    thumbnail_cache_dir : str or None
+        Directory of a ThumbnailCache shared by the workers, by default the one shared with plot_heatmap_overlays. None to not use a cache.
+
+    max_dimension : int or None
+        Maximum width and height of the thumbnails.
+
+    Returns
+    -------
+    list of tuple
+        A (slide_name, status, seconds) tuple for each job where status is one of 'done', 'skipped' or 'failed'.
+    """
+    results = []
+    pending = []
+    for job in jobs:
+        slide_path, hd5_file_path = job[0], job[1]
+        slide_name = utils.path_to_filename(slide_path)
+        thumbnail_path = get_thumbnail_path(hd5_file_path, slide_name)
+        if not overwrite and is_thumbnail_up_to_date(thumbnail_path, job):
+            results.append((slide_name, 'skipped', 0.))
+        else:
+            pending.append(tuple(job))
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(pending), 1))
+    plot_job = functools.partial(plot_thumbnail_job,
+                                 thumbnail_cache_dir=thumbnail_cache_dir,
+                                 max_dimension=max_dimension)
+    if n_process == 1:
+        done = map(plot_job, pending)
+        results.extend(_report_thumbnail_jobs(done))
+    else:
+        with multiprocessing.Pool(processes=n_process,
+                                  maxtasksperchild=MAX_SLIDES_PER_WORKER) as pool:
+            done = pool.imap_unordered(plot_job, pending, chunksize=1)
+            results.extend(_report_thumbnail_jobs(done))
+    return results
+
+
+def _report_thumbnail_jobs(done):
+    for slide_name, status, seconds in done:
+        print(f"{status} {slide_name} in {seconds:.2f}s")
+        yield slide_name, status, seconds
+
+
+def get_colormap_lut(colormap=DEFAULT_HEATMAP_COLORMAP):
+    """Get the lookup table of a matplotlib colormap.
+
+    Returns
+    -------
+    np.ndarray
+        uint8 array of shape (256, 3) with the RGB colour of each probability quantized to 0..255.
+    """
+    colors = matplotlib.colormaps[colormap](np.linspace(0., 1., 256))[:, :3]
+    return np.rint(colors * 255).astype(np.uint8)
+
+
+def get_tile_indices(length, down_sample, tile_size):
+    """Get the tile of each thumbnail pixel along one axis.
+    """
+    return (np.arange(length) * down_sample // tile_size).astype(np.int64)
+
+
+def draw_heatmap(image, grid, down_sample, tile_size, lut, alpha=DEFAULT_HEATMAP_ALPHA):
+    """Blend a class grid of probabilities over a thumbnail in place.
+
+    The grid is upsampled to the thumbnail by nearest neighbour indexing, coloured through the colormap lookup table and alpha blended in one pass. Pixels of tiles without a patch are left as they are.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        (height, width, 3) RGB uint8 thumbnail.
+
+    grid : np.ndarray
+        float array of shape (rows, columns) of probabilities where cells without a patch are NaN.
+
+    down_sample : float
+        Downsample of the thumbnail relative to the slide.
+
+    tile_size : float
+        Size of a grid cell in slide pixels.
+
+    lut : np.ndarray
+        uint8 array of shape (256, 3) from get_colormap_lut.
+
+    alpha : float
+        Opacity of the heatmap.
+    """
+    height, width = image.shape[:2]
+    rows = get_tile_indices(height, down_sample, tile_size)
+    cols = get_tile_indices(width, down_sample, tile_size)
+    # pad the grid with a no data cell for pixels beyond the last tile
+    padded = np.full((grid.shape[0] + 1, grid.shape[1] + 1), np.nan, dtype=np.float32)
+    padded[:grid.shape[0], :grid.shape[1]] = grid
+    rows = np.minimum(rows, grid.shape[0])
+    cols = np.minimum(cols, grid.shape[1])
+    present = ~np.isnan(padded)
+    levels = np.rint(np.clip(np.nan_to_num(padded), 0., 1.) * 255).astype(np.uint8)
+    pixel_levels = levels[rows[:, None], cols[None, :]]
+    pixel_present = present[rows[:, None], cols[None, :]]
+    blended = cv2.addWeighted(image, 1. - alpha, lut[pixel_levels], alpha, 0.)
+    image[pixel_present] = blended[pixel_present]
+
+
+def get_heatmap_level(store, down_sample, patch_size, group_name=None):
+    """Get the coarsest pyramid level of a heatmap that is at least as fine as the thumbnail.
+    """
+    level = int(np.floor(np.log2(max(down_sample / patch_size, 1.))))
+    return min(level, store.get_n_levels(group_name) - 1)
+
+
+def get_overlay_dir(heatmap_path):
+    """Get the directory PlotHeatmapOverlay saves the overlays of a heatmap file in.
+    """
+    return os.path.join(os.path.dirname(heatmap_path), 'Overlays')
+
+
+def get_overlay_path(heatmap_path, slide_name, class_name):
+    """Get the path of the PNG PlotHeatmapOverlay saves for a class of a slide.
+    """
+    return f'{os.path.join(get_overlay_dir(heatmap_path), slide_name)}.{class_name}.png'
+
+
+class PlotHeatmapOverlay(object):
+    def __init__(self, slide_name, os_slide, heatmap_path, class_names=None,
+                 slide_path=None, thumbnail_cache=DEFAULT_THUMBNAIL_CACHE_DIR,
+                 max_dimension=DEFAULT_THUMBNAIL_MAX_DIMENSION, colormap=DEFAULT_HEATMAP_COLORMAP, alpha=DEFAULT_HEATMAP_ALPHA):
+        """Save the heatmap of each class blended over the slide thumbnail.
+
+        The heatmap is read from the coarsest pyramid level that is at least as fine as the thumbnail, or from the full grid if the file has no pyramid.
+
+        Parameters
+        ----------
+        os_slide : OpenSlide
+
+        heatmap_path : str
+            Path to the heatmap.0.{slide_id}.h5 file written by generate_heatmaps.
+
+        class_names : list of str
+            Classes to plot. Defaults to all classes of the heatmap.
+
+        slide_path : str
+            Path of the slide, used to look up the thumbnail in thumbnail_cache.
+
+        thumbnail_cache : ThumbnailCache, str or None
+            Cache, or directory of the cache, to read the decoded thumbnail from instead of the slide. Defaults to the cache in DEFAULT_THUMBNAIL_CACHE_DIR shared by the thumbnail renderers, None to always decode the thumbnail from the slide.
+
+        max_dimension : int or None
+            Maximum width and height of the thumbnail. None to use the size of the lowest resolution level whatever it is.
+
+        colormap : str
+            Name of the matplotlib colormap.
+
+        alpha : float
+            Opacity of the heatmap.
+        """
+        self.os_slide = os_slide
+        self.slide_path = slide_path
+        self.thumbnail_cache = thumbnail_cache
+        self.heatmap_path = heatmap_path
+        self.class_names = class_names
+        self.slide_name = slide_name
+        self.lut = get_colormap_lut(colormap)
+        self.alpha = alpha
+        self.store_path = get_overlay_dir(self.heatmap_path)
+        self.dimensions, self.down_sample = get_thumbnail_size(self.os_slide,
+                                                               max_dimension)
+        self.run()
+
+    def get_thumbnail(self):
+        self.thumbnail = read_thumbnail(self.os_slide, self.dimensions,
+                                        slide_path=self.slide_path,
+                                        thumbnail_cache=self.thumbnail_cache)
+
+    def read_heatmap(self):
+        with HeatmapStore(self.heatmap_path) as store:
+            group_name = store.get_group_name()
+            patch_size = int(group_name.split('/')[0])
+            level = get_heatmap_level(store, self.down_sample, patch_size, group_name)
+            self.class_names = self.class_names or store.get_class_names(group_name)
+            self.grid = store.read(class_names=self.class_names, group_name=group_name,
+                                   level=level)
+        self.tile_size = patch_size * 2**level
+
+    def save_overlays(self):
+        for idx, class_name in enumerate(self.class_names):
+            overlay = self.thumbnail.copy()
+            draw_heatmap(overlay, self.grid[idx], self.down_sample, self.tile_size,
+                         self.lut, self.alpha)
+            Image.fromarray(overlay).save(
+                    get_overlay_path(self.heatmap_path, self.slide_name, class_name))
+
+    def run(self):
+        os.makedirs(self.store_path, exist_ok=True)
+        self.get_thumbnail()
+        self.read_heatmap()
+        self.save_overlays()
+
+
+def plot_heatmap_overlay_job(job, class_names=None,
+                             thumbnail_cache_dir=DEFAULT_THUMBNAIL_CACHE_DIR,
+                             max_dimension=DEFAULT_THUMBNAIL_MAX_DIMENSION,
+                             colormap=DEFAULT_HEATMAP_COLORMAP, alpha=DEFAULT_HEATMAP_ALPHA):
+    """Open the slide of a single job and plot its overlays with PlotHeatmapOverlay.
+
+    Parameters
+    ----------
+    job : tuple
+        A tuple of (slide_path, heatmap_path).
+
+    Returns
+    -------
+    tuple
+        A tuple of
+         - slide_name (str)
+         - status (str) one of 'done' or 'failed'
+         - seconds (float) time taken to plot the overlays
+    """
+    slide_path, heatmap_path = job
+    slide_name = utils.path_to_filename(slide_path)
+    start = time.time()
+    try:
+        os_slide = OpenSlide(slide_path)
+        PlotHeatmapOverlay(slide_name, os_slide, heatmap_path, class_names,
+                           slide_path=slide_path, thumbnail_cache=thumbnail_cache_dir,
+                           max_dimension=max_dimension, colormap=colormap, alpha=alpha)
+        os_slide.close()
+    except Exception as e:
+        print(f"could not plot heatmap overlay of {slide_name}: {e}")
+        return slide_name, 'failed', time.time() - start
+    return slide_name, 'done', time.time() - start
+
+
+def plot_heatmap_overlays(jobs, class_names, n_process=None, overwrite=False,
+                          thumbnail_cache_dir=DEFAULT_THUMBNAIL_CACHE_DIR,
+                          max_dimension=DEFAULT_THUMBNAIL_MAX_DIMENSION,
+                          colormap=DEFAULT_HEATMAP_COLORMAP, alpha=DEFAULT_HEATMAP_ALPHA):
+    """Plot the heatmap overlays of a cohort of slides on a process pool.
+
+    Slides are handed out one at a time and workers are replaced after MAX_SLIDES_PER_WORKER slides, as in plot_thumbnails. A slide is skipped if the overlays of all its classes are newer than its slide and heatmap files.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        List of (slide_path, heatmap_path).
+
+    class_names : list of str
+        Classes to plot.
+
+    n_process : int
+        Number of processes to use. Defaults to the number of CPUs.
+
+    overwrite : bool
+        Whether to plot overlays that are already up to date.
+
+    thumbnail_cache_dir : str or None
+        Directory of a ThumbnailCache shared by the workers, by default the one shared with plot_thumbnails. None to not use a cache.
+
+    max_dimension : int or None
+        Maximum width and height of the overlays.
+
+    colormap : str
+        Name of the matplotlib colormap.
+
+    alpha : float
+        Opacity of the heatmap.
+
+    Returns
+    -------
+    list of tuple
+        A (slide_name, status, seconds) tuple for each job where status is one of 'done', 'skipped' or 'failed'.
+    """
+    results = []
+    pending = []
+    for job in jobs:
+        slide_path, heatmap_path = job
+        slide_name = utils.path_to_filename(slide_path)
+        if not overwrite and all(is_thumbnail_up_to_date(
+                get_overlay_path(heatmap_path, slide_name, class_name), job)
+                for class_name in class_names):
+            results.append((slide_name, 'skipped', 0.))
+        else:
+            pending.append(tuple(job))
+    n_process = min(n_process or multiprocessing.cpu_count(), max(len(pending), 1))
+    plot_job = functools.partial(plot_heatmap_overlay_job, class_names=class_names,
+                                 thumbnail_cache_dir=thumbnail_cache_dir,
+                                 max_dimension=max_dimension, colormap=colormap, alpha=alpha)
+    if n_process == 1:
+        done = map(plot_job, pending)
+        results.extend(_report_thumbnail_jobs(done))
+    else:
+        with multiprocessing.Pool(processes=n_process,
+                                  maxtasksperchild=MAX_SLIDES_PER_WORKER) as pool:
+            done = pool.imap_unordered(plot_job, pending, chunksize=1)
+            results.extend(_report_thumbnail_jobs(done))
+    return results